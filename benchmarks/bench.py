@@ -0,0 +1,405 @@
+"""
+Repeatable HTTP load benchmark for the REST API.
+
+Boots create_app() in a separate process (so the load generator does not share its GIL) against a freshly seeded
+database, replays a weighted request mix built from Insomnia.json with N concurrent clients, and writes latency
+percentiles, throughput and SQL statements per request (from /metrics) to a JSON report. Comparing a report with a
+stored baseline exits non-zero when a scenario regressed.
+
+    python -m benchmarks.bench run --db sqlite --rows 20000 --concurrency 8 --duration 30 --report report.json
+    python -m benchmarks.bench run --db postgres --rows 1000000 --report report.json --baseline baseline.json
+    python -m benchmarks.bench run --url http://localhost:5000 --report report.json   # an already running server
+    python -m benchmarks.bench compare report.json baseline.json
+
+--db postgres seeds DATABASE_URL with seed.py (TRUNCATE first, the schema must be migrated with `flask db upgrade`).
+--db sqlite creates the schema in a temporary SQLite file, a stand-in for quick local runs only.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COLLECTION = os.path.join(ROOT, 'Insomnia.json')
+
+# Insomnia.json predates the rename from the "twitter" project, its requests are mapped onto the current API
+RESOURCE_ALIASES = {'tweets': 'posts', 'users': 'profiles'}
+FIELD_ALIASES = {'user_id': 'profile_id'}
+
+# Relative weight of each kind of request in the mix (overridable per scenario with --mix posts.show=50,...)
+DEFAULT_WEIGHTS = {'index': 10, 'show': 40, 'create': 5, 'update': 3, 'delete': 2, 'like': 10, 'search': 5, 'trending': 5}
+
+# Requests the collection does not have, so every resource and the update path are measured too
+EXTRA_REQUESTS = [
+    ('posts', 'update', 'PATCH', '/posts/{id}', {'content': 'edited by the benchmark', 'likes': 0}),
+    ('posts', 'like', 'POST', '/posts/{id}/like', None),
+    ('posts', 'trending', 'GET', '/posts/trending?hours=24', None),
+    ('profiles', 'index', 'GET', '/profiles', None),
+    ('profiles', 'show', 'GET', '/profiles/{id}', None),
+    ('comments', 'index', 'GET', '/comments', None),
+    ('comments', 'show', 'GET', '/comments/{id}', None),
+    ('images', 'index', 'GET', '/images', None),
+    ('search', 'search', 'GET', '/search?q={word}', None),
+]
+SEARCH_WORDS = ('the', 'people', 'state', 'money', 'world', 'never', 'music', 'movie')
+
+# Flask endpoint that serves each scenario, for the SQL statement counts in /metrics
+ENDPOINTS = {'posts.create': 'posts.create_bulk', 'posts.trending': 'posts.trending_posts', 'search.search': 'search.search'}
+
+# A scenario is a regression when it is worse than the baseline by more than these
+DEFAULT_TOLERANCE = 0.15  # latency percentiles and throughput, relative
+QUERY_TOLERANCE = 0.5  # SQL statements per request, absolute
+
+
+class Scenario:
+    def __init__(self, resource: str, action: str, method: str, path: str, body=None):
+        self.resource = resource
+        self.action = action
+        self.name = '%s.%s' % (resource, action)
+        self.method = method
+        self.path = path
+        self.body = body
+        self.weight = DEFAULT_WEIGHTS.get(action, 1)
+        self.endpoint = ENDPOINTS.get(self.name, self.name)
+
+
+def load_collection(path: str = COLLECTION):
+    """The requests of an Insomnia export as scenarios, with ids in URLs turned into {id} placeholders"""
+    with open(path) as f:
+        export = json.load(f)
+    scenarios = []
+    for resource in export['resources']:
+        if resource['_type'] != 'request':
+            continue
+        segments = resource['url'].replace('{{ _.base_url }}', '').strip('/').split('/')
+        name = RESOURCE_ALIASES.get(segments[0], segments[0])
+        path = '/' + '/'.join([name] + ['{id}' if s.isdigit() else s for s in segments[1:]])
+        body = None
+        if resource.get('body', {}).get('text'):
+            body = {FIELD_ALIASES.get(k, k): v for k, v in json.loads(resource['body']['text']).items()}
+        scenarios.append(Scenario(name, resource['name'], resource['method'], path, body))
+    return scenarios
+
+
+def build_mix(mix_overrides: str = '', skip=()):
+    scenarios = {s.name: s for s in load_collection()}
+    for request in EXTRA_REQUESTS:
+        scenario = Scenario(*request)
+        scenarios.setdefault(scenario.name, scenario)
+    for item in filter(None, (mix_overrides or '').split(',')):
+        name, weight = item.split('=')
+        scenarios[name.strip()].weight = float(weight)
+    return [s for s in scenarios.values() if s.weight > 0 and s.name not in skip]
+
+
+# SERVER
+
+def seed_sqlite(path: str, rows: int, seed: int):
+    import seed as seeder
+    from social_media_app.src import create_app
+    from social_media_app.src.models import db
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'SQLALCHEMY_ECHO': False})
+    with app.app_context():
+        db.create_all()
+        db.engine.dispose()
+    connection = sqlite3.connect(path)
+    for chunk in seeder.plan(rows, 1, 1, seed):
+        for buffer in seeder.generate_chunk(*chunk, seed, buffer_class=seeder.RowBuffer):
+            buffer.write(connection)
+    connection.commit()
+    connection.close()
+
+
+def serve(uri: str, ready):
+    """Run the app on a free local port with metrics on, reporting the port through ready"""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from social_media_app.src import create_app
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'  # reuse each client's connection like a real load balancer would
+        disable_nagle_algorithm = True  # headers and body are separate writes, do not wait for the client's delayed ACK
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    config = {'SQLALCHEMY_DATABASE_URI': uri, 'SQLALCHEMY_ECHO': False, 'METRICS_ENABLED': True, 'LOG_LEVEL': 'WARNING'}
+    if uri.startswith('sqlite'):
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30, 'check_same_thread': False}}
+    app = create_app(config)
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=KeepAliveHandler)
+    ready.put(server.port)
+    server.serve_forever()
+
+
+def boot(args):
+    """Seed the database and start the server, returns (base url, server process, scenarios to skip)"""
+    skip = set()
+    if args.db == 'sqlite':
+        path = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')
+        seed_sqlite(path, args.rows, args.seed)
+        uri = 'sqlite:///' + path
+        skip.add('posts.update')  # update() stores the JSON date string as is, which only Postgres accepts
+    else:
+        import seed as seeder
+        uri = seeder.database_url()
+        seeder.load(uri, args.rows, args.seed, multiprocessing.cpu_count(), truncate=True, log=lambda message: None)
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(uri, ready), daemon=True)
+    process.start()
+    return 'http://127.0.0.1:%d' % ready.get(timeout=60), process, skip
+
+
+# LOAD
+
+class Client:
+    """One keep-alive connection, used by a single worker thread"""
+
+    def __init__(self, base_url: str):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.connection = None
+
+    def request(self, method: str, path: str, body=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.connection.request(method, path, body=payload, headers=headers)
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                self.connection.close()
+                self.connection = None  # the server closed the connection, retry once on a new one
+                if attempt:
+                    raise
+
+
+class Load:
+    """Shared state of a run: ids to request, posts created by the run, and the timings"""
+
+    def __init__(self, scenarios, ids, seed: int):
+        self.scenarios = scenarios
+        self.weights = [s.weight for s in scenarios]
+        self.ids = ids
+        self.seed = seed
+        self.created = []  # post ids created by the run, deletes only remove those
+        self.timings = {s.name: [] for s in scenarios}
+        self.errors = {s.name: 0 for s in scenarios}
+        self.lock = threading.Lock()
+
+    def prepare(self, scenario: Scenario, rng: random.Random):
+        """(path, body) for one request, or None if it cannot run right now"""
+        body = scenario.body
+        if scenario.action == 'delete':
+            with self.lock:
+                if not self.created:
+                    return None
+                id = self.created.pop()
+        elif '{id}' in scenario.path:
+            if not self.ids.get(scenario.resource):
+                return None
+            id = rng.choice(self.ids[scenario.resource])
+        else:
+            id = None
+        path = scenario.path.replace('{id}', str(id)).replace('{word}', rng.choice(SEARCH_WORDS))
+        if scenario.action == 'create':
+            # Creates go through /bulk with one item: it parses the ISO date on every database and fans out the same way
+            item = dict(body, post_date=datetime.utcnow().isoformat())
+            item['profile_id'] = rng.choice(self.ids['profiles'])
+            path, body = path + '/bulk', [item]
+        elif scenario.action == 'update':
+            body = dict(body, post_date=datetime.utcnow().isoformat(), profile_id=rng.choice(self.ids['profiles']))
+        return path, body
+
+    def worker(self, number: int, base_url: str, deadline: float, max_requests: int):
+        rng = random.Random(self.seed * 7919 + number)
+        client = Client(base_url)
+        done = 0
+        while time.perf_counter() < deadline and (not max_requests or done < max_requests):
+            scenario = rng.choices(self.scenarios, self.weights)[0]
+            prepared = self.prepare(scenario, rng)
+            if prepared is None:
+                continue
+            path, body = prepared
+            start = time.perf_counter()
+            status, data = client.request(scenario.method, path, body)
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.timings[scenario.name].append(elapsed)
+                if status >= 400:
+                    self.errors[scenario.name] += 1
+                elif scenario.action == 'create':
+                    self.created.append(json.loads(data)['results'][0]['id'])
+            done += 1
+
+
+def discover_ids(base_url: str, limit: int = 500):
+    """Ids that exist, read from the first page of every index endpoint"""
+    client = Client(base_url)
+    ids = {}
+    for resource in ('profiles', 'posts', 'comments', 'images'):
+        status, data = client.request('GET', '/%s?limit=%d' % (resource, limit))
+        ids[resource] = [row['id'] for row in json.loads(data)['results']] if status == 200 else []
+    return ids
+
+
+def query_counts(base_url: str):
+    """Mean SQL statements per request by endpoint, from the server's /metrics (empty if metrics are off)"""
+    status, data = Client(base_url).request('GET', '/metrics')
+    if status != 200:
+        return {}
+    sums, counts = {}, {}
+    for line in data.decode('utf-8').splitlines():
+        for suffix, target in (('_sum', sums), ('_count', counts)):
+            prefix = 'http_request_db_queries%s{endpoint="' % suffix
+            if line.startswith(prefix):
+                endpoint, value = line[len(prefix):].split('"} ')
+                target[endpoint] = float(value)
+    return {endpoint: round(sums[endpoint] / counts[endpoint], 2) for endpoint in sums if counts.get(endpoint)}
+
+
+def percentile(sorted_values, fraction: float):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))  # nearest rank
+    return sorted_values[index]
+
+
+def summarize(timings, errors, elapsed: float):
+    values = sorted(timings)
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'rps': round(len(values) / elapsed, 2),
+        'p50_ms': round(percentile(values, 0.50) * 1000, 3) if values else None,
+        'p95_ms': round(percentile(values, 0.95) * 1000, 3) if values else None,
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3) if values else None,
+    }
+
+
+def run(args):
+    process = None
+    skip = set()
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        base_url, process, skip = boot(args)
+    try:
+        scenarios = build_mix(args.mix, skip)
+        load = Load(scenarios, discover_ids(base_url), args.seed)
+        started = time.perf_counter()
+        deadline = started + args.duration
+        per_worker = -(-args.requests // args.concurrency) if args.requests else 0
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            futures = [pool.submit(load.worker, n, base_url, deadline, per_worker) for n in range(args.concurrency)]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - started
+        queries = query_counts(base_url)
+    finally:
+        if process is not None:
+            process.terminate()
+
+    report = {
+        'config': {'db': None if args.url else args.db, 'url': args.url, 'rows': args.rows, 'seed': args.seed,
+                   'concurrency': args.concurrency, 'duration': args.duration, 'requests': args.requests,
+                   'mix': {s.name: s.weight for s in scenarios}, 'skipped': sorted(skip)},
+        'total': summarize([t for values in load.timings.values() for t in values], sum(load.errors.values()), elapsed),
+        'scenarios': {}
+    }
+    for scenario in scenarios:
+        result = summarize(load.timings[scenario.name], load.errors[scenario.name], elapsed)
+        result['queries_per_request'] = queries.get(scenario.endpoint)
+        report['scenarios'][scenario.name] = result
+    return report
+
+
+# COMPARE
+
+def compare(report: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE):
+    """Lines describing every regression of report against baseline (empty if there are none)"""
+    regressions = []
+    for name, base in sorted(baseline['scenarios'].items()):
+        current = report['scenarios'].get(name)
+        if current is None or not current['requests'] or not base['requests']:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if current[key] > base[key] * (1 + tolerance):
+                regressions.append('%s %s %.3f -> %.3f (+%.0f%%)' % (name, key, base[key], current[key], (current[key] / base[key] - 1) * 100))
+        if current['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append('%s rps %.2f -> %.2f' % (name, base['rps'], current['rps']))
+        if current['errors'] > base['errors']:
+            regressions.append('%s errors %d -> %d' % (name, base['errors'], current['errors']))
+        if base.get('queries_per_request') is not None and current.get('queries_per_request') is not None \
+                and current['queries_per_request'] > base['queries_per_request'] + QUERY_TOLERANCE:
+            regressions.append('%s queries/request %.2f -> %.2f' % (name, base['queries_per_request'], current['queries_per_request']))
+    return regressions
+
+
+def print_report(report: dict):
+    print('%-22s %8s %6s %9s %9s %9s %9s %8s' % ('scenario', 'requests', 'errors', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+    rows = sorted(report['scenarios'].items()) + [('TOTAL', report['total'])]
+    for name, r in rows:
+        print('%-22s %8d %6d %9.2f %9s %9s %9s %8s' % (name, r['requests'], r['errors'], r['rps'], r['p50_ms'], r['p95_ms'],
+                                                      r['p99_ms'], r.get('queries_per_request', '')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmark and write a report')
+    run_parser.add_argument('--db', choices=('sqlite', 'postgres'), default='sqlite', help='database to boot the app against')
+    run_parser.add_argument('--url', help='benchmark an already running server instead of booting one')
+    run_parser.add_argument('--rows', type=int, default=20000, help='approximate rows to seed (see seed.py)')
+    run_parser.add_argument('--seed', type=int, default=42, help='seed for the data and the request sequence')
+    run_parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    run_parser.add_argument('--duration', type=float, default=30, help='seconds to run for')
+    run_parser.add_argument('--requests', type=int, default=0, help='stop after this many requests (0: run for --duration)')
+    run_parser.add_argument('--mix', default='', help='scenario weights, e.g. posts.show=50,posts.create=0')
+    run_parser.add_argument('--report', default='bench_report.json', help='where to write the JSON report')
+    run_parser.add_argument('--baseline', help='compare with this report and exit 1 on regressions')
+    run_parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='allowed relative slowdown')
+
+    compare_parser = commands.add_parser('compare', help='compare a report with a baseline report')
+    compare_parser.add_argument('report')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='allowed relative slowdown')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        report = run(args)
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print_report(report)
+        baseline_path = args.baseline
+    else:
+        with open(args.report) as f:
+            report = json.load(f)
+        baseline_path = args.baseline
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        if regressions:
+            return 1
+        print('No regressions against %s.' % baseline_path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,93 +1,239 @@
-# """
-# Populate twitter database with fake data using the SQLAlchemy ORM.
-# """
+"""
+Populate the social media database with synthetic profiles, posts, comments and images for benchmarking.
 
-# import random
-# import string
-# import hashlib
-# import secrets
-# from faker import Faker
-# from twitter.src.models import User, Tweet, likes_table, db
-# from twitter.src import create_app
-
-# USER_COUNT = 50
-# TWEET_COUNT = 100
-# LIKE_COUNT = 400
-
-# assert LIKE_COUNT <= (USER_COUNT * TWEET_COUNT)
-
-
-# def random_passhash():
-#     """Get hashed and salted password of length N | 8 <= N <= 15"""
-#     raw = ''.join(
-#         random.choices(
-#             string.ascii_letters + string.digits + '!@#$%&', # valid pw characters
-#             k=random.randint(8, 15) # length of pw
-#         )
-#     )
-
-#     salt = secrets.token_hex(16)
-
-#     return hashlib.sha512((raw + salt).encode('utf-8')).hexdigest()
-
-
-# def truncate_tables():
-#     """Delete all rows from database tables"""
-#     db.session.execute(likes_table.delete())
-#     Tweet.query.delete()
-#     User.query.delete()
-#     db.session.commit()
-
-
-# def main():
-#     """Main driver function"""
-#     app = create_app()
-#     app.app_context().push()
-#     truncate_tables()
-#     fake = Faker()
-
-#     last_user = None  # save last user
-#     for _ in range(USER_COUNT):
-#         last_user = User(
-#             username=fake.unique.first_name().lower() + str(random.randint(1,150)),
-#             password=random_passhash()
-#         )
-#         db.session.add(last_user)
-
-#     # insert users
-#     db.session.commit()
-
-#     last_tweet = None  # save last tweet
-#     for _ in range(TWEET_COUNT):
-#         last_tweet = Tweet(
-#             content=fake.sentence(),
-#             user_id=random.randint(last_user.id - USER_COUNT + 1, last_user.id)
-#         )
-#         db.session.add(last_tweet)
-
-#     # insert tweets
-#     db.session.commit()
-
-#     user_tweet_pairs = set()
-#     while len(user_tweet_pairs) < LIKE_COUNT:
-
-#         candidate = (
-#             random.randint(last_user.id - USER_COUNT + 1, last_user.id),
-#             random.randint(last_tweet.id - TWEET_COUNT + 1, last_tweet.id)
-#         )
-
-#         if candidate in user_tweet_pairs:
-#             continue  # pairs must be unique
-
-#         user_tweet_pairs.add(candidate)
-
-#     new_likes = [{"user_id": pair[0], "tweet_id": pair[1]} for pair in list(user_tweet_pairs)]
-#     insert_likes_query = likes_table.insert().values(new_likes)
-#     db.session.execute(insert_likes_query)
-
-#     # insert likes
-#     db.session.commit()
-
-
-# # run script
-# main()
+Rows are generated with Faker from a fixed seed (the same arguments always produce the same data) with a power-law
+skew: a few profiles post a lot and a few posts get most of the comments, like a real network. Every chunk of profiles
+is written with COPY FROM STDIN by its own worker process in its own transaction, so millions of rows load in minutes
+instead of one INSERT per session.add().
+
+    python seed.py --rows 1000000 --truncate            # about a million rows in total
+    python seed.py --rows 50000000 --workers 16         # production sized, appended after the existing rows
+
+Needs Postgres (DATABASE_URL, as for the app). When posts and comments are partitioned (migration 0009), the monthly
+partitions from START to END are created first, so the rows do not all land in the default partitions.
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import random
+import time
+from datetime import datetime, timedelta
+import psycopg2
+from dotenv import load_dotenv
+from faker import Faker
+
+POSTS_PER_PROFILE = 10  # Mean of the power-law number of posts per profile
+COMMENTS_PER_POST = 3  # Mean of the power-law number of comments per post
+IMAGES_PER_POST = 0.3  # Chance that a post has an image
+SKEW = 1.5  # Pareto shape, lower means a heavier tail (1.5: the top 1% of profiles write about a fifth of the posts)
+MAX_PER_PARENT = 5000  # Cap on the posts of one profile and the comments of one post
+PROFILES_PER_CHUNK = 2000  # Profiles (and all of their rows) loaded per COPY transaction
+POOL_SIZE = 2000  # Faker sentences/names generated per chunk and then sampled, Faker is the slow part
+START = datetime(2015, 1, 1)  # Profiles join between START and END, everything else happens after that
+END = datetime(2024, 12, 31)
+
+ROWS_PER_PROFILE = 1 + POSTS_PER_PROFILE * (1 + COMMENTS_PER_POST + IMAGES_PER_POST)
+TABLES = ('profiles', 'posts', 'comments', 'images', 'follows', 'timeline_entries', 'trending_buckets')
+
+
+def database_url():
+    load_dotenv()
+    url = os.getenv('DATABASE_URL')
+    if not url:
+        raise SystemExit("DATABASE_URL is not set.")
+    return url.replace('postgresql+psycopg2://', 'postgresql://')  # libpq does not know SQLAlchemy driver names
+
+
+def power_law(rng: random.Random, mean: float):
+    """A Pareto distributed count with the given mean (before the MAX_PER_PARENT cap)"""
+    scale = mean * (SKEW - 1) / SKEW  # the mean of paretovariate(SKEW) is SKEW / (SKEW - 1)
+    return min(int(rng.paretovariate(SKEW) * scale), MAX_PER_PARENT)
+
+
+def copy_value(value):
+    """Format a value for COPY ... FROM STDIN (text format)"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyBuffer:
+    """Rows of one table, sent to Postgres with a single COPY"""
+
+    def __init__(self, table: str, columns):
+        self.table = table
+        self.columns = columns
+        self.buffer = io.StringIO()
+        self.rows = 0
+
+    def add(self, *values):
+        self.buffer.write('\t'.join(copy_value(v) for v in values))
+        self.buffer.write('\n')
+        self.rows += 1
+
+    def write(self, cursor):
+        self.buffer.seek(0)
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (self.table, ', '.join(self.columns)), self.buffer)
+
+
+class RowBuffer:
+    """Rows of one table, sent with one executemany INSERT (for databases without COPY, e.g. SQLite in benchmarks/)"""
+
+    def __init__(self, table: str, columns):
+        self.table = table
+        self.columns = columns
+        self.values = []
+        self.rows = 0
+
+    def add(self, *values):
+        self.values.append(tuple(v.isoformat(sep=' ') if isinstance(v, datetime) else v for v in values))
+        self.rows += 1
+
+    def write(self, cursor):
+        placeholders = ', '.join('?' for _ in self.columns)
+        cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (self.table, ', '.join(self.columns), placeholders), self.values)
+
+
+def random_date(rng: random.Random, after: datetime):
+    return after + timedelta(seconds=rng.randint(0, int((END - after).total_seconds())))
+
+
+def plan(rows: int, first_profile_id: int, first_post_id: int, seed: int):
+    """Split the load into chunks of (chunk number, first profile id, posts per profile, first post id)"""
+    rng = random.Random(seed)
+    profiles = max(1, round(rows / ROWS_PER_PROFILE))
+    chunks = []
+    profile_id, post_id = first_profile_id, first_post_id
+    for number, start in enumerate(range(0, profiles, PROFILES_PER_CHUNK)):
+        counts = [power_law(rng, POSTS_PER_PROFILE) for _ in range(min(PROFILES_PER_CHUNK, profiles - start))]
+        chunks.append((number, profile_id, counts, post_id))
+        profile_id += len(counts)
+        post_id += sum(counts)
+    return chunks
+
+
+def generate_chunk(number: int, first_profile_id: int, post_counts, first_post_id: int, seed: int, buffer_class=CopyBuffer):
+    """The buffers of one chunk. Profile and post ids are explicit, comment and image ids come from the sequences"""
+    rng = random.Random(seed * 1000003 + number)  # every chunk is reproducible on its own, whichever worker runs it
+    fake = Faker()
+    fake.seed_instance(seed * 1000003 + number)
+    sentences = [fake.sentence(nb_words=8)[:128] for _ in range(POOL_SIZE)]
+    names = [fake.name()[:128] for _ in range(POOL_SIZE)]
+    words = [fake.word() for _ in range(POOL_SIZE)]
+
+    profiles = buffer_class('profiles', ('id', 'username', 'password', 'name', 'interests', 'birthday', 'start_date', 'fan_out_on_read',
+                                         'post_count', 'total_likes'))
+    posts = buffer_class('posts', ('id', 'content', 'post_date', 'likes', 'profile_id', 'comment_count', 'image_count'))
+    comments = buffer_class('comments', ('content', 'comment_date', 'post_id'))
+    images = buffer_class('images', ('url', 'image_date', 'post_id', 'comment_id'))
+
+    post_id = first_post_id
+    for offset, count in enumerate(post_counts):
+        profile_id = first_profile_id + offset
+        start_date = random_date(rng, START)
+        birthday = datetime(1950, 1, 1) + timedelta(days=rng.randint(0, 365 * 55))
+        interests = ', '.join(rng.sample(words, 3))
+        username = '%s%d' % (rng.choice(words), profile_id)  # the id suffix keeps usernames unique
+        password, name = '%032x' % rng.getrandbits(128), rng.choice(names)
+        # Rows are added once their counters are known (row order within a table does not matter to COPY)
+        total_likes = 0
+        for _ in range(count):
+            post_date = random_date(rng, start_date)
+            content, likes = rng.choice(sentences), power_law(rng, 20)
+            comment_count = power_law(rng, COMMENTS_PER_POST)
+            for _ in range(comment_count):
+                comments.add(rng.choice(sentences), random_date(rng, post_date), post_id)
+            image_count = 0
+            if rng.random() < IMAGES_PER_POST:
+                images.add('https://picsum.photos/seed/%d/640/480' % post_id, post_date, post_id, None)
+                image_count = 1
+            posts.add(post_id, content, post_date, likes, profile_id, comment_count, image_count)
+            total_likes += likes
+            post_id += 1
+        profiles.add(profile_id, username, password, name, interests[:128], birthday, start_date, False, count, total_likes)
+    return [profiles, posts, comments, images]
+
+
+def create_partitions(url: str):
+    """Create the monthly partitions of posts and comments for START..END if the tables are partitioned, returns their
+    names"""
+    # Imported here so that seed.py (and its worker processes) only boot the app for this step
+    from social_media_app.src import create_app
+    from social_media_app.src.models import db
+    from social_media_app.src.partitions import PARTITIONED, add_months, ensure_months, is_partitioned, month_start
+    months = [month_start(START)]
+    while months[-1] < month_start(END):
+        months.append(add_months(months[-1], 1))
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'SQLALCHEMY_ECHO': False, 'PARTITION_AUTO_CREATE': False})
+    with app.app_context():
+        try:
+            return [name for table in PARTITIONED if is_partitioned(table) for name in ensure_months(table, months)]
+        finally:
+            db.engine.dispose()  # close the connections before the worker processes fork
+
+
+def load_chunk(args):
+    """Generate one chunk and COPY it in one transaction, returns the rows written"""
+    url, number, first_profile_id, post_counts, first_post_id, seed = args
+    buffers = generate_chunk(number, first_profile_id, post_counts, first_post_id, seed)
+    connection = psycopg2.connect(url)
+    try:
+        with connection, connection.cursor() as cursor:  # commits at the end of the block
+            for buffer in buffers:  # parents before children, so the foreign keys are satisfied
+                buffer.write(cursor)
+    finally:
+        connection.close()
+    return sum(buffer.rows for buffer in buffers)
+
+
+def load(url: str, rows: int, seed: int, workers: int, truncate: bool, log=print):
+    """Load about rows rows into the database at url, returns the number of rows written"""
+    with psycopg2.connect(url) as connection, connection.cursor() as cursor:
+        if truncate:
+            cursor.execute('TRUNCATE %s RESTART IDENTITY CASCADE' % ', '.join(TABLES))
+        cursor.execute('SELECT coalesce(max(id), 0) FROM profiles')
+        first_profile_id = cursor.fetchone()[0] + 1
+        cursor.execute('SELECT coalesce(max(id), 0) FROM posts')
+        first_post_id = cursor.fetchone()[0] + 1
+    connection.close()
+    created = create_partitions(url)
+    if created:
+        log('Created %d monthly partitions.' % len(created))
+
+    chunks = plan(rows, first_profile_id, first_post_id, seed)
+    log('Loading about %d rows in %d chunks with %d workers...' % (rows, len(chunks), workers))
+    started = time.perf_counter()
+    written = 0
+    with multiprocessing.Pool(workers) as pool:
+        work = [(url, number, profile_id, counts, post_id, seed) for number, profile_id, counts, post_id in chunks]
+        for done, count in enumerate(pool.imap_unordered(load_chunk, work), 1):
+            written += count
+            log('  chunk %d/%d, %d rows, %.0f rows/s' % (done, len(chunks), written, written / (time.perf_counter() - started)))
+
+    # Profile and post ids were written explicitly, move their sequences past them; then refresh planner statistics
+    with psycopg2.connect(url) as connection, connection.cursor() as cursor:
+        for table in ('profiles', 'posts'):
+            cursor.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), (SELECT max(id) FROM %s))" % (table, table))
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE %s' % ', '.join(TABLES[:4]))
+    connection.close()
+    log('Done: %d rows in %.1fs.' % (written, time.perf_counter() - started))
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000, help='approximate number of rows to create in total (10k to 50M)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed, the same seed produces the same data')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='parallel COPY processes')
+    parser.add_argument('--truncate', action='store_true', help='empty the tables first')
+    args = parser.parse_args()
+    load(database_url(), args.rows, args.seed, args.workers, args.truncate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# Production launch profile: run with `gunicorn -c gunicorn.conf.py wsgi:app` (this is what docker-compose does).
+# `python wsgi.py` still starts the single-process Flask development server for local debugging.
+# Every setting can be overridden with an environment variable so one image works on any machine size.
+import multiprocessing
+import os
+from src.pool import env_flag
+
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+
+# 'gthread' (threads inside each worker process) or 'gevent' (green threads, gevent and psycogreen are in requirements.txt)
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+
+# One process per core plus one, so a container uses all of its cores (WEB_CONCURRENCY is the usual override)
+workers = int(os.getenv('WEB_CONCURRENCY') or multiprocessing.cpu_count() * 2 + 1)
+threads = int(os.getenv('GUNICORN_THREADS', 4))  # Request threads per worker (gthread only)
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))  # Concurrent requests per worker (gevent only)
+
+# Import the app once in the master and fork the workers from it: faster start-up and shared memory pages.
+# Note: with preload a HUP reload restarts the workers but keeps the preloaded code. To roll out new code without
+# downtime send USR2 (start a new master) and then WINCH + QUIT to the old one, or set GUNICORN_PRELOAD=false.
+preload_app = env_flag('GUNICORN_PRELOAD', True)
+
+# Graceful restarts: workers get graceful_timeout seconds to finish in-flight requests before being killed,
+# and are recycled after max_requests (+ jitter so they do not all restart at once) to cap memory growth.
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 100))
+reload = env_flag('GUNICORN_RELOAD', False)  # Restart workers on code changes (development only)
+
+# Access and error logs go to stdout/stderr for docker logs
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info').lower()
+
+
+def post_fork(server, worker):
+    # gevent workers need psycopg2 to yield to other green threads while it waits on Postgres
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+    # Database connections opened in the master while preloading must never be shared between forked workers
+    if preload_app:
+        from src.models import db
+        app = server.app.wsgi()
+        with app.app_context():
+            db.engine.dispose()
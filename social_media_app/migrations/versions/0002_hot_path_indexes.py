@@ -0,0 +1,36 @@
+"""hot path indexes for foreign keys
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 11:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction, and it keeps the tables writable while the index builds
+    with op.get_context().autocommit_block():
+        op.create_index('ix_posts_profile_id_post_date', 'posts',
+                        ['profile_id', sa.text('post_date DESC'), sa.text('id DESC')], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_comments_post_id_comment_date', 'comments',
+                        ['post_id', 'comment_date', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_images_post_id', 'images', ['post_id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_images_comment_id', 'images', ['comment_id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_images_comment_id', table_name='images', postgresql_concurrently=True)
+        op.drop_index('ix_images_post_id', table_name='images', postgresql_concurrently=True)
+        op.drop_index('ix_comments_post_id_comment_date', table_name='comments', postgresql_concurrently=True)
+        op.drop_index('ix_posts_profile_id_post_date', table_name='posts', postgresql_concurrently=True)
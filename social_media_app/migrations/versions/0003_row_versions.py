@@ -0,0 +1,29 @@
+"""row versions for etags
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 14:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+TABLES = ('profiles', 'posts', 'images', 'comments')
+
+
+def upgrade():
+    # A constant server default is a metadata-only change on Postgres 11+, existing rows are not rewritten
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_column(table, 'version')
@@ -0,0 +1,52 @@
+"""full text search on post and comment content
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 15:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+TABLES = ('posts', 'comments')
+
+
+def upgrade():
+    # The trigger keeps search_vector in step with content on every INSERT and on UPDATEs that touch content
+    op.execute("""
+        CREATE FUNCTION search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := to_tsvector('english', coalesce(NEW.content, ''));
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    for table in TABLES:
+        op.add_column(table, sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+        op.execute("CREATE TRIGGER %s_search_vector BEFORE INSERT OR UPDATE OF content ON %s "
+                   "FOR EACH ROW EXECUTE FUNCTION search_vector_update()" % (table, table))
+        op.execute("UPDATE %s SET search_vector = to_tsvector('english', coalesce(content, ''))" % table)
+
+    # Build the GIN indexes without blocking writes
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            op.create_index('ix_%s_search_vector' % table, table, ['search_vector'], unique=False,
+                            postgresql_using='gin', postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            op.drop_index('ix_%s_search_vector' % table, table_name=table, postgresql_concurrently=True)
+    for table in TABLES:
+        op.execute("DROP TRIGGER %s_search_vector ON %s" % (table, table))
+        op.drop_column(table, 'search_vector')
+    op.execute("DROP FUNCTION search_vector_update()")
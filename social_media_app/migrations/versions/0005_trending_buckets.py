@@ -0,0 +1,32 @@
+"""hourly trending score buckets
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 16:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('trending_buckets',
+    sa.Column('hour', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('hour', 'post_id')
+    )
+    op.create_index('ix_trending_buckets_post_id', 'trending_buckets', ['post_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_trending_buckets_post_id', table_name='trending_buckets')
+    op.drop_table('trending_buckets')
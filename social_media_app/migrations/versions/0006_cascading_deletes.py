@@ -0,0 +1,47 @@
+"""on delete cascade for every foreign key
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 18:10:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+# (constraint name Postgres gave the unnamed constraints of 0001, table, column, referenced table)
+FOREIGN_KEYS = (
+    ('posts_profile_id_fkey', 'posts', 'profile_id', 'profiles'),
+    ('comments_post_id_fkey', 'comments', 'post_id', 'posts'),
+    ('images_post_id_fkey', 'images', 'post_id', 'posts'),
+    ('images_comment_id_fkey', 'images', 'comment_id', 'comments'),
+    ('follows_follower_id_fkey', 'follows', 'follower_id', 'profiles'),
+    ('follows_followee_id_fkey', 'follows', 'followee_id', 'profiles'),
+    ('timeline_entries_profile_id_fkey', 'timeline_entries', 'profile_id', 'profiles'),
+)
+
+
+def _recreate(ondelete):
+    for name, table, column, referent in FOREIGN_KEYS:
+        op.drop_constraint(name, table, type_='foreignkey')
+        # NOT VALID skips re-checking every existing row while the table is locked
+        op.execute('ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s (id)%s NOT VALID'
+                   % (table, name, column, referent, ' ON DELETE %s' % ondelete if ondelete else ''))
+    # VALIDATE only needs a lock that lets writes through, but only once the transaction holding the ADD CONSTRAINT
+    # locks has committed: run each one in its own transaction
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in FOREIGN_KEYS:
+            op.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (table, name))
+
+
+def upgrade():
+    _recreate('CASCADE')
+
+
+def downgrade():
+    _recreate(None)
@@ -0,0 +1,32 @@
+"""post, like, comment and image counters
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 20:05:00.000000
+
+The columns start at 0 (adding a column with a constant default does not rewrite the table). Fill them in afterwards
+with `flask repair-counters`, which recomputes them in chunks instead of one long UPDATE of every row.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('profiles', sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('profiles', sa.Column('total_likes', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('posts', sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('posts', sa.Column('image_count', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('posts', 'image_count')
+    op.drop_column('posts', 'comment_count')
+    op.drop_column('profiles', 'total_likes')
+    op.drop_column('profiles', 'post_count')
@@ -0,0 +1,112 @@
+"""posts and comments partitioned by month
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 21:30:00.000000
+
+Rewrites both tables into partitioned ones (one partition per month of post_date / comment_date, see src/partitions.py)
+while holding an exclusive lock on them: run it in a maintenance window. Needs Postgres 13 or later (row triggers on a
+partitioned table).
+
+The primary keys become (id, <date>), which nothing can reference by id alone, so the foreign keys to posts.id and
+comments.id are dropped; the creates check the parents exist (api/bulk.py) and the deletes in purge.py and
+Comment.delete() remove the dependent rows themselves.
+The downgrade puts them back and fails at VALIDATE if rows still point at posts or comments that were archived.
+"""
+import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+TABLES = (('posts', 'post_date'), ('comments', 'comment_date'))  # (table, partition key)
+MONTHS_AHEAD = 3  # Future months created here, src/partitions.py keeps creating them from then on
+
+# (constraint name, table, column, referenced table) of the foreign keys to posts and comments, as 0006 left them
+FOREIGN_KEYS = (
+    ('comments_post_id_fkey', 'comments', 'post_id', 'posts'),
+    ('images_post_id_fkey', 'images', 'post_id', 'posts'),
+    ('images_comment_id_fkey', 'images', 'comment_id', 'comments'),
+    ('timeline_entries_post_id_fkey', 'timeline_entries', 'post_id', 'posts'),
+    ('trending_buckets_post_id_fkey', 'trending_buckets', 'post_id', 'posts'),
+)
+
+# table -> (name, columns) of the indexes of 0001, 0002 and 0004, built again on the new tables
+INDEXES = {
+    'posts': (('ix_posts_post_date_id', 'post_date, id'),
+              ('ix_posts_profile_id_post_date', 'profile_id, post_date DESC, id DESC')),
+    'comments': (('ix_comments_comment_date_id', 'comment_date, id'),
+                 ('ix_comments_post_id_comment_date', 'post_id, comment_date, id')),
+}
+
+
+# Copies of the helpers in src/partitions.py, a migration must not change when the application code does
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def _partition_name(table, month):
+    return '%s_p%04d_%02d' % (table, month.year, month.month)
+
+
+def _create_partitions(table, column):
+    today = datetime.datetime.utcnow().date()
+    oldest = op.get_bind().execute(sa.text('SELECT min(%s) FROM %s_unpartitioned' % (column, table))).scalar() or today
+    month, last = datetime.date(oldest.year, oldest.month, 1), _add_months(datetime.date(today.year, today.month, 1), MONTHS_AHEAD)
+    while month <= last:
+        op.execute("CREATE TABLE %s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')"
+                   % (_partition_name(table, month), table, month.isoformat(), _add_months(month, 1).isoformat()))
+        month = _add_months(month, 1)
+    op.execute('CREATE TABLE %s_default PARTITION OF %s DEFAULT' % (table, table))  # anything beyond the last month
+
+
+def _finish_table(table, primary_key):
+    # Indexes, constraints and the trigger once the rows are in: building an index over loaded rows beats updating it per row
+    op.execute('ALTER TABLE %s ADD PRIMARY KEY (%s)' % (table, primary_key))
+    for name, columns in INDEXES[table]:
+        op.execute('CREATE INDEX %s ON %s (%s)' % (name, table, columns))
+    op.execute('CREATE INDEX ix_%s_search_vector ON %s USING gin (search_vector)' % (table, table))
+    if table == 'posts':
+        op.execute('ALTER TABLE posts ADD CONSTRAINT posts_profile_id_fkey FOREIGN KEY (profile_id) '
+                   'REFERENCES profiles (id) ON DELETE CASCADE')
+    op.execute("CREATE TRIGGER %s_search_vector BEFORE INSERT OR UPDATE OF content ON %s "
+               "FOR EACH ROW EXECUTE FUNCTION search_vector_update()" % (table, table))
+
+
+def _rebuild(table, column, old_name, partitioned):
+    """Move the rows of table (renamed to old_name) into a new table of the same name, partitioned or not"""
+    op.execute('ALTER TABLE %s RENAME TO %s' % (table, old_name))
+    op.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)%s'
+               % (table, old_name, ' PARTITION BY RANGE (%s)' % column if partitioned else ''))
+    if partitioned:
+        _create_partitions(table, column)
+    op.execute('INSERT INTO %s SELECT * FROM %s' % (table, old_name))
+    op.execute('ALTER SEQUENCE %s_id_seq OWNED BY %s.id' % (table, table))  # or dropping the old table drops the sequence
+    op.execute('DROP TABLE %s CASCADE' % old_name)  # with its partitions, indexes and trigger on the way down
+    _finish_table(table, 'id, %s' % column if partitioned else 'id')
+
+
+def upgrade():
+    for name, table, _, _ in FOREIGN_KEYS:
+        op.drop_constraint(name, table, type_='foreignkey')
+    for table, column in TABLES:
+        _rebuild(table, column, '%s_unpartitioned' % table, partitioned=True)
+
+
+def downgrade():
+    for table, column in TABLES:
+        _rebuild(table, column, '%s_partitioned' % table, partitioned=False)
+    for name, table, column, referent in FOREIGN_KEYS:
+        # NOT VALID skips re-checking every existing row while the tables are locked
+        op.execute('ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s (id) ON DELETE CASCADE NOT VALID'
+                   % (table, name, column, referent))
+    # VALIDATE lets writes through only once the rebuild's locks are released, so after its commit (as in 0006)
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in FOREIGN_KEYS:
+            op.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (table, name))
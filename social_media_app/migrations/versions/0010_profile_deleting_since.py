@@ -0,0 +1,30 @@
+"""profiles.deleting_since for resumable background deletes
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18 22:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('profiles', sa.Column('deleting_since', sa.DateTime(), nullable=True))  # nullable: no table rewrite
+    # Partial: only the few profiles being deleted are in it
+    with op.get_context().autocommit_block():
+        op.create_index('ix_profiles_deleting_since', 'profiles', ['deleting_since'], unique=False,
+                        postgresql_where=sa.text('deleting_since IS NOT NULL'), postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_profiles_deleting_since', table_name='profiles', postgresql_concurrently=True)
+    op.drop_column('profiles', 'deleting_since')
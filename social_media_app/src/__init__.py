@@ -5,7 +5,24 @@ from .api.profiles import bp_profiles  # Import the profiles blueprint from the
 from .api.posts import bp_posts  # Import the posts blueprint from the api module
 from .api.images import bp_images  # Import the images blueprint from the api module
 from .api.comments import bp_comments  # Import the comments blueprint from the api module
+from .api.search import bp_search  # Import the search blueprint from the api module
+from .api.events import bp_events  # Import the Server-Sent Events blueprint from the api module
+from .api.batch import bp_batch  # Import the batch blueprint from the api module
+from .api.debug import bp_debug  # Import the debug blueprint from the api module
 from .models import db  # Import the database instance from the models module
+from .cache import entity_cache  # Import the read-through cache used by the show() endpoints
+from .counters import like_buffer  # Import the buffered like counter used by the posts blueprint
+from .schema import check_indexes_command  # Import the `flask check-indexes` command
+from .pool import configure_pool, pool_config, env_flag  # Import the connection pool settings
+from .instrumentation import instrumentation  # Import the opt-in request metrics (/metrics)
+from .search import search_index  # Import the full-text search backends used by /search
+from .trending import trending  # Import the trending rankings used by /posts/trending
+from .purge import purge_jobs, purge_profile_command  # Import the set-based deletes of large profiles
+from .aggregates import repair_counters_command  # Import the `flask repair-counters` command
+from .compression import compression  # Import the gzip/brotli response compression
+from .events import change_feed  # Import the change feed behind the /events streams
+from .idempotency import idempotency  # Import the Idempotency-Key store used by the create endpoints
+from .partitions import partitions, create_partitions_command, archive_partitions_command  # Import the monthly partitions of posts and comments
 from dotenv import load_dotenv  # Import the load_dotenv function from the dotenv module
 
 
@@ -16,11 +33,16 @@ load_dotenv()
 
 def create_app(test_config=None):  # Define the application factory function
     app = Flask(__name__, instance_relative_config=True)  # Create an instance of the Flask application
+    development = os.getenv('FLASK_ENV', 'production') == 'development'  # docker-compose/gunicorn run with FLASK_ENV=production
     app.config.from_mapping(  # Set default configuration
         SECRET_KEY=os.getenv('SECRET_KEY'),  # Set the secret key for the application (Example: 'key_name')
         SQLALCHEMY_DATABASE_URI=os.getenv('DATABASE_URL'),  # Set the database URI (Example: 'postgresql://postgres@pg:5432/social_media_app_db')
         SQLALCHEMY_TRACK_MODIFICATIONS=False,  # Disable SQLAlchemy event system
-        SQLALCHEMY_ECHO=True  # Enable SQLAlchemy logging
+        # Log every SQL statement only in development (or with SQLALCHEMY_ECHO=true), never on the production request path
+        SQLALCHEMY_ECHO=os.getenv('SQLALCHEMY_ECHO', str(development)).lower() == 'true',
+        LOG_LEVEL=os.getenv('LOG_LEVEL', 'DEBUG' if development else 'INFO').upper(),  # Level of the app logger
+        DEBUG_ENDPOINTS=env_flag('DEBUG_ENDPOINTS', development),  # Expose /debug/* (pool stats)
+        **pool_config()  # DB_POOL_SIZE, DB_MAX_OVERFLOW, ... (see pool.py)
     )
 
     if test_config is None:  # Check if test_config is not provided
@@ -28,18 +50,42 @@ def create_app(test_config=None):  # Define the application factory function
     else:  # If test_config is provided
         app.config.from_mapping(test_config)  # Override the configuration with test_config
 
+    app.logger.setLevel(app.config['LOG_LEVEL'])  # Apply the configured log level
+
     try:
         os.makedirs(app.instance_path)  # Ensure the instance folder exists
     except OSError:
         pass  # Ignore the error if the folder already exists
 
+    configure_pool(app)  # Turn the DB_POOL_* settings into SQLALCHEMY_ENGINE_OPTIONS and check them against the workers
     db.init_app(app)  # Initialize the database with the Flask app
     migrate = Migrate(app, db)  # Initialize migration support with the Flask app and database
+    entity_cache.init_app(app)  # Initialize the read-through cache (CACHE_* settings)
+    like_buffer.init_app(app)  # Initialize the buffered like counter (LIKE_* settings)
+    instrumentation.init_app(app)  # Initialize request metrics when METRICS_ENABLED is on
+    search_index.init_app(app)  # Pick the search backend (tsvector on Postgres, in-process index otherwise)
+    trending.init_app(app)  # Initialize the trending rankings (TRENDING_* settings)
+    purge_jobs.init_app(app)  # Initialize background deletes of large profiles (PURGE_* settings)
+    idempotency.init_app(app)  # Initialize the Idempotency-Key store (IDEMPOTENCY_* settings)
+    change_feed.init_app(app)  # Pick the change feed backend (LISTEN/NOTIFY on Postgres, in-process otherwise)
+    partitions.init_app(app)  # Create future monthly partitions in the background on Postgres (PARTITION_* settings)
+    compression.init_app(app)  # Compress large JSON responses (COMPRESS_* settings), after metrics so sizes are on the wire
 
     # Register blueprints for different parts of the application
     app.register_blueprint(bp_profiles)  # Register the profiles blueprint
     app.register_blueprint(bp_posts)  # Register the posts blueprint
     app.register_blueprint(bp_images)  # Register the images blueprint
     app.register_blueprint(bp_comments)  # Register the comments blueprint
+    app.register_blueprint(bp_search)  # Register the search blueprint
+    app.register_blueprint(bp_events)  # Register the Server-Sent Events blueprint
+    app.register_blueprint(bp_batch)  # Register the batch blueprint (POST /batch)
+    if app.config['DEBUG_ENDPOINTS']:
+        app.register_blueprint(bp_debug)  # Register the debug blueprint (/debug/pool)
+
+    app.cli.add_command(check_indexes_command)  # Register `flask check-indexes`
+    app.cli.add_command(purge_profile_command)  # Register `flask purge-profile <id>` and `flask purge-profile --pending`
+    app.cli.add_command(repair_counters_command)  # Register `flask repair-counters`
+    app.cli.add_command(create_partitions_command)  # Register `flask create-partitions`
+    app.cli.add_command(archive_partitions_command)  # Register `flask archive-partitions --before YYYY-MM`
 
     return app  # Return the Flask app instance
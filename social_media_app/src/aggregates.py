@@ -0,0 +1,61 @@
+# Bulk maintenance of the counter columns (profiles.post_count / total_likes, posts.comment_count / image_count).
+# Single rows are counted by count_rows() in models.py; this module handles the set-based paths (the deletes in
+# purge.py and the like flush in counters.py) and the repair job that recomputes every counter from the tables.
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, update
+from .models import Comment, Image, Post, Profile, add_to_counters, db
+
+REPAIR_CHUNK_SIZE = 10000  # Rows of profiles or posts recomputed per transaction by the repair job
+
+
+def uncount_posts(condition):
+    """Take the posts matching condition off their authors' counters before a set-based delete (no commit)"""
+    # ( SELECT profile_id, count(*), coalesce(sum(likes), 0) FROM posts WHERE <condition> GROUP BY profile_id; )
+    rows = db.session.query(Post.profile_id, func.count(Post.id), func.coalesce(func.sum(Post.likes), 0)) \
+        .filter(condition).group_by(Post.profile_id).all()
+    add_to_counters(Profile.post_count, {profile_id: -count for profile_id, count, _ in rows})
+    add_to_counters(Profile.total_likes, {profile_id: -likes for profile_id, _, likes in rows})
+
+
+def add_post_likes(deltas: dict):
+    """Add {post_id: like delta} to the total_likes of the posts' authors (no commit)"""
+    totals = {}
+    for post_id, profile_id in db.session.query(Post.id, Post.profile_id).filter(Post.id.in_(deltas)):
+        totals[profile_id] = totals.get(profile_id, 0) + deltas[post_id]
+    add_to_counters(Profile.total_likes, totals)
+
+
+def _recompute(model, values: dict, chunk_size: int, log):
+    """Set every row's counters to values (correlated subqueries), chunk_size ids per transaction"""
+    table = model.__table__
+    last_id = db.session.query(func.max(model.id)).scalar() or 0
+    for start in range(0, last_id, chunk_size):
+        # ( UPDATE posts SET comment_count = (SELECT count(*) FROM comments WHERE post_id = posts.id), ...
+        #   WHERE id > :start AND id <= :end; the subqueries use the foreign key indexes )
+        db.session.execute(update(table).where(table.c.id > start, table.c.id <= start + chunk_size).values(values))
+        db.session.commit()
+        log('  %s %d-%d of %d' % (table.name, start + 1, min(start + chunk_size, last_id), last_id))
+
+
+def repair_counters(chunk_size: int = REPAIR_CHUNK_SIZE, log=print):
+    """Recompute every counter from the tables, e.g. after a COPY load or a manual DELETE.
+
+    Each chunk is correct as of its own transaction; a write racing a chunk can leave that one counter off, so run it
+    when writes are quiet (or twice)."""
+    _recompute(Profile, {
+        'post_count': select(func.count(Post.id)).where(Post.profile_id == Profile.id).scalar_subquery(),
+        'total_likes': select(func.coalesce(func.sum(Post.likes), 0)).where(Post.profile_id == Profile.id).scalar_subquery(),
+    }, chunk_size, log)
+    _recompute(Post, {
+        'comment_count': select(func.count(Comment.id)).where(Comment.post_id == Post.id).scalar_subquery(),
+        'image_count': select(func.count(Image.id)).where(Image.post_id == Post.id).scalar_subquery(),
+    }, chunk_size, log)
+
+
+@click.command('repair-counters')
+@click.option('--chunk-size', type=int, default=REPAIR_CHUNK_SIZE, help='Rows recomputed per transaction.')
+@with_appcontext
+def repair_counters_command(chunk_size):
+    """Recompute the post, like, comment and image counters of every profile and post."""
+    repair_counters(chunk_size, log=click.echo)
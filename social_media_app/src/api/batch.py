@@ -0,0 +1,208 @@
+# POST /batch: several creates, updates and deletes of posts, comments and images in one request and one transaction.
+# "A post with two images and a first comment" used to be four requests and four commits; as a batch it is one
+# round-trip, and if any operation fails nothing is written. The body is an ordered list of operations:
+#
+#   {"operations": [
+#       {"op": "create", "type": "post", "ref": "p", "data": {"content": "...", "post_date": "2024-05-01", "profile_id": 1}},
+#       {"op": "create", "type": "image", "data": {"url": "...", "image_date": "2024-05-01", "post_id": "$p"}},
+#       {"op": "update", "type": "comment", "id": 7, "data": {"content": "edited"}},
+#       {"op": "delete", "type": "image", "id": 9}
+#   ]}
+#
+# "$p" stands for the id of the row created by the operation with "ref": "p" earlier in the batch. The session is only
+# flushed when such an id is needed, so a batch without references is written by the single flush of the commit.
+# Profiles are not batchable, they are created and deleted through /profiles.
+from flask import Blueprint, abort, current_app, jsonify, request
+from sqlalchemy import exc
+from ..cache import entity_cache
+from ..events import change_feed
+from ..feed import fan_out_many
+from ..idempotency import idempotent
+from ..models import Comment, Image, Post, Profile, add_to_counters, count_rows, delete_comment_images, uncount_comment, db
+from ..purge import delete_posts
+from ..trending import record_comments
+from .bulk import parse_date, parse_id, parse_text, reference_errors
+from .comments import COMMENT_REFERENCES, validate_comment
+from .images import IMAGE_REFERENCES, check_comment_posts, validate_image
+from .posts import POST_REFERENCES, validate_post
+
+bp_batch = Blueprint('batch', __name__, url_prefix='/batch')
+
+MAX_OPERATIONS = 100  # Largest batch accepted by one request
+
+
+def parse_count(value, field: str):
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValueError("%s must be a non-negative integer." % field)
+    return value
+
+
+# type -> (model, validate() of the create body, columns an update may set with their parsers)
+BATCHABLE = {
+    'post': (Post, validate_post, {'content': parse_text, 'post_date': parse_date, 'likes': parse_count}),
+    'comment': (Comment, validate_comment, {'content': parse_text, 'comment_date': parse_date}),
+    'image': (Image, validate_image, {'url': parse_text, 'image_date': parse_date}),
+}
+
+# type -> (references, check) of a create, the same checks as the single and bulk creates make
+CREATE_CHECKS = {
+    'post': (POST_REFERENCES, None),
+    'comment': (COMMENT_REFERENCES, None),
+    'image': (IMAGE_REFERENCES, check_comment_posts),
+}
+
+
+class Batch:
+    """The state of one batch while its operations run: named rows and what to do once they are flushed"""
+
+    def __init__(self):
+        self.refs = {}  # ref -> created object
+        self.results = []  # (operation, type, object), or for deletes (operation, type, (id, post_id))
+        self.created = {kind: [] for kind in BATCHABLE}
+        self.deleted = set()  # (type, id) of every row a delete operation removed
+        self.response = []  # one result per operation, built by finish()
+
+    def resolve(self, value, field: str):
+        """The id in value, where "$ref" is the id of a row created earlier in the batch"""
+        if isinstance(value, str) and value.startswith('$'):
+            obj = self.refs.get(value[1:])
+            if obj is None:
+                raise ValueError("%s refers to %s, which no earlier operation created." % (field, value))
+            if obj.id is None:
+                db.session.flush()  # the id is needed now (the INSERT ... RETURNING id of everything pending)
+            if (obj.__class__.__name__.lower(), obj.id) in self.deleted:
+                raise ValueError("%s refers to %s, which an earlier operation deleted." % (field, value))
+            return obj.id
+        return value
+
+    def load(self, model, kind: str, operation: dict):
+        id = parse_id(self.resolve(operation.get('id'), 'id'), 'id')
+        obj = model.query.get(id)
+        if obj is None:
+            raise ValueError("%s %d does not exist." % (kind, id))
+        return obj
+
+    def run(self, operation: dict):
+        if not isinstance(operation, dict):
+            raise ValueError("Operation must be a JSON object.")
+        action, kind = operation.get('op'), operation.get('type')
+        if kind not in BATCHABLE:
+            raise ValueError("type must be one of %s." % ', '.join(BATCHABLE))
+        model, validate, updatable = BATCHABLE[kind]
+        data = operation.get('data', {})
+        if not isinstance(data, dict):
+            raise ValueError("data must be a JSON object.")
+        data = {field: self.resolve(value, field) for field, value in data.items()}
+
+        if action == 'create':
+            row = validate(data)
+            # "$ref" ids were resolved above, so rows created earlier in the batch are flushed and found here
+            references, check = CREATE_CHECKS[kind]
+            errors = reference_errors([(None, row)], references) + (check([(None, row)]) if check is not None else [])
+            if errors:
+                raise ValueError(errors[0][1])
+            obj = model(**row)
+            db.session.add(obj)
+            ref = operation.get('ref')
+            if ref is not None:
+                if not isinstance(ref, str) or ref in self.refs:
+                    raise ValueError("ref must be a string that no earlier operation used.")
+                self.refs[ref] = obj
+            self.created[kind].append(obj)
+            self.results.append(('create', kind, obj))
+        elif action == 'update':
+            obj = self.load(model, kind, operation)
+            unknown = set(data) - set(updatable)
+            if unknown or not data:
+                raise ValueError("data must set one or more of %s." % ', '.join(updatable))
+            for field, value in data.items():
+                value = updatable[field](value, field)
+                if field == 'post_date':
+                    obj.move_timeline_entries(value)  # as Post.update() does
+                # A row created by this batch is counted with its final likes by finish()
+                if field == 'likes' and obj not in self.created[kind]:
+                    add_to_counters(Profile.total_likes, {obj.profile_id: value - (obj.likes or 0)})
+                setattr(obj, field, value)
+            obj.version = model.version + 1  # like update(), bumped in SQL
+            self.results.append(('update', kind, obj))
+        elif action == 'delete':
+            obj = self.load(model, kind, operation)
+            id, post_id = obj.id, obj.id if kind == 'post' else obj.post_id
+            if kind == 'post':
+                db.session.expunge(obj)
+                delete_posts(Post.id == id)  # set-based, with its comments and images (see purge.py)
+            else:
+                if kind == 'comment':
+                    uncount_comment(obj)
+                    delete_comment_images(obj)
+                else:
+                    count_rows(Image, [obj], -1)
+                db.session.delete(obj)
+            self.deleted.add((kind, id))
+            self.results.append(('delete', kind, (id, post_id)))
+        else:
+            raise ValueError("op must be create, update or delete.")
+
+    def surviving(self, kind: str):
+        """The rows of kind created by the batch that no later operation deleted, directly or with their post"""
+        return [obj for obj in self.created[kind] if (kind, obj.id) not in self.deleted
+                and (kind == 'post' or ('post', obj.post_id) not in self.deleted)]
+
+    def finish(self):
+        """Flush, run the side effects of the creates and build the response, without committing"""
+        db.session.flush()
+        for kind, (model, _, _) in BATCHABLE.items():
+            # Every created row, deleted or not: a delete in the batch already took its row back off the counters
+            count_rows(model, self.created[kind])  # the parents' counters
+        fan_out_many(self.surviving('post'))  # timelines, as POST /posts does
+        record_comments(self.surviving('comment'))  # trending scores, as POST /comments does
+        results, messages = [], []
+        for action, kind, target in self.results:
+            if action == 'delete':
+                id, post_id = target
+                results.append({'op': action, 'type': kind, 'id': id})
+                messages.append({'type': kind, 'action': 'deleted', 'id': id, 'post_id': post_id})
+            else:
+                # serialize() before the commit expires the objects, so reading them costs no extra SELECT
+                results.append({'op': action, 'type': kind, 'id': target.id, kind: target.serialize()})
+                post_id = target.id if kind == 'post' else target.post_id
+                messages.append({'type': kind, 'action': action + 'd', 'id': target.id, 'post_id': post_id})
+        change_feed.publish_many(db.session, messages)
+        self.response = results
+
+    def invalidate(self):
+        """Drop the cached show() payloads of every row the committed batch touched"""
+        for kind, (model, _, _) in BATCHABLE.items():
+            entity_cache.invalidate_many(model, [r['id'] for r in self.response if r['type'] == kind])
+
+
+# POST /batch
+@bp_batch.route('', methods=['POST'])
+@idempotent
+def run_batch():
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return abort(400, description="Body must be an object with a non-empty operations array.")
+    max_operations = current_app.config.get('BATCH_MAX_OPERATIONS', MAX_OPERATIONS)
+    if len(operations) > max_operations:
+        return abort(400, description="At most %d operations can be run per batch." % max_operations)
+
+    batch = Batch()
+    index = None
+    try:
+        for index, operation in enumerate(operations):
+            batch.run(operation)
+        index = None  # failures from here on belong to the whole batch
+        batch.finish()
+        db.session.commit()  # one transaction for every operation
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'errors': [{'index': index, 'error': str(e)}]}), 400
+    except exc.IntegrityError as e:
+        # a constraint that run() does not check itself (it checks every parent exists); nothing of the batch was written
+        db.session.rollback()
+        return jsonify({'errors': [{'index': index, 'error': "The batch violates a constraint: %s" % e.orig}]}), 400
+
+    batch.invalidate()
+    return jsonify({'results': batch.response})
@@ -0,0 +1,144 @@
+# Bulk create shared by the /bulk endpoints of the posts, comments and images blueprints.
+# The whole JSON array is validated first (including one query per referenced table to check foreign keys), then all
+# rows go in with a single multi-row INSERT ... RETURNING in one transaction instead of one commit per row.
+# The single-row creates and POST /batch validate with the same functions. The references are checked here rather than
+# by the database: on Postgres nothing has a foreign key to the partitioned posts and comments (migration 0009). Like a
+# foreign key, the check takes FOR KEY SHARE locks on the parents until the commit, and the deletes lock the rows they
+# delete first (lock_for_delete()), so a parent cannot disappear between the check and the insert. A profile that is
+# being deleted in chunks (profiles.deleting_since, see purge.py) gets no new posts, and its posts no new comments or
+# images, which the chunks already past them would miss.
+from datetime import datetime
+from flask import abort, current_app, jsonify, request
+from sqlalchemy import insert, null
+from ..models import Post, Profile, count_rows, db
+from ..events import change_feed
+
+MAX_BULK_ITEMS = 1000  # Largest array accepted by one bulk request
+MAX_TEXT_LENGTH = 128  # Length of the String(128) content and url columns
+
+
+def parse_date(value, field: str):
+    """Parse an ISO 8601 date or date-time string, raising ValueError with a message the client can act on"""
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError("%s must be an ISO 8601 date (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)." % field)
+
+
+def parse_id(value, field: str, required: bool = True):
+    """Check an id field is an integer (or missing/None when it is optional)"""
+    if value is None and not required:
+        return None
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError("%s must be an integer." % field)
+    return value
+
+
+def parse_text(value, field: str, max_length: int = MAX_TEXT_LENGTH):
+    """Check a text field is a non-empty string that fits its column"""
+    if not isinstance(value, str) or not value:
+        raise ValueError("%s must be a non-empty string." % field)
+    if len(value) > max_length:
+        raise ValueError("%s must be at most %d characters." % (field, max_length))
+    return value
+
+
+def require(item: dict, *fields):
+    """Raise ValueError naming the required fields missing from item"""
+    missing = [f for f in fields if item.get(f) in (None, '')]
+    if missing:
+        raise ValueError("Missing required field(s): %s." % ', '.join(missing))
+
+
+def reference_errors(rows, references):
+    """(index, error) for every row whose id in one of the (column, Model) pairs does not exist (or belongs to a profile
+    that is being deleted), for [(index, row)]"""
+    errors = []
+    for column, model in references:  # one query per referenced table instead of one per row
+        wanted = {row[column] for index, row in rows if row[column] is not None}
+        if model is Profile:
+            query = db.session.query(Profile.id, Profile.deleting_since)
+        elif model is Post:
+            query = db.session.query(Post.id, Profile.deleting_since).join(Profile, Post.profile_id == Profile.id)
+        else:
+            query = db.session.query(model.id, null())  # a comment's post is checked through the post_id next to it
+        query = query.filter(model.id.in_(wanted)).with_for_update(read=True, key_share=True)
+        found = dict(query) if wanted else {}  # id -> deleting_since of the profile it belongs to
+        for index, row in rows:
+            id = row[column]
+            if id is not None and id not in found:
+                errors.append((index, "%s %d does not exist." % (column, id)))
+            elif id is not None and found[id] is not None:
+                errors.append((index, "%s %d is being deleted." % (column, id)))
+    return errors
+
+
+def validate_one(validate, references=(), check=None):
+    """Validate the JSON object in the request like one item of bulk_create() and return its row, or abort with 400"""
+    item = request.get_json(silent=True)
+    try:
+        if not isinstance(item, dict):
+            raise ValueError("Body must be a JSON object.")
+        row = validate(item)
+    except ValueError as e:
+        return abort(400, description=str(e))
+    errors = reference_errors([(None, row)], references) + (check([(None, row)]) if check is not None else [])
+    if errors:
+        return abort(400, description=errors[0][1])
+    return row
+
+
+def insert_rows(model, rows: list):
+    """Insert rows (dicts of column values) in one statement and return the created rows, without committing"""
+    table = model.__table__
+    if db.engine.dialect.full_returning:
+        # Postgres: INSERT INTO ... VALUES (...), (...), ... RETURNING * (one round-trip for the whole batch)
+        return db.session.execute(insert(table).values(rows).returning(*table.c)).all()
+    # Databases without multi-row RETURNING (SQLite in the tests) fall back to an ORM flush in the same transaction
+    objects = [model(**row) for row in rows]
+    db.session.add_all(objects)
+    db.session.flush()
+    return objects
+
+
+def bulk_create(model, validate, references=(), check=None, after_insert=None):
+    """Validate the JSON array in the request with validate(item) -> row, insert it all and return the response.
+
+    references lists (column, Model) pairs whose ids must exist. check(rows) returns the (index, error) pairs of
+    checks across rows and tables, for [(index, row)]. after_insert(created) runs in the same transaction.
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        return abort(400, description="Body must be a non-empty JSON array.")
+    max_items = current_app.config.get('BULK_MAX_ITEMS', MAX_BULK_ITEMS)
+    if len(items) > max_items:
+        return abort(400, description="At most %d items can be created per request." % max_items)
+
+    # Validate every item up front and report every problem, not just the first one
+    rows, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("Item must be a JSON object.")
+            rows.append((index, validate(item)))
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+
+    # Check foreign keys (one query per referenced table instead of one per item) and the checks across rows
+    found = reference_errors(rows, references) + (check(rows) if check is not None else [])
+    errors.extend({'index': index, 'error': error} for index, error in found)
+
+    if errors:
+        return jsonify({'errors': sorted(errors, key=lambda e: e['index'])}), 400
+
+    created = insert_rows(model, [row for index, row in rows])
+    # serialize() only reads attributes, so it works on RETURNING rows as well as model objects
+    result = [model.serialize(r) for r in created]
+    count_rows(model, created)  # the parents' counters, one UPDATE per parent
+    if after_insert is not None:
+        after_insert(created)
+    # One change feed event per row; a post is its own topic, comments and images belong to their post's
+    change_feed.publish_many(db.session, [{'type': model.__name__.lower(), 'action': 'created', 'id': r.id,
+                                           'post_id': getattr(r, 'post_id', r.id)} for r in created])
+    db.session.commit()  # one transaction for the whole array
+    return jsonify({'results': result})
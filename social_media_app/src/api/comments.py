@@ -1,6 +1,15 @@
 # Brent McFarlane 05/25/2024 
 from flask import Blueprint, jsonify, abort, request
 from ..models import Profile, Post, Image, Comment, db 
+from ..encoders import encoder_for, fast_jsonify
+from ..trending import record_comments
+from ..idempotency import idempotent
+from .pagination import paginate
+from .streaming import wants_stream, stream_rows
+from .conditional import check_page, page_etag, show_entity
+from .multiget import wants_ids, get_many
+from .fields import parse_fields
+from .bulk import bulk_create, parse_date, parse_id, parse_text, reference_errors, require, validate_one
 
 
 bp_comments = Blueprint('comments', __name__, url_prefix='/comments')
@@ -10,37 +19,68 @@ bp_comments = Blueprint('comments', __name__, url_prefix='/comments')
 # C: CREATE A RECORD
 # The POST method is used to send data to the server to create a new user. 
 @bp_comments.route('', methods=['POST'])
+@idempotent  # retries with the same Idempotency-Key get the first response back
 def create_comment():
-    if 'content' not in request.json or 'comment_date' not in request.json or 'post_id' not in request.json:
-        return abort(400, description="Content, comment date, and post ID cannot be empty.")
-
-    # Construct Comment object
-    c = Comment(
-        content=request.json['content'],
-        comment_date=request.json['comment_date'],
-        post_id=request.json['post_id']
-    )
+    # Validated like one item of create_bulk(), including that the post exists (400 otherwise)
+    c = Comment(**validate_one(validate_comment, COMMENT_REFERENCES))
 
-    # The insert() method creates and adds the user to the database.
+    # The insert() method creates and adds the user to the database, and counts the comment towards its post's
+    # trending score in the same transaction (see trending.py)
     c.insert()
 
     return jsonify(c.serialize())
 
+# Create many comments in one request. The body is a JSON array of objects shaped like the body of create_comment().
+def validate_comment(item: dict):
+    require(item, 'content', 'comment_date', 'post_id')
+    return {
+        'content': parse_text(item['content'], 'content'),
+        'comment_date': parse_date(item['comment_date'], 'comment_date'),
+        'post_id': parse_id(item['post_id'], 'post_id')
+    }
+
+COMMENT_REFERENCES = [('post_id', Post)]  # checked by every create, the database has no foreign key to posts
+
+@bp_comments.route('/bulk', methods=['POST'])
+@idempotent
+def create_bulk():
+    return bulk_create(Comment, validate_comment, references=COMMENT_REFERENCES, after_insert=record_comments)
+
 # # R: READ A RECORD
 # # Read all comments
 @bp_comments.route('', methods=['GET']) 
 def index():
-    comments = Comment.query.all()  # ORM performs SELECT query ( comparable to SELECT * FROM coments; )
+    fields = parse_fields(Comment)  # ?fields=id,... narrows the columns read and the keys returned
+
+    # ?ids=1,2,3 returns exactly those records (cache first, then one query for the rest)
+    if wants_ids():
+        return get_many(Comment, fields)
+
+    # Full export: ?stream=1 or Accept: application/x-ndjson streams every row instead of one page
+    if wants_stream():
+        return stream_rows(Comment, Comment.comment_date, fields)
+
+    # Keyset pagination over plain column tuples instead of ORM objects
+    # ( comparable to SELECT <serialized columns> FROM comments WHERE (comment_date, id) < (:date, :id) ORDER BY comment_date DESC, id DESC LIMIT :limit; )
+    # Conditional GET: a cheap (id, version) read of the page answers a matching If-None-Match with a 304
+    response = check_page(Comment, Comment.comment_date, fields)
+    if response is not None:
+        return response
+
+    encoder = encoder_for(Comment, fields)
+    comments, next_cursor = paginate(encoder.query(Comment.version), Comment, Comment.comment_date)  # version last, for the ETag
     result = []
     for c in comments:
-        result.append(c.serialize())  # build list of profiles as dictionaries
-    return jsonify(result)  # return JSON response
+        result.append(encoder.encode(c))  # build list of profiles as dictionaries straight from the row tuples
+    response = fast_jsonify({'results': result, 'next': next_cursor})  # the JSON of jsonify(), encoded faster
+    response.set_etag(page_etag(Comment, comments, next_cursor, fields))
+    return response
 
 @bp_comments.route('/<int:id>', methods=['GET'])
 # Read a specific comment
 def show(id: int):
-    c = Comment.query.get_or_404(id)
-    return jsonify(c.serialize())  # return JSON response
+    # Read-through cache with an ETag: only a cache miss runs the SELECT (or raises 404), a matching If-None-Match gets a 304
+    return show_entity(Comment, id, parse_fields(Comment))
 
 # # U: UPDATE A RECORD
 # # The PUT and PATCH methods are used to update a user in the database. The code needs to be able to handle a username only, a password only, and both
@@ -70,7 +110,13 @@ def update(id:int):
 
     # Post ID validation and update
     if 'post_id' in request.json:
-        post_id = request.json['post_id']
+        try:
+            post_id = parse_id(request.json['post_id'], 'post_id')
+        except ValueError as e:
+            return abort(400, description=str(e))
+        errors = reference_errors([(None, {'post_id': post_id})], COMMENT_REFERENCES)  # moving it to a missing post
+        if errors:
+            return abort(400, description=errors[0][1])
         c.post_id = post_id
 
     
@@ -0,0 +1,85 @@
+# Conditional GET (ETag / If-None-Match) for the show() and index() endpoints.
+# ETags come from the version column that update() bumps, never from hashing the response body, so a client polling
+# with If-None-Match gets a 304 without the payload being loaded or serialized:
+# - show(): the tag is "<table>-<id>-<version>", read from the entity cache or from a one-column SELECT.
+# - index(): the tag fingerprints the (id, version) pairs of the requested page, read with a narrow query over the same
+#   (date, id) index the page itself uses. A page changes when a row on it is updated, added or deleted.
+import hashlib
+from flask import Response, abort, jsonify, request
+from ..cache import entity_cache
+from ..encoders import encoder_for, fast_jsonify
+from ..models import db
+from ..compression import ENCODING_SUFFIXES
+from .fields import fields_tag, narrow
+from .pagination import paginate
+
+
+def entity_etag(model, id: int, version: int):
+    return '%s-%s-%s' % (model.__tablename__, id, version)
+
+
+def page_etag(model, rows, next_cursor, fields=None):
+    """ETag of a page of rows whose first column is the id and last column the version"""
+    digest = hashlib.sha1(fields_tag(fields).encode('ascii'))
+    for row in rows:
+        digest.update(b'%d:%d,' % (row[0], row[-1]))
+    digest.update((next_cursor or '').encode('ascii'))
+    return '%s-%s' % (model.__tablename__, digest.hexdigest()[:20])
+
+
+def matching_etag(etag: str):
+    """The variant of etag in If-None-Match, or None if the client holds none of them"""
+    # If-None-Match uses the weak comparison (RFC 7232), so W/"x" matches "x". The compressed variants of a response
+    # carry the same tag plus the encoding (see compression.py), a client holding one of those is up to date as well.
+    if_none_match = request.if_none_match
+    for suffix in ('',) + ENCODING_SUFFIXES:
+        if if_none_match.contains_weak(etag + suffix):
+            return etag + suffix
+    return None
+
+
+def not_modified(etag: str):
+    """304 carrying the tag the client matched, so a cache keeps the variant (plain, gzip or br) it already has"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def show_entity(model, id: int, fields=None, counts: bool = False):
+    """show() response for (model, id) with an ETag, or a 304 if the client's copy is current"""
+    if counts:
+        # ?include=counts: the counters change without a version bump, so they are read fresh, without cache or ETag
+        encoder = encoder_for(model, fields, counts=True)
+        row = encoder.query().filter(model.id == id).first()
+        if row is None:
+            return abort(404)
+        return fast_jsonify(encoder.encode(row))
+    entry = entity_cache.get_entry(model, id)
+    if entry is None and request.if_none_match:
+        # Cache miss on a conditional request: read just the version before loading and serializing the row
+        version = db.session.query(model.version).filter(model.id == id).scalar()
+        if version is None:
+            return abort(404)
+        matched = matching_etag(entity_etag(model, id, version) + fields_tag(fields))
+        if matched:
+            return not_modified(matched)
+    if entry is None:
+        entry = entity_cache.get_or_load_entry(model, id)
+
+    etag = entity_etag(model, id, entry['version']) + fields_tag(fields)
+    matched = matching_etag(etag)
+    if matched:
+        return not_modified(matched)
+    response = jsonify(narrow(entry['payload'], fields))
+    response.set_etag(etag)
+    return response
+
+
+def check_page(model, date_column, fields=None):
+    """A 304 response if the client's copy of the requested index() page is current, otherwise None"""
+    if not request.if_none_match:
+        return None
+    # ( comparable to SELECT id, version FROM <table> WHERE (date, id) < (:date, :id) ORDER BY date DESC, id DESC LIMIT :limit; )
+    rows, next_cursor = paginate(db.session.query(model.id, model.version), model, date_column)
+    matched = matching_etag(page_etag(model, rows, next_cursor, fields))
+    return not_modified(matched) if matched else None
@@ -0,0 +1,11 @@
+# Operational endpoints for sizing and troubleshooting. Only registered when DEBUG_ENDPOINTS is on (see create_app).
+from flask import Blueprint, jsonify
+from ..models import db
+from ..pool import pool_stats
+
+bp_debug = Blueprint('debug', __name__, url_prefix='/debug')
+
+# Connection pool of the worker that served the request: checked out, overflow, checkout wait times
+@bp_debug.route('/pool', methods=['GET'])
+def pool():
+    return jsonify(pool_stats(db.engine))
@@ -0,0 +1,58 @@
+# Server-Sent Events streams of the change feed (see events.py): GET /events for everything, GET /posts/<id>/events
+# (in posts.py) for one post and its comments and images. Each event names what changed, e.g.
+#
+#   event: comment.created
+#   data: {"type": "comment", "action": "created", "id": 7, "post_id": 3}
+#
+# and the client fetches the rows it needs by id (GET /comments?ids=7). A stream ends after EVENTS_STREAM_TIMEOUT
+# seconds, or with a "stream.reset" event when the client fell behind; EventSource reconnects on its own either way.
+# Every open stream holds a request thread: run gunicorn with GUNICORN_WORKER_CLASS=gevent for many subscribers.
+import time
+from flask import Blueprint, Response, abort, current_app
+from ..encoders import dumps
+from ..events import RESET, change_feed
+
+bp_events = Blueprint('events', __name__, url_prefix='/events')
+
+EVENT_STREAM_MIMETYPE = 'text/event-stream'
+RETRY_MILLISECONDS = 3000  # How long EventSource waits before reconnecting
+
+
+def format_event(message: dict, app=None):
+    return b'event: %s.%s\ndata: %s\n\n' % (message['type'].encode('ascii'), message['action'].encode('ascii'),
+                                            dumps(message, app))
+
+
+def event_stream(topic=None):
+    """SSE response for the events of post topic (or of everything), 503 if this worker has too many streams open"""
+    subscription = change_feed.subscribe(topic)
+    if subscription is None:
+        return abort(503, description="Too many open event streams, try again later.")
+    heartbeat = current_app.config['EVENTS_HEARTBEAT']
+    deadline = time.monotonic() + current_app.config['EVENTS_STREAM_TIMEOUT']
+    app = current_app._get_current_object()  # the generator runs after the request's context is gone
+
+    # Reads only the subscription's queue, never the database, so the stream does not hold a pooled connection (and
+    # needs no stream_with_context(), which would keep the request's session and its connection until the stream ends)
+    def generate():
+        yield b'retry: %d\n\n' % RETRY_MILLISECONDS  # sent straight away so the client and proxies see the stream open
+        while time.monotonic() < deadline:
+            message = subscription.get(timeout=min(heartbeat, max(deadline - time.monotonic(), 0)))
+            if message is None:
+                yield b': keep-alive\n\n'  # a comment line; writing it is also how a closed connection is noticed
+                continue
+            yield format_event(message, app)
+            if message is RESET:
+                break
+
+    response = Response(generate(), mimetype=EVENT_STREAM_MIMETYPE)
+    response.call_on_close(subscription.close)  # unsubscribe when the client goes away, even if nothing was sent
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx: pass events through instead of buffering the response
+    return response
+
+
+# GET /events
+@bp_events.route('', methods=['GET'])
+def index():
+    return event_stream()
@@ -0,0 +1,39 @@
+# Sparse fieldsets: ?fields=id,content,likes narrows a response to those keys.
+# List endpoints also narrow the SELECT column list (see RowEncoder), single records are narrowed from the cached payload.
+# ?include=counts adds the counter columns of profiles and posts under 'counts'.
+from flask import abort, request
+from ..encoders import COUNTER_FIELDS, field_names
+
+
+def parse_fields(model):
+    """The ?fields= names as a tuple in serialize() order, or None for every field. Aborts with 400 on unknown names."""
+    if 'fields' not in request.args:
+        return None
+    requested = {f.strip() for f in request.args['fields'].split(',') if f.strip()}
+    names = field_names(model)
+    unknown = requested - set(names)
+    if unknown or not requested:
+        return abort(400, description="Fields must be one or more of %s." % ', '.join(names))
+    return tuple(name for name in names if name in requested)
+
+
+def narrow(payload: dict, fields):
+    """payload with only the keys in fields (all of them if fields is None)"""
+    if fields is None:
+        return payload
+    return {key: value for key, value in payload.items() if key in fields}
+
+
+def fields_tag(fields):
+    """Suffix that keeps the ETags of different fieldsets of the same data apart"""
+    return '' if fields is None else '-f' + '.'.join(fields)
+
+
+def wants_counts(model):
+    """True for ?include=counts. Aborts with 400 on anything else, or when model has no counters."""
+    if 'include' not in request.args:
+        return False
+    included = {i.strip() for i in request.args['include'].split(',') if i.strip()}
+    if included != {'counts'} or model not in COUNTER_FIELDS:
+        return abort(400, description="Include can only be counts, on profiles and posts.")
+    return True
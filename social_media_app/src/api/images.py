@@ -1,6 +1,14 @@
 # Brent McFarlane 05/25/2024  (added comments for my own understanding)
 from flask import Blueprint, jsonify, abort, request
-from ..models import Image, db 
+from ..models import Image, Post, Comment, db 
+from ..encoders import encoder_for, fast_jsonify
+from ..idempotency import idempotent
+from .pagination import paginate
+from .streaming import wants_stream, stream_rows
+from .conditional import check_page, page_etag, show_entity
+from .multiget import wants_ids, get_many
+from .fields import parse_fields
+from .bulk import bulk_create, parse_date, parse_id, parse_text, require, validate_one
 
 
 bp_images = Blueprint('images', __name__, url_prefix='/images')
@@ -10,37 +18,74 @@ bp_images = Blueprint('images', __name__, url_prefix='/images')
 # C: CREATE A RECORD
 # The POST method is used to send data to the server to create a new images. 
 @bp_images.route('', methods=['POST'])
+@idempotent  # retries with the same Idempotency-Key get the first response back
 def create():
-    if 'url' not in request.json or 'image_date' not in request.json or "post_id" not in request.json or "comment_id" not in request.json:
-        return abort(400)
-
-    # construct Image
-    i = Image(
-        url=request.json['url'],
-        image_date=request.json['image_date'],
-        post_id=request.json['post_id'],
-        comment_id=request.json['comment_id']
-    )
+    # Validated like one item of create_bulk(), including that the post and the comment exist (400 otherwise)
+    i = Image(**validate_one(validate_image, IMAGE_REFERENCES, check_comment_posts))
     # The insert() method creates and adds the user to the database.
     i.insert()
 
     return jsonify(i.serialize())
 
+# Create many images in one request. The body is a JSON array of objects shaped like the body of create().
+def validate_image(item: dict):
+    require(item, 'url', 'image_date', 'post_id')
+    return {
+        'url': parse_text(item['url'], 'url'),
+        'image_date': parse_date(item['image_date'], 'image_date'),
+        'post_id': parse_id(item['post_id'], 'post_id'),
+        'comment_id': parse_id(item.get('comment_id'), 'comment_id', required=False)
+    }
+
+IMAGE_REFERENCES = [('post_id', Post), ('comment_id', Comment)]  # checked by every create, see bulk.py
+
+def check_comment_posts(rows):
+    """(index, error) for every image whose comment is on another post than the image, for [(index, row)]"""
+    wanted = {row['comment_id'] for index, row in rows if row['comment_id'] is not None}
+    posts = dict(db.session.query(Comment.id, Comment.post_id).filter(Comment.id.in_(wanted))) if wanted else {}
+    return [(index, "comment_id %d is a comment on another post than post_id %d." % (row['comment_id'], row['post_id']))
+            for index, row in rows if posts.get(row['comment_id'], row['post_id']) != row['post_id']]
+
+@bp_images.route('/bulk', methods=['POST'])
+@idempotent
+def create_bulk():
+    return bulk_create(Image, validate_image, references=IMAGE_REFERENCES, check=check_comment_posts)
+
 # # R: READ A RECORD
 # # Read all images
 @bp_images.route('', methods=['GET']) 
 def index():
-    images = Image.query.all()  # ORM performs SELECT query ( comparable to SELECT * FROM profiimagesles; )
+    fields = parse_fields(Image)  # ?fields=id,... narrows the columns read and the keys returned
+
+    # ?ids=1,2,3 returns exactly those records (cache first, then one query for the rest)
+    if wants_ids():
+        return get_many(Image, fields)
+
+    # Full export: ?stream=1 or Accept: application/x-ndjson streams every row instead of one page
+    if wants_stream():
+        return stream_rows(Image, Image.image_date, fields)
+
+    # Keyset pagination over plain column tuples instead of ORM objects
+    # ( comparable to SELECT <serialized columns> FROM images WHERE (image_date, id) < (:date, :id) ORDER BY image_date DESC, id DESC LIMIT :limit; )
+    # Conditional GET: a cheap (id, version) read of the page answers a matching If-None-Match with a 304
+    response = check_page(Image, Image.image_date, fields)
+    if response is not None:
+        return response
+
+    encoder = encoder_for(Image, fields)
+    images, next_cursor = paginate(encoder.query(Image.version), Image, Image.image_date)  # version last, for the ETag
     result = []
     for i in images:
-        result.append(i.serialize())  # build list of images as dictionaries
-    return jsonify(result)  # return JSON response
+        result.append(encoder.encode(i))  # build list of images as dictionaries straight from the row tuples
+    response = fast_jsonify({'results': result, 'next': next_cursor})  # the JSON of jsonify(), encoded faster
+    response.set_etag(page_etag(Image, images, next_cursor, fields))
+    return response
 
 # Read a specific image
 @bp_images.route('/<int:id>', methods=['GET'])
 def show(id: int):
-    i = Image.query.get_or_404(id)
-    return jsonify(i.serialize())  # return JSON response
+    # Read-through cache with an ETag: only a cache miss runs the SELECT (or raises 404), a matching If-None-Match gets a 304
+    return show_entity(Image, id, parse_fields(Image))
 
 # # U: UPDATE A RECORD
 # # The PUT and PATCH methods are used to update a images in the database. The code needs to be able to handle a username only, a password only, and both
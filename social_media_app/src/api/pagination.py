@@ -0,0 +1,61 @@
+# Keyset (cursor) pagination shared by the index() endpoints of every blueprint.
+# Instead of OFFSET (which gets slower the deeper you page) each page starts right after the (date, id) of the last row
+# of the previous page, so every page is one index range scan no matter how large the table is.
+import base64
+import json
+from datetime import datetime
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 50  # Page size used when the client does not send ?limit=
+MAX_PAGE_SIZE = 500  # Hard server-side cap, a client can never ask for more rows than this in one page
+
+
+def encode_cursor(date: datetime, id: int):
+    """Turn the (date, id) of the last row of a page into an opaque cursor string"""
+    raw = json.dumps([date.isoformat(), id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    """Turn a cursor string back into (date, id), aborting with 400 if it was tampered with"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        date_str, id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(date_str), int(id)
+    except (ValueError, TypeError):
+        return abort(400, description="The 'after' cursor is not valid.")
+
+
+def page_size(arg: str = 'limit'):
+    """Read ?limit= (or another query argument) from the request and clamp it to the server-side maximum"""
+    default = current_app.config.get('PAGE_SIZE_DEFAULT', DEFAULT_PAGE_SIZE)
+    maximum = current_app.config.get('PAGE_SIZE_MAX', MAX_PAGE_SIZE)
+    try:
+        limit = int(request.args.get(arg, default))
+    except ValueError:
+        return abort(400, description="Limit must be a whole number.")
+    if limit < 1:
+        return abort(400, description="Limit must be at least 1.")
+    return min(limit, maximum)
+
+
+def paginate(query, model, date_column, limit_arg: str = 'limit', after_arg: str = 'after'):
+    """Return (rows, next_cursor) for one page of query, newest first by (date, id)"""
+    limit = page_size(limit_arg)
+    query = query.order_by(date_column.desc(), model.id.desc())
+
+    # ?after= is the cursor handed out with the previous page
+    after = request.args.get(after_arg)
+    if after:
+        date, id = decode_cursor(after)
+        query = query.filter(tuple_(date_column, model.id) < (date, id))
+
+    # Fetch one extra row so we know whether there is a next page without running a COUNT(*)
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, date_column.key), last.id)
+    return rows, next_cursor
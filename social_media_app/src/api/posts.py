@@ -1,7 +1,21 @@
 # Brent McFarlane 05/25/2024  (added comments for my own understanding)
-from flask import Blueprint, jsonify, abort, request
-from ..models import Post, db 
+from flask import Blueprint, jsonify, abort, request, current_app
+from ..models import Post, Profile, Comment, db 
+from ..cache import entity_cache
+from ..counters import like_buffer
+from ..feed import fan_out_many
+from ..encoders import encoder_for, fast_jsonify
+from ..trending import trending
+from ..idempotency import idempotent
+from .pagination import paginate, page_size
+from .streaming import wants_stream, stream_rows
+from .conditional import check_page, page_etag, show_entity
+from .multiget import wants_ids, get_many
+from .fields import parse_fields, wants_counts
+from .bulk import bulk_create, parse_date, parse_id, parse_text, require, validate_one
+from .events import event_stream
 from datetime import datetime
+from sqlalchemy.orm import joinedload, selectinload
 
 # This will output the URL prefix for the blueprint as /posts. If the URL for the database is http://localhost:3000 then the URL for this endpoint 
 # would be http://localhost:3000/posts
@@ -13,37 +27,175 @@ bp_posts = Blueprint('posts', __name__, url_prefix='/posts')
 # C: CREATE A RECORD
 # The POST method is used to send data to the server to create a new user. 
 @bp_posts.route('', methods=['POST'])
+@idempotent  # retries with the same Idempotency-Key get the first response back
 def create():
-    if 'content' not in request.json or 'post_date' not in request.json or 'profile_id' not in request.json:
-        return abort(400, description="Content, post date, and profile ID cannot be empty.")
-
-    # construct Post
-    p = Post(
-        content=request.json['content'],
-        post_date=request.json['post_date'],
-        likes=request.json.get('likes', 0),
-        profile_id=request.json['profile_id']
-    )
-    # The insert() method creates and adds the user to the database.
+    # Validated like one item of create_bulk(), including that the profile exists (400 otherwise)
+    p = Post(**validate_one(validate_post, POST_REFERENCES))
+    # The insert() method creates and adds the user to the database, and copies the post into the author's and the
+    # followers' timelines in the same transaction (see feed.py)
     p.insert()
 
     return jsonify(p.serialize())
 
+# Create many posts in one request. The body is a JSON array of objects shaped like the body of create().
+def validate_post(item: dict):
+    require(item, 'content', 'post_date', 'profile_id')
+    likes = item.get('likes', 0)
+    if not isinstance(likes, int) or likes < 0:
+        raise ValueError("likes must be a non-negative integer.")
+    return {
+        'content': parse_text(item['content'], 'content'),
+        'post_date': parse_date(item['post_date'], 'post_date'),
+        'likes': likes,
+        'profile_id': parse_id(item['profile_id'], 'profile_id')
+    }
+
+POST_REFERENCES = [('profile_id', Profile)]
+
+@bp_posts.route('/bulk', methods=['POST'])
+@idempotent
+def create_bulk():
+    # fan_out_many copies the new posts into the timelines in the same transaction as the insert
+    return bulk_create(Post, validate_post, references=POST_REFERENCES, after_insert=fan_out_many)
+
 # R: READ A RECORD
 # Read all posts
 @bp_posts.route('', methods=['GET']) 
 def index():
-    posts = Post.query.all()  # ORM performs SELECT query ( comparable to SELECT * FROM posts; )
+    fields = parse_fields(Post)  # ?fields=id,... narrows the columns read and the keys returned
+    counts = wants_counts(Post)  # ?include=counts adds the counter columns
+
+    # ?ids=1,2,3 returns exactly those records (cache first, then one query for the rest)
+    if wants_ids():
+        return get_many(Post, fields, counts)
+
+    # Full export: ?stream=1 or Accept: application/x-ndjson streams every row instead of one page
+    if wants_stream():
+        return stream_rows(Post, Post.post_date, fields, counts)
+
+    # Keyset pagination over plain column tuples instead of ORM objects
+    # ( comparable to SELECT <serialized columns> FROM posts WHERE (post_date, id) < (:date, :id) ORDER BY post_date DESC, id DESC LIMIT :limit; )
+    # Conditional GET: a cheap (id, version) read of the page answers a matching If-None-Match with a 304
+    # (not with ?include=counts: the counters change without a version bump, those pages are always sent in full)
+    response = check_page(Post, Post.post_date, fields) if not counts else None
+    if response is not None:
+        return response
+
+    encoder = encoder_for(Post, fields, counts)
+    posts, next_cursor = paginate(encoder.query(Post.version), Post, Post.post_date)  # version last, for the ETag
     result = []
     for p in posts:
-        result.append(p.serialize())  # build list of posts as dictionaries
-    return jsonify(result)  # return JSON response
+        result.append(encoder.encode(p))  # build list of posts as dictionaries straight from the row tuples
+    response = fast_jsonify({'results': result, 'next': next_cursor})  # the JSON of jsonify(), encoded faster
+    if not counts:
+        response.set_etag(page_etag(Post, posts, next_cursor, fields))
+    return response
+
+# TRENDING
+# Top posts of the last ?hours= (default 24) by decayed likes and comments. The ranking comes from the hourly buckets in
+# trending.py and is cached in memory, so a request costs one query for the payloads of the page.
+@bp_posts.route('/trending', methods=['GET'])
+def trending_posts():
+    try:
+        hours = int(request.args.get('hours', 24))
+    except ValueError:
+        return abort(400, description="Hours must be a whole number.")
+    max_hours = current_app.config['TRENDING_MAX_HOURS']
+    if hours < 1 or hours > max_hours:
+        return abort(400, description="Hours must be between 1 and %d." % max_hours)
+    limit = min(page_size(), current_app.config['TRENDING_MAX_RESULTS'])
+
+    ranking = trending.top(hours, limit)
+    encoder = encoder_for(Post)
+    ids = [post_id for post_id, _ in ranking]
+    payloads = {row[0]: encoder.encode(row) for row in encoder.query().filter(Post.id.in_(ids))} if ids else {}
+    result = []
+    for post_id, score in ranking:
+        if post_id in payloads:  # skip a post deleted since the ranking was computed
+            result.append(dict(payloads[post_id], score=score))
+    return fast_jsonify({'results': result, 'hours': hours})
+
+# Server-Sent Events for a post: its updates and deletion, and the comments and images created, changed or deleted on it.
+# Replaces polling GET /comments for new comments (see events.py).
+@bp_posts.route('/<int:id>/events', methods=['GET'])
+def post_events(id):
+    if db.session.query(Post.id).filter(Post.id == id).first() is None:
+        return abort(404)
+    return event_stream(id)
 
 # Read a specific post
 @bp_posts.route('/<int:id>', methods=['GET'])
 def show(id: int):
-    p = Post.query.get_or_404(id)
-    return jsonify(p.serialize())  # return JSON response
+    # ?exact=1 first writes the likes of this post that this worker has buffered, so the count includes every like this
+    # worker took. Each gunicorn worker has its own buffer: likes taken by the other workers show up within their next
+    # flush (LIKE_FLUSH_INTERVAL seconds), the count is only exact with a single worker.
+    if request.args.get('exact', '').lower() in ('1', 'true', 'yes'):
+        like_buffer.flush([id])
+
+    # ?expand=author,comments,images returns the post together with its related rows
+    if 'expand' in request.args:
+        return jsonify(post_detail(id, parse_expand()))
+    # Read-through cache with an ETag: only a cache miss runs the SELECT (or raises 404), a matching If-None-Match gets a 304
+    return show_entity(Post, id, parse_fields(Post), wants_counts(Post))
+
+# POST DETAIL
+# Everything a client needs to render a post and its thread in one call. Each relation is loaded with one extra query
+# (joinedload for the author, selectinload for the lists) so the number of queries never grows with the thread size:
+# 1 for the post (+ author), 1 for its images, 1 for a page of comments and 1 for the images of those comments.
+EXPANDABLE = ('author', 'comments', 'images')
+
+def parse_expand():
+    expand = {e.strip() for e in request.args.get('expand', '').split(',') if e.strip()}
+    unknown = expand - set(EXPANDABLE)
+    if unknown:
+        return abort(400, description="Cannot expand %s. Choose from %s." % (', '.join(sorted(unknown)), ', '.join(EXPANDABLE)))
+    return expand
+
+def post_detail(id: int, expand: set):
+    query = Post.query
+    if 'author' in expand:
+        query = query.options(joinedload(Post.author))  # same SELECT as the post, joined
+    if 'images' in expand:
+        query = query.options(selectinload(Post.images))  # SELECT ... FROM images WHERE post_id IN (:id)
+    p = query.filter(Post.id == id).first_or_404()
+
+    result = p.serialize()
+    if 'author' in expand:
+        result['author'] = p.author.serialize()
+    if 'images' in expand:
+        result['images'] = [i.serialize() for i in p.images]
+    if 'comments' in expand:
+        # Comments are paged like index() with ?comments_limit= and ?comments_after=
+        comments_query = Comment.query.filter(Comment.post_id == id)
+        if 'images' in expand:
+            comments_query = comments_query.options(selectinload(Comment.images))
+        comments, next_cursor = paginate(comments_query, Comment, Comment.comment_date,
+                                         limit_arg='comments_limit', after_arg='comments_after')
+        serialized = []
+        for c in comments:
+            comment = c.serialize()
+            if 'images' in expand:
+                comment['images'] = [i.serialize() for i in c.images]
+            serialized.append(comment)
+        result['comments'] = {'results': serialized, 'next': next_cursor}
+    return result
+
+# LIKES
+# Likes go through the buffered counter in counters.py instead of PUT/PATCH, so concurrent likes are never lost and
+# do not each need a round-trip to Postgres. The response shows the stored count plus this worker's pending likes.
+def change_likes(id: int, delta: int):
+    payload = dict(entity_cache.get_or_load(Post, id))  # 404 if the post does not exist
+    like_buffer.add(id, delta)
+    payload['likes'] = (payload['likes'] or 0) + like_buffer.pending(id)
+    return jsonify(payload)
+
+@bp_posts.route('/<int:id>/like', methods=['POST'])
+def like(id: int):
+    return change_likes(id, 1)
+
+@bp_posts.route('/<int:id>/unlike', methods=['POST'])
+def unlike(id: int):
+    return change_likes(id, -1)
 
 # U: UPDATE A RECORD
 # The PUT and PATCH methods are used to update a post in the database. 
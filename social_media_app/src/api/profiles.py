@@ -3,7 +3,16 @@
 # Import the Blueprint, jsonify, abort, and request classes from the flask module.
 from flask import Blueprint, jsonify, abort, request
 # Import the Profile, Post, Image, Comment, and db classes from the models module.
-from ..models import Profile, db 
+from ..models import Profile, Follow, db 
+from ..feed import follow_profile, unfollow_profile, read_feed
+from ..purge import purge_jobs
+from ..encoders import encoder_for, fast_jsonify
+from ..idempotency import idempotent
+from .pagination import paginate, page_size, decode_cursor, encode_cursor
+from .streaming import wants_stream, stream_rows
+from .conditional import check_page, page_etag, show_entity
+from .multiget import wants_ids, get_many
+from .fields import parse_fields, wants_counts
 import hashlib
 import secrets
 from datetime import datetime
@@ -23,6 +32,7 @@ bp_profiles = Blueprint('profiles', __name__, url_prefix='/profiles')
 # C: CREATE A RECORD
 # The POST method is used to send data to the server to create a new user. 
 @bp_profiles.route('', methods=['POST'])
+@idempotent  # retries with the same Idempotency-Key get the first response back
 def create():
     # Check if the request contains the required fields
     username = request.json['username']
@@ -71,17 +81,40 @@ def create():
 # Read all record
 @bp_profiles.route('', methods=['GET']) 
 def index():
-    profiles = Profile.query.all()  # ORM performs SELECT query ( comparable to SELECT * FROM profiles; )
+    fields = parse_fields(Profile)  # ?fields=id,... narrows the columns read and the keys returned
+    counts = wants_counts(Profile)  # ?include=counts adds the counter columns
+
+    # ?ids=1,2,3 returns exactly those records (cache first, then one query for the rest)
+    if wants_ids():
+        return get_many(Profile, fields, counts)
+
+    # Full export: ?stream=1 or Accept: application/x-ndjson streams every row instead of one page
+    if wants_stream():
+        return stream_rows(Profile, Profile.start_date, fields, counts)
+
+    # Keyset pagination over plain column tuples instead of ORM objects
+    # ( comparable to SELECT <serialized columns> FROM profiles WHERE (start_date, id) < (:date, :id) ORDER BY start_date DESC, id DESC LIMIT :limit; )
+    # Conditional GET: a cheap (id, version) read of the page answers a matching If-None-Match with a 304
+    # (not with ?include=counts: the counters change without a version bump, those pages are always sent in full)
+    response = check_page(Profile, Profile.start_date, fields) if not counts else None
+    if response is not None:
+        return response
+
+    encoder = encoder_for(Profile, fields, counts)
+    profiles, next_cursor = paginate(encoder.query(Profile.version), Profile, Profile.start_date)  # version last, for the ETag
     result = []
     for p in profiles:
-        result.append(p.serialize())  # build list of profiles as dictionaries
-    return jsonify(result)  # return JSON response
+        result.append(encoder.encode(p))  # build list of profiles as dictionaries straight from the row tuples
+    response = fast_jsonify({'results': result, 'next': next_cursor})  # the JSON of jsonify(), encoded faster
+    if not counts:
+        response.set_etag(page_etag(Profile, profiles, next_cursor, fields))
+    return response
 
 # Read a specific record
 @bp_profiles.route('/<int:id>', methods=['GET'])
 def show(id: int):
-    p = Profile.query.get_or_404(id)
-    return jsonify(p.serialize())  # return JSON response
+    # Read-through cache with an ETag: only a cache miss runs the SELECT (or raises 404), a matching If-None-Match gets a 304
+    return show_entity(Profile, id, parse_fields(Profile), wants_counts(Profile))
 
 # U: UPDATE A RECORD
 # The PUT and PATCH methods are used to update a user in the database. The code needs to be able to handle a username only, a password only, and both
@@ -152,14 +185,59 @@ def update(id:int):
 
 @bp_profiles.route('/<int:id>', methods=['DELETE'])
 def delete(id: int):
-    p = Profile.query.get_or_404(id)
+    Profile.query.get_or_404(id)
+    try:
+        # Posts, comments, images, follows and timeline entries go too. Large accounts are deleted in the background.
+        if purge_jobs.delete_profile(id):
+            return jsonify(True)
+        return jsonify({'profile_id': id, 'status': 'deleting'}), 202
+    except:
+        # something went wrong :(
+        return jsonify(False)
+
+
+# FOLLOWS AND FEED
+
+# Follow another profile. The body is {"profile_id": <id of the profile to follow>}
+@bp_profiles.route('/<int:id>/following', methods=['POST'])
+def follow(id: int):
+    Profile.query.get_or_404(id)
+    if 'profile_id' not in request.json:
+        return abort(400, description="Profile ID to follow cannot be empty.")
+    followee_id = request.json['profile_id']
+    if followee_id == id:
+        return abort(400, description="A profile cannot follow itself.")
+    Profile.query.get_or_404(followee_id)
+
+    # Following twice is a no-op that returns the existing follow
+    f = Follow.query.get((id, followee_id))
+    if f is None:
+        f = follow_profile(id, followee_id)
+    return jsonify(f.serialize())
+
+# Stop following a profile
+@bp_profiles.route('/<int:id>/following/<int:followee_id>', methods=['DELETE'])
+def unfollow(id: int, followee_id: int):
+    f = Follow.query.get_or_404((id, followee_id))
     try:
-        p.delete()  # Delete and commit the deletion
+        unfollow_profile(f)  # Delete the follow and its timeline entries
         return jsonify(True)
     except:
         # something went wrong :(
         return jsonify(False)
 
+# Read the latest posts of the profile and everyone it follows, paged with ?limit= and ?after= like index()
+@bp_profiles.route('/<int:id>/feed', methods=['GET'])
+def feed(id: int):
+    Profile.query.get_or_404(id)
+    after = request.args.get('after')
+    posts, last = read_feed(id, page_size(), decode_cursor(after) if after else None)
+    result = []
+    for p in posts:
+        result.append(p.serialize())  # build list of posts as dictionaries
+    next_cursor = encode_cursor(*last) if last else None
+    return jsonify({'results': result, 'next': next_cursor})  # return the page plus the cursor for the next one
+
 
 # # I WANTED TO GET TO RELATIONSHIPS BUT COULDNT RUN CODE TO TEST
 # # @bp_profiles.route('/<int:id>/liked_tweets', methods=['GET'])
@@ -0,0 +1,68 @@
+# Full-text search across posts and comments (see search.py for the Postgres and in-process backends)
+import base64
+import json
+from flask import Blueprint, abort, current_app, request
+from ..encoders import encoder_for, fast_jsonify
+from ..search import MAX_RESULTS, SEARCHABLE, search_index
+from .pagination import page_size
+
+bp_search = Blueprint('search', __name__, url_prefix='/search')
+
+
+# Ranked results have no (date, id) order to seek on, so the cursor is an opaque offset capped at SEARCH_MAX_RESULTS
+def encode_offset(offset: int):
+    return base64.urlsafe_b64encode(json.dumps(['search', offset]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_offset(cursor: str):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        tag, offset = json.loads(base64.urlsafe_b64decode(padded))
+        if tag != 'search' or int(offset) < 0:
+            raise ValueError
+        return int(offset)
+    except (ValueError, TypeError):
+        return abort(400, description="The 'after' cursor is not valid.")
+
+def parse_types():
+    # ?type=post,comment (default: both)
+    types = [t.strip() for t in request.args.get('type', ','.join(SEARCHABLE)).split(',') if t.strip()]
+    unknown = set(types) - set(SEARCHABLE)
+    if unknown or not types:
+        return abort(400, description="Type must be one or more of %s." % ', '.join(SEARCHABLE))
+    return types
+
+# GET /search?q=...&type=post,comment&limit=&after=
+@bp_search.route('', methods=['GET'])
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return abort(400, description="The search needs a query (?q=).")
+    types = parse_types()
+    limit = page_size()
+    after = request.args.get('after')
+    offset = decode_offset(after) if after else 0
+    max_results = current_app.config.get('SEARCH_MAX_RESULTS', MAX_RESULTS)
+    limit = min(limit, max(max_results - offset, 0))
+
+    # One extra hit tells us whether there is a next page
+    hits = search_index.search(q, types, limit + 1, offset) if limit else []
+    next_cursor = None
+    if len(hits) > limit:
+        hits = hits[:limit]
+        next_cursor = encode_offset(offset + limit)
+
+    # One query per result type loads the payloads of the page ( SELECT <serialized columns> FROM posts WHERE id IN (...); )
+    payloads = {}
+    for kind in types:
+        ids = [id for k, id, _ in hits if k == kind]
+        if ids:
+            model, _ = SEARCHABLE[kind]
+            encoder = encoder_for(model)
+            for row in encoder.query().filter(model.id.in_(ids)):
+                payloads[(kind, row[0])] = encoder.encode(row)
+
+    result = []
+    for kind, id, rank in hits:
+        if (kind, id) in payloads:  # skip a row deleted since it was indexed
+            result.append({'type': kind, 'rank': rank, kind: payloads[(kind, id)]})
+    return fast_jsonify({'results': result, 'next': next_cursor})
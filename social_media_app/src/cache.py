@@ -0,0 +1,254 @@
+# Read-through cache for the serialized payloads returned by the show() endpoints, keyed by (table, id).
+# Each entry also keeps the row's version so show() can answer If-None-Match from the cache.
+# Two tiers: an in-process LRU with a short TTL in every worker, and an optional shared backend (Redis) that all workers
+# see. The insert()/update()/delete() methods in models.py invalidate both tiers after they commit.
+import json
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 5  # Seconds a payload lives in the in-process LRU (bounds staleness across workers)
+DEFAULT_SHARED_TTL = 300  # Seconds a payload lives in the shared backend
+DEFAULT_MAX_ENTRIES = 10000  # Payloads kept in the in-process LRU before the least recently used is evicted
+
+
+class CacheBackend:
+    """Interface for a cache backend. Values are JSON-compatible dictionaries."""
+
+    def get(self, key: str):
+        raise NotImplementedError
+
+    def set(self, key: str, value: dict, ttl: float):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """{key: value} for the keys that are cached"""
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set_many(self, values: dict, ttl: float):
+        for key, value in values.items():
+            self.set(key, value, ttl)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocalCache(CacheBackend):
+    """Thread-safe in-process LRU cache with a per-entry TTL, bounded by entries and optionally by the sizes given to
+    set()"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, value, size), oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value, size = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                return None
+            self._entries.move_to_end(key)  # mark as most recently used
+            return value
+
+    def set(self, key: str, value: dict, ttl: float, size: int = 0):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            self._bytes += size - (old[2] if old else 0)
+            self._entries[key] = (time.monotonic() + ttl, value, size)
+            while self._entries and (len(self._entries) > self.max_entries
+                                     or (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                self._bytes -= self._entries.popitem(last=False)[1][2]  # evict the least recently used entry
+
+    def delete(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache(CacheBackend):
+    """Shared cache backend stored in Redis (needs the optional redis package)"""
+
+    def __init__(self, url: str, prefix: str = 'entity:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_URL is set but the redis package is not installed (pip install redis).")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value: dict, ttl: float):
+        self.client.set(self.prefix + key, json.dumps(value), ex=int(ttl))
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        raws = self.client.mget([self.prefix + key for key in keys])  # one round-trip
+        return {key: json.loads(raw) for key, raw in zip(keys, raws) if raw is not None}
+
+    def set_many(self, values: dict, ttl: float):
+        pipeline = self.client.pipeline(transaction=False)  # one round-trip
+        for key, value in values.items():
+            pipeline.set(self.prefix + key, json.dumps(value), ex=int(ttl))
+        pipeline.execute()
+
+    def delete_many(self, keys, batch_size: int = 1000):
+        keys = [self.prefix + key for key in keys]
+        for start in range(0, len(keys), batch_size):
+            self.client.delete(*keys[start:start + batch_size])  # one round-trip per batch
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class EntityCache:
+    """serialize() payloads by model and id: a per-worker LRU in front of Redis when CACHE_URL is set"""
+
+    def __init__(self):
+        self.enabled = False
+        self.local = None
+        self.shared = None
+        self.ttl = DEFAULT_TTL
+        self.shared_ttl = DEFAULT_SHARED_TTL
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_ENABLED', True)
+        app.config.setdefault('CACHE_TTL', DEFAULT_TTL)
+        app.config.setdefault('CACHE_SHARED_TTL', DEFAULT_SHARED_TTL)
+        app.config.setdefault('CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+        app.config.setdefault('CACHE_URL', None)  # Example: 'redis://redis:6379/0'
+
+        self.enabled = app.config['CACHE_ENABLED']
+        self.ttl = app.config['CACHE_TTL']
+        self.shared_ttl = app.config['CACHE_SHARED_TTL']
+        self.local = LocalCache(app.config['CACHE_MAX_ENTRIES'])
+        self.shared = RedisCache(app.config['CACHE_URL']) if app.config['CACHE_URL'] else None
+        app.extensions['entity_cache'] = self
+
+    @staticmethod
+    def key(model, id: int):
+        return '%s:%s' % (model.__tablename__, id)
+
+    def get_entry(self, model, id: int):
+        """Return the cached {'version', 'payload'} entry or None, filling the local tier from the shared one"""
+        if not self.enabled:
+            return None
+        key = self.key(model, id)
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry, self.ttl)
+        return entry
+
+    def get(self, model, id: int):
+        """Return the cached payload or None"""
+        entry = self.get_entry(model, id)
+        return entry['payload'] if entry is not None else None
+
+    def set(self, model, id: int, payload: dict, version: int):
+        if not self.enabled:
+            return
+        key = self.key(model, id)
+        entry = {'version': version, 'payload': payload}  # the row version is kept for ETags (see api/conditional.py)
+        self.local.set(key, entry, self.ttl)
+        if self.shared is not None:
+            self.shared.set(key, entry, self.shared_ttl)
+
+    def get_or_load_entry(self, model, id: int):
+        """Return the {'version', 'payload'} entry for (model, id), reading the database (or 404) only on a miss"""
+        entry = self.get_entry(model, id)
+        if entry is None:
+            obj = model.query.get_or_404(id)
+            entry = {'version': obj.version, 'payload': obj.serialize()}
+            self.set(model, id, entry['payload'], entry['version'])
+        return entry
+
+    def get_many_entries(self, model, ids):
+        """{id: entry} for the ids that are cached, with one lookup in the shared tier for the local misses"""
+        if not self.enabled:
+            return {}
+        entries = {}
+        for id in ids:
+            entry = self.local.get(self.key(model, id))
+            if entry is not None:
+                entries[id] = entry
+        misses = [id for id in ids if id not in entries]
+        if misses and self.shared is not None:
+            found = self.shared.get_many([self.key(model, id) for id in misses])
+            for id in misses:
+                entry = found.get(self.key(model, id))
+                if entry is not None:
+                    entries[id] = entry
+                    self.local.set(self.key(model, id), entry, self.ttl)
+        return entries
+
+    def set_many(self, model, entries: dict):
+        """set() for {id: {'version', 'payload'}}"""
+        if not self.enabled or not entries:
+            return
+        values = {self.key(model, id): entry for id, entry in entries.items()}
+        self.local.set_many(values, self.ttl)
+        if self.shared is not None:
+            self.shared.set_many(values, self.shared_ttl)
+
+    def get_or_load(self, model, id: int):
+        """Return the payload for (model, id), reading the database (or 404) only on a cache miss"""
+        return self.get_or_load_entry(model, id)['payload']
+
+    def invalidate(self, model, id: int):
+        """Drop (model, id) from both tiers, called after a write commits"""
+        if self.local is None:
+            return  # init_app() has not run (e.g. models used from a script)
+        key = self.key(model, id)
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def invalidate_many(self, model, ids):
+        """invalidate() for many ids of one model, e.g. after a set-based delete"""
+        if self.local is None or not ids:
+            return
+        keys = [self.key(model, id) for id in ids]
+        self.local.delete_many(keys)
+        if self.shared is not None:
+            self.shared.delete_many(keys)
+
+
+entity_cache = EntityCache()
@@ -0,0 +1,141 @@
+# Write-coalescing like counter for posts.
+# Each like only bumps a number in memory. A background thread periodically turns the pending deltas into one batch of
+# "UPDATE posts SET likes = likes + :delta WHERE id = :id" statements, so a like storm on one viral post becomes a single
+# row update per flush instead of thousands of read-modify-write transactions fighting over the same row lock.
+# The buffer lives in each worker process, so posts.likes can be up to one flush interval behind the likes of every worker.
+import atexit
+import threading
+from sqlalchemy import bindparam, func, update
+from .cache import entity_cache
+from .models import Post, db
+from .trending import record_likes
+from .aggregates import add_post_likes
+
+DEFAULT_FLUSH_INTERVAL = 1.0  # Seconds between flushes, 0 turns the background thread off (flush() by hand)
+DEFAULT_SHARDS = 16  # Independent locks, so concurrent likes on different posts rarely wait for each other
+
+
+class LikeBuffer:
+    """Pending like deltas per post, sharded by id and written to posts.likes every LIKE_FLUSH_INTERVAL seconds"""
+
+    def __init__(self, shards: int = DEFAULT_SHARDS):
+        self._make_shards(shards)
+        self.app = None
+        self.interval = DEFAULT_FLUSH_INTERVAL
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._atexit_registered = False
+
+    def _make_shards(self, shards: int):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+
+    def init_app(self, app):
+        app.config.setdefault('LIKE_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+        app.config.setdefault('LIKE_BUFFER_SHARDS', DEFAULT_SHARDS)
+        self.app = app
+        self.interval = app.config['LIKE_FLUSH_INTERVAL']
+        self._make_shards(app.config['LIKE_BUFFER_SHARDS'])
+        app.extensions['like_buffer'] = self
+        if not self._atexit_registered:
+            atexit.register(self._flush_at_exit)  # do not lose buffered likes when a worker shuts down
+            self._atexit_registered = True
+
+    def _shard(self, post_id: int):
+        return self._shards[post_id % len(self._shards)]
+
+    def add(self, post_id: int, delta: int):
+        """Buffer a like (+1) or unlike (-1) for post_id"""
+        counts, lock = self._shard(post_id)
+        with lock:
+            counts[post_id] = counts.get(post_id, 0) + delta
+        self._ensure_thread()
+
+    def pending(self, post_id: int):
+        """Likes buffered for post_id that are not in the database yet"""
+        counts, lock = self._shard(post_id)
+        with lock:
+            return counts.get(post_id, 0)
+
+    def _drain(self, post_ids=None):
+        """Take the pending deltas (all of them, or only post_ids) out of the buffer"""
+        deltas = {}
+        for counts, lock in self._shards:
+            with lock:
+                if post_ids is None:
+                    deltas.update(counts)
+                    counts.clear()
+                else:
+                    for id in post_ids:
+                        if id in counts:
+                            deltas[id] = counts.pop(id)
+        return {id: delta for id, delta in deltas.items() if delta != 0}
+
+    def _restore(self, deltas: dict):
+        for id, delta in deltas.items():
+            counts, lock = self._shard(id)
+            with lock:
+                counts[id] = counts.get(id, 0) + delta
+
+    def flush(self, post_ids=None):
+        """Write the pending deltas to Postgres in one transaction, returns the number of posts updated"""
+        deltas = self._drain(post_ids)
+        if not deltas:
+            return 0
+
+        # likes = likes + delta keeps the update atomic in the database, no read of the row is needed
+        statement = update(Post.__table__) \
+            .where(Post.__table__.c.id == bindparam('b_id')) \
+            .values(likes=func.coalesce(Post.__table__.c.likes, 0) + bindparam('b_delta'),
+                    version=Post.__table__.c.version + 1)  # new like count, new ETag
+        # Sorted by id so two workers flushing at the same time lock rows in the same order (no deadlocks)
+        params = [{'b_id': id, 'b_delta': delta} for id, delta in sorted(deltas.items())]
+        try:
+            db.session.execute(statement, params)  # executemany: one batch of UPDATEs
+            record_likes(deltas)  # the same deltas feed /posts/trending, in the same transaction
+            add_post_likes(deltas)  # and the authors' total_likes
+            db.session.commit()
+        except:
+            db.session.rollback()
+            self._restore(deltas)  # put the likes back so the next flush retries them
+            raise
+
+        for id in deltas:
+            entity_cache.invalidate(Post, id)
+        return len(deltas)
+
+    def _ensure_thread(self):
+        # Started lazily on the first like so that every gunicorn worker gets its own thread after the fork
+        if self.interval <= 0 or self.app is None or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='like-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception("Flushing buffered likes failed, retrying on the next interval.")
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self._stop.set()
+
+    def _flush_at_exit(self):
+        self.stop()
+        if not any(counts for counts, lock in self._shards):
+            return
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Flushing buffered likes at exit failed.")
+
+
+like_buffer = LikeBuffer()
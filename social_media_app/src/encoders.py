@@ -0,0 +1,139 @@
+# Fast serialization path for read-only list responses.
+# Instead of hydrating a full ORM object per row and calling serialize() on it, the list endpoints select just the
+# columns serialize() uses and turn each result tuple into the same dictionary with an encoder compiled once per model.
+# The JSON text is produced by orjson when it is installed (falling back to the standard library), with the same key
+# order, separators and ASCII escaping as jsonify(). The list payloads (ids, counters, strings and dates) come out byte
+# for byte the same; floats may be written differently (orjson writes 1e16 where jsonify() writes 1e+16), with the
+# same value.
+import json
+import time
+from flask import Response, current_app
+from sqlalchemy import DateTime
+from .instrumentation import add_serialize_time
+from .models import Comment, Image, Post, Profile, db
+
+try:
+    import orjson  # optional, much faster JSON encoder
+except ImportError:
+    orjson = None
+
+# The keys each serialize() method returns, in order. Keys mapped to a value are constants, not columns.
+# tests/test_models.py checks these against serialize() so the two cannot drift apart.
+SERIALIZED_FIELDS = {
+    Profile: ('id', 'username', 'name', 'interests', 'birthday', 'start_date',
+              ('password', 'Not shown for security reasons.')),
+    Post: ('id', 'content', 'post_date', 'likes', 'profile_id'),
+    Image: ('id', 'url', 'image_date', 'post_id', 'comment_id'),
+    Comment: ('id', 'content', 'comment_date', 'post_id'),
+}
+
+
+# The counter columns serialize(counts=True) adds under 'counts' (?include=counts)
+COUNTER_FIELDS = {
+    Profile: ('post_count', 'total_likes'),
+    Post: ('comment_count', 'image_count'),
+}
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+# Columns every list query selects even when ?fields= leaves them out: the id and the date the pages are ordered by
+# (pagination.py builds the next cursor from them) and the ETag fingerprint reads the id from column 0.
+KEY_FIELDS = {
+    Profile: ('id', 'start_date'),
+    Post: ('id', 'post_date'),
+    Image: ('id', 'image_date'),
+    Comment: ('id', 'comment_date'),
+}
+
+
+class RowEncoder:
+    """Selects the columns serialize() needs and turns each result row into the serialize() dictionary"""
+
+    def __init__(self, model, fields, output=None, counts: bool = False):
+        """output limits the keys of the dictionary to a subset of fields (a sparse fieldset); key columns are still selected.
+        counts adds the counter columns like serialize(counts=True)."""
+        self.model = model
+        self.columns = []
+        parts = []
+        for field in fields:
+            name = field[0] if isinstance(field, tuple) else field
+            wanted = output is None or name in output
+            if isinstance(field, tuple):  # constant value, e.g. the masked password
+                if wanted:
+                    parts.append('%r: %r' % field)
+                continue
+            if not wanted and field not in KEY_FIELDS[model]:
+                continue  # ?fields= left it out, do not even select it
+            column = getattr(model, field)
+            index = len(self.columns)
+            self.columns.append(column)
+            if not wanted:
+                continue
+            if isinstance(column.type, DateTime):
+                parts.append('%r: _isoformat(row[%d])' % (field, index))
+            else:
+                parts.append('%r: row[%d]' % (field, index))
+        if counts:
+            counters = []
+            for field in COUNTER_FIELDS[model]:
+                counters.append('%r: row[%d]' % (field, len(self.columns)))
+                self.columns.append(getattr(model, field))
+            parts.append("'counts': {%s}" % ', '.join(counters))
+        # Generate one flat function per model (like dataclasses does) so encoding a row is a single dict literal
+        source = 'def encode(row):\n    return {%s}\n' % ', '.join(parts)
+        namespace = {'_isoformat': _isoformat}
+        exec(source, namespace)
+        self.encode = namespace['encode']
+
+    def query(self, *columns):
+        """A query returning plain tuples of the serialized columns (plus any extra columns, after them)"""
+        return db.session.query(*self.columns, *columns)
+
+
+ENCODERS = {model: RowEncoder(model, fields) for model, fields in SERIALIZED_FIELDS.items()}
+_SPARSE_ENCODERS = {}  # (model, fields, counts) -> RowEncoder, built on first use
+
+
+def field_names(model):
+    return [f[0] if isinstance(f, tuple) else f for f in SERIALIZED_FIELDS[model]]
+
+
+def encoder_for(model, fields=None, counts: bool = False):
+    """The encoder of model, or of a sparse fieldset of it (a tuple of field names from field_names()), with or
+    without the counters"""
+    if fields is None and not counts:
+        return ENCODERS[model]
+    key = (model, fields, counts)
+    encoder = _SPARSE_ENCODERS.get(key)
+    if encoder is None:
+        output = set(fields) if fields is not None else None
+        encoder = _SPARSE_ENCODERS[key] = RowEncoder(model, SERIALIZED_FIELDS[model], output=output, counts=counts)
+    return encoder
+
+
+def dumps(payload, app=None):
+    """Encode payload like jsonify() does (see the top of the file for floats), using orjson unless ASCII escaping would
+    differ. Pass app to encode outside of the application context (e.g. in a streaming generator)"""
+    app = app or current_app
+    config = app.config
+    pretty = config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug
+    sort_keys = config['JSON_SORT_KEYS']
+    ensure_ascii = config['JSON_AS_ASCII']
+    if orjson is not None and not pretty:
+        body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+        # orjson never escapes non-ASCII characters, so only use it when that makes no difference
+        if not ensure_ascii or body.isascii():
+            return body
+    return json.dumps(payload, indent=2 if pretty else None, separators=(', ', ': ') if pretty else (',', ':'),
+                      sort_keys=sort_keys, ensure_ascii=ensure_ascii).encode('utf-8')
+
+
+def fast_jsonify(payload):
+    """jsonify() replacement for payloads that only contain JSON types (no datetimes or models)"""
+    start = time.perf_counter()
+    body = dumps(payload) + b'\n'
+    add_serialize_time(time.perf_counter() - start)
+    return Response(body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,204 @@
+# Change feed for Server-Sent Events (GET /events and GET /posts/<id>/events, see api/events.py).
+# The insert()/update()/delete() methods in models.py (and the set-based deletes in purge.py) publish a small event
+# such as {"type": "comment", "action": "created", "id": 7, "post_id": 3} in the same transaction as the change, so
+# clients are told what changed instead of polling GET /comments, and fetch the rows they care about by id.
+#
+# Two backends:
+#   postgres  publish() runs SELECT pg_notify(...) inside the transaction, Postgres delivers it only if the transaction
+#             commits and to every worker; each worker LISTENs on one dedicated connection from a background thread.
+#   memory    publish() keeps the events on the session and hands them to this process's subscribers after the commit
+#             (tests, SQLite and single-process development servers).
+#
+# Every subscriber has a bounded queue. A subscriber that falls EVENTS_QUEUE_SIZE events behind is cut off with a
+# "reset" event instead of slowing down the publishers or growing without limit; the client refetches and reconnects.
+# Like counts (counters.py) are not published, they change too often to be worth a message each.
+import json
+import queue
+import select
+import threading
+import time
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from .pool import worker_model
+
+DEFAULT_QUEUE_SIZE = 256  # Events a subscriber may fall behind before it is cut off
+DEFAULT_HEARTBEAT = 15  # Seconds between keep-alive comments, so proxies keep the connection open and dead clients are noticed
+DEFAULT_STREAM_TIMEOUT = 300  # Seconds before a stream is closed and the client reconnects (lets workers recycle)
+DEFAULT_CHANNEL = 'social_media_events'  # Postgres NOTIFY channel
+RECONNECT_DELAY = 1.0  # Seconds the listener waits before reconnecting after losing its connection
+
+RESET = {'type': 'stream', 'action': 'reset'}  # Last event of a subscriber that fell too far behind
+
+
+class Subscription:
+    """One open event stream: the events for a post (topic = post id), or all events (topic = None)"""
+
+    def __init__(self, feed, topic, size: int):
+        self.feed = feed
+        self.topic = topic
+        self.queue = queue.Queue(size)
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def put(self, message: dict):
+        # Never blocks the publisher: a full queue means the client cannot keep up, so it gets a reset and is dropped
+        with self._lock:  # publishers in request threads and the listener thread may put at the same time
+            if self.closed:
+                return
+            try:
+                self.queue.put_nowait(message)
+            except queue.Full:
+                self.closed = True
+                while True:
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                self.queue.put_nowait(RESET)
+
+    def get(self, timeout: float):
+        """The next event, or None after timeout seconds without one"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.closed = True
+        self.feed.unsubscribe(self)
+
+
+class ChangeFeed:
+    """Committed model changes, delivered to the subscriptions of this worker through LISTEN/NOTIFY or in process"""
+
+    def __init__(self):
+        self.app = None
+        self.backend = 'memory'
+        self.channel = DEFAULT_CHANNEL
+        self.subscribers = {}  # topic (post id or None for everything) -> set of subscriptions
+        self._lock = threading.Lock()
+        self._listener = None
+        self._listening = False
+
+    def init_app(self, app):
+        app.config.setdefault('EVENTS_BACKEND', 'auto')  # 'postgres', 'memory' or 'auto' (postgres when the database is)
+        app.config.setdefault('EVENTS_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)
+        # Open streams per worker process, more are refused with a 503. Each stream holds a request thread (gthread) or
+        # greenlet (gevent), so by default streams may take half of a worker's concurrency and requests keep the rest.
+        app.config.setdefault('EVENTS_MAX_SUBSCRIBERS', max(1, worker_model()[1] // 2))
+        app.config.setdefault('EVENTS_HEARTBEAT', DEFAULT_HEARTBEAT)
+        app.config.setdefault('EVENTS_STREAM_TIMEOUT', DEFAULT_STREAM_TIMEOUT)
+        app.config.setdefault('EVENTS_CHANNEL', DEFAULT_CHANNEL)
+        backend = app.config['EVENTS_BACKEND']
+        if backend == 'auto':
+            uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+            backend = 'postgres' if uri.startswith('postgresql') else 'memory'
+        self.app = app
+        self.backend = backend
+        self.channel = app.config['EVENTS_CHANNEL']
+
+        if not self._listening:
+            # Session class events cover the scoped session Flask-SQLAlchemy creates
+            event.listen(Session, 'after_commit', _after_commit)
+            event.listen(Session, 'after_soft_rollback', _after_rollback)
+            self._listening = True
+        app.extensions['change_feed'] = self
+
+    # Publishing
+
+    def publish(self, session, type: str, action: str, id: int, post_id: int = None):
+        """Publish a change in session's transaction, it reaches the subscribers only if the transaction commits"""
+        self.publish_many(session, [{'type': type, 'action': action, 'id': id, 'post_id': post_id}])
+
+    def publish_many(self, session, messages):
+        if not messages:
+            return
+        if self.backend == 'postgres':
+            # ( SELECT pg_notify('social_media_events', '{"type": ...}'); queued by Postgres until COMMIT )
+            session.execute(text('SELECT pg_notify(:channel, :payload)'),
+                            [{'channel': self.channel, 'payload': json.dumps(m)} for m in messages])
+        else:
+            session.info.setdefault('events_pending', []).extend(messages)
+
+    def dispatch(self, message: dict):
+        """Hand a committed event to the subscribers of its post and to the subscribers of everything"""
+        with self._lock:
+            targets = list(self.subscribers.get(None, ()))
+            if message.get('post_id') is not None:
+                targets.extend(self.subscribers.get(message['post_id'], ()))
+        for subscription in targets:
+            subscription.put(message)
+
+    # Subscribing
+
+    def subscribe(self, topic=None):
+        """A new Subscription, or None if this worker already has EVENTS_MAX_SUBSCRIBERS open streams"""
+        config = self.app.config
+        with self._lock:
+            if sum(len(s) for s in self.subscribers.values()) >= config['EVENTS_MAX_SUBSCRIBERS']:
+                return None
+            subscription = Subscription(self, topic, config['EVENTS_QUEUE_SIZE'])
+            self.subscribers.setdefault(topic, set()).add(subscription)
+        if self.backend == 'postgres':
+            self._ensure_listener()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            topic_subscribers = self.subscribers.get(subscription.topic)
+            if topic_subscribers is not None:
+                topic_subscribers.discard(subscription)
+                if not topic_subscribers:
+                    del self.subscribers[subscription.topic]
+
+    # Postgres LISTEN, one connection and thread per worker process, started by the first subscriber
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='change-feed-listener', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        from .models import db  # imported here because models.py imports this module
+        while True:
+            connection = None
+            try:
+                with self.app.app_context():
+                    connection = db.engine.raw_connection()
+                # Take the connection out of the pool for good, it sits in LISTEN for the life of the worker
+                connection.detach()
+                dbapi_connection = connection.connection
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute('LISTEN "%s"' % self.channel.replace('"', ''))
+                while True:
+                    # Wait for a notification (or wake up now and then to notice a broken connection)
+                    if select.select([dbapi_connection], [], [], 60) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notification = dbapi_connection.notifies.pop(0)
+                        self.dispatch(json.loads(notification.payload))
+            except Exception:
+                self.app.logger.exception("The change feed lost its LISTEN connection, reconnecting.")
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                time.sleep(RECONNECT_DELAY)
+
+
+change_feed = ChangeFeed()
+
+
+def _after_commit(session):
+    pending = session.info.pop('events_pending', None)
+    if pending:
+        for message in pending:
+            change_feed.dispatch(message)
+
+
+def _after_rollback(session, previous_transaction):
+    session.info.pop('events_pending', None)
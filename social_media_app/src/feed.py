@@ -0,0 +1,105 @@
+# Home timeline (feed) for a profile: the latest posts of the profile itself and of every profile it follows.
+# Fan-out-on-write: when a post is created it is copied into the timeline_entries rows of the author and every follower,
+# so reading a feed is one index range scan on timeline_entries instead of filtering the whole posts table.
+# Fan-out-on-read: copying a post into millions of timelines is too expensive, so once a profile has more than
+# FEED_FANOUT_MAX_FOLLOWERS followers it is flagged and its posts are merged into followers' feeds at read time instead.
+from flask import current_app
+from sqlalchemy import delete, insert, literal, select, tuple_
+from .models import Follow, Post, Profile, TimelineEntry, db
+
+FANOUT_MAX_FOLLOWERS = 10000  # Above this many followers a profile's posts are pulled at read time instead
+BACKFILL_POSTS = 50  # Recent posts copied into a timeline when a new follow is created
+
+
+def _max_followers():
+    return current_app.config.get('FEED_FANOUT_MAX_FOLLOWERS', FANOUT_MAX_FOLLOWERS)
+
+
+def _fan_out(post, authors: dict):
+    """Queue the timeline inserts for one post in the current transaction (authors caches Profile lookups)"""
+    if post.profile_id not in authors:
+        authors[post.profile_id] = Profile.query.get(post.profile_id)
+    author = authors[post.profile_id]
+    if author is None:
+        return
+
+    # The author always sees their own post
+    db.session.execute(insert(TimelineEntry.__table__).values(
+        profile_id=post.profile_id, post_date=post.post_date, post_id=post.id))
+
+    if not author.fan_out_on_read:
+        # Count at most max+1 followers so this check stays cheap even for huge followings
+        limit = _max_followers()
+        followers = Follow.query.filter_by(followee_id=author.id).limit(limit + 1).count()
+        if followers > limit:
+            author.fan_out_on_read = True  # from now on this author's posts are merged at read time
+        else:
+            # One set-based INSERT ... SELECT instead of one INSERT per follower
+            rows = select(Follow.follower_id, literal(post.post_date, db.DateTime), literal(post.id, db.Integer)) \
+                .where(Follow.followee_id == post.profile_id)
+            db.session.execute(insert(TimelineEntry.__table__).from_select(['profile_id', 'post_date', 'post_id'], rows))
+
+
+def fan_out_many(posts):
+    """Copy new posts (or rows with the same columns) into the timelines of their authors and (if not too many) their
+    followers, without committing"""
+    authors = {}
+    for post in posts:
+        _fan_out(post, authors)
+
+
+def follow_profile(follower_id: int, followee_id: int):
+    """Create a follow and backfill the followee's recent posts into the follower's timeline"""
+    f = Follow(follower_id=follower_id, followee_id=followee_id)
+    db.session.add(f)
+
+    followee = Profile.query.get(followee_id)
+    if not followee.fan_out_on_read:
+        recent = select(literal(follower_id, db.Integer), Post.post_date, Post.id) \
+            .where(Post.profile_id == followee_id) \
+            .order_by(Post.post_date.desc(), Post.id.desc()) \
+            .limit(current_app.config.get('FEED_BACKFILL_POSTS', BACKFILL_POSTS))
+        db.session.execute(insert(TimelineEntry.__table__).from_select(['profile_id', 'post_date', 'post_id'], recent))
+
+    db.session.commit()
+    return f
+
+
+def unfollow_profile(f: Follow):
+    """Remove a follow and the followee's posts from the follower's timeline"""
+    followee_posts = select(Post.id).where(Post.profile_id == f.followee_id)
+    db.session.execute(delete(TimelineEntry.__table__).where(
+        TimelineEntry.profile_id == f.follower_id,
+        TimelineEntry.post_id.in_(followee_posts)
+    ))
+    db.session.delete(f)
+    db.session.commit()
+
+
+def read_feed(profile_id: int, limit: int, after=None):
+    """Return (posts, (post_date, id) of the last post or None) for one feed page, newest first"""
+    # Fan-out-on-write part: a range scan over this profile's timeline entries
+    written = db.session.query(Post) \
+        .join(TimelineEntry, TimelineEntry.post_id == Post.id) \
+        .filter(TimelineEntry.profile_id == profile_id)
+    if after:
+        written = written.filter(tuple_(TimelineEntry.post_date, TimelineEntry.post_id) < after)
+    written = written.order_by(TimelineEntry.post_date.desc(), TimelineEntry.post_id.desc()).limit(limit + 1)
+
+    # Fan-out-on-read part: recent posts of followed profiles that are flagged as too big to fan out
+    pulled = db.session.query(Post) \
+        .join(Follow, Follow.followee_id == Post.profile_id) \
+        .join(Profile, Profile.id == Follow.followee_id) \
+        .filter(Follow.follower_id == profile_id, Profile.fan_out_on_read.is_(True))
+    if after:
+        pulled = pulled.filter(tuple_(Post.post_date, Post.id) < after)
+    pulled = pulled.order_by(Post.post_date.desc(), Post.id.desc()).limit(limit + 1)
+
+    # Merge both (a post can be in both if its author crossed the threshold later) and keep the newest page
+    merged = {p.id: p for p in written.all() + pulled.all()}
+    posts = sorted(merged.values(), key=lambda p: (p.post_date, p.id), reverse=True)
+    last = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last = (posts[-1].post_date, posts[-1].id)
+    return posts, last
@@ -0,0 +1,200 @@
+# Idempotency-Key support for the create endpoints.
+# A mobile client that times out and retries a POST would insert the same post or comment again. Clients send an
+# Idempotency-Key header (any unique string, e.g. a UUID, per logical request); the first response to a key is kept for
+# IDEMPOTENCY_TTL seconds and a retry with the same key gets that response back (with Idempotent-Replayed: true) without
+# running the view or touching the main tables.
+#
+# Keys are scoped to the method and path and bound to the request body: the same key with a different body is a 422,
+# and a retry that arrives while the first request is still running is a 409. Only 2xx responses are kept, so a request
+# that failed validation or hit a server error can be corrected and retried with the same key.
+#
+# Two tiers: an in-process LRU (LocalCache from cache.py) and, with IDEMPOTENCY_TABLE on (the default on Postgres), the
+# idempotency_keys table, which all workers share and which survives restarts. The table is the source of truth for
+# keys that are in progress; expired rows are swept every IDEMPOTENCY_SWEEP_INTERVAL seconds by the worker that next
+# reserves a key. An in-progress row is a lease of IDEMPOTENCY_LEASE seconds: if its worker was killed before storing
+# the response (a gunicorn timeout, a max_requests recycle, a deploy), the next retry after the lease takes the key over
+# instead of getting a 409 until the key expires. With the table the view runs in a SAVEPOINT, so its commit only
+# releases the savepoint and store() commits the create together with its stored response: a worker that dies between
+# the two leaves neither behind, and the retry runs the view again instead of creating a duplicate.
+# The LRU is bounded by IDEMPOTENCY_MAX_KEYS entries and IDEMPOTENCY_MAX_BYTES of response bodies.
+import datetime
+import hashlib
+import threading
+import time
+from functools import wraps
+from flask import Response, abort, current_app, make_response, request
+from sqlalchemy import delete, exc, insert, select, update
+from .cache import LocalCache
+from .models import IdempotencyKey, db
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+DEFAULT_TTL = 24 * 3600  # Seconds a stored response is replayed for (clients retry within minutes, not days)
+DEFAULT_MAX_KEYS = 10000  # Stored responses kept in the in-process LRU
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024  # Response bytes kept in the in-process LRU (bulk responses can be large)
+DEFAULT_SWEEP_INTERVAL = 300  # Seconds between deletes of expired rows from idempotency_keys
+DEFAULT_LEASE = 60  # Seconds a request holds its key while running, twice gunicorn's default worker timeout
+
+
+class IdempotencyStore:
+    """Responses of POSTs sent with an Idempotency-Key, in a per-worker LRU and the idempotency_keys table"""
+
+    def __init__(self):
+        self.local = LocalCache(DEFAULT_MAX_KEYS)
+        self.use_table = False
+        self.ttl = DEFAULT_TTL
+        self.lease = DEFAULT_LEASE
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    def init_app(self, app):
+        uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+        app.config.setdefault('IDEMPOTENCY_TTL', DEFAULT_TTL)
+        app.config.setdefault('IDEMPOTENCY_MAX_KEYS', DEFAULT_MAX_KEYS)
+        app.config.setdefault('IDEMPOTENCY_MAX_BYTES', DEFAULT_MAX_BYTES)
+        app.config.setdefault('IDEMPOTENCY_TABLE', uri.startswith('postgresql'))  # keep keys in idempotency_keys
+        app.config.setdefault('IDEMPOTENCY_SWEEP_INTERVAL', DEFAULT_SWEEP_INTERVAL)
+        app.config.setdefault('IDEMPOTENCY_LEASE', DEFAULT_LEASE)  # keep above GUNICORN_TIMEOUT
+        self.local = LocalCache(app.config['IDEMPOTENCY_MAX_KEYS'], app.config['IDEMPOTENCY_MAX_BYTES'])
+        self.use_table = app.config['IDEMPOTENCY_TABLE']
+        self.ttl = app.config['IDEMPOTENCY_TTL']
+        self.lease = app.config['IDEMPOTENCY_LEASE']
+        app.extensions['idempotency'] = self
+
+    # Lookup: {'fingerprint', 'status_code', 'mimetype', 'body'}, status_code None while in progress
+
+    def lookup(self, key: str):
+        entry = self.local.get(key)
+        if entry is not None or not self.use_table:
+            return entry
+        # ( SELECT ... FROM idempotency_keys WHERE key = :key AND created_at >= :cutoff
+        #   AND (status_code IS NOT NULL OR created_at >= :lease_cutoff); on the primary key )
+        # An in-progress row whose lease ran out counts as absent, reserve() then takes it over
+        table = IdempotencyKey.__table__
+        row = db.session.execute(select(table.c.fingerprint, table.c.status_code, table.c.mimetype, table.c.body)
+                                 .where(table.c.key == key, table.c.created_at >= self._cutoff(),
+                                        table.c.status_code.isnot(None) | (table.c.created_at >= self._lease_cutoff()))).first()
+        if row is None:
+            return None
+        entry = {'fingerprint': row.fingerprint, 'status_code': row.status_code, 'mimetype': row.mimetype, 'body': row.body}
+        if entry['status_code'] is not None:
+            self.local.set(key, entry, self.ttl, len(entry['body']))  # finished responses never change, later retries skip the query
+        return entry
+
+    def reserve(self, key: str, fingerprint: str):
+        """Mark key as in progress. Returns the lease (its reservation time), or None if another request holds the key
+        (or finished with it) already."""
+        now = datetime.datetime.utcnow()
+        if not self.use_table:
+            with self._lock:  # check and set as one step, two threads of a worker may race on a retry
+                if self.local.get(key) is not None:
+                    return None
+                self.local.set(key, {'fingerprint': fingerprint, 'status_code': None}, self.ttl)
+                return now
+
+        table = IdempotencyKey.__table__
+        try:
+            self._sweep()
+            # An expired row, or an in-progress one whose lease ran out (its worker died), no longer counts: remove it
+            # so the insert does not collide with it
+            db.session.execute(delete(table).where(table.c.key == key, (table.c.created_at < self._cutoff()) | (
+                table.c.status_code.is_(None) & (table.c.created_at < self._lease_cutoff()))))
+            # The primary key decides between concurrent requests on every worker: only one insert succeeds
+            db.session.execute(insert(table).values(key=key, fingerprint=fingerprint, created_at=now))
+            db.session.commit()
+            return now
+        except exc.IntegrityError:
+            db.session.rollback()
+            return None
+
+    def store(self, key: str, fingerprint: str, lease, response):
+        entry = {'fingerprint': fingerprint, 'status_code': response.status_code, 'mimetype': response.mimetype,
+                 'body': response.get_data()}
+        if self.use_table:
+            # Only into our own reservation: after a takeover the row belongs to the retry that took it
+            table = IdempotencyKey.__table__
+            db.session.execute(update(table).where(table.c.key == key, table.c.created_at == lease).values(
+                status_code=entry['status_code'], mimetype=entry['mimetype'], body=entry['body']))
+            while db.session().in_nested_transaction():
+                db.session.commit()  # the savepoint of _run(), if the view did not release it
+            db.session.commit()  # the view's writes and the stored response together
+        self.local.set(key, entry, self.ttl, len(entry['body']))
+
+    def release(self, key: str, lease):
+        """Forget an in-progress key after the request failed, so the client can retry it"""
+        self.local.delete(key)
+        if self.use_table:
+            db.session.rollback()  # whatever the failed view left behind, committed to its savepoint or not
+            table = IdempotencyKey.__table__
+            db.session.execute(delete(table).where(table.c.key == key, table.c.created_at == lease,
+                                                   table.c.status_code.is_(None)))
+            db.session.commit()
+
+    def _cutoff(self):
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+
+    def _lease_cutoff(self):
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=self.lease)
+
+    def _sweep(self):
+        # Runs in the caller's transaction; ( DELETE FROM idempotency_keys WHERE created_at < :cutoff; on ix_..._created_at )
+        now = time.monotonic()
+        if now - self._last_sweep < current_app.config['IDEMPOTENCY_SWEEP_INTERVAL']:
+            return
+        self._last_sweep = now
+        table = IdempotencyKey.__table__
+        db.session.execute(delete(table).where(table.c.created_at < self._cutoff()))
+
+    # Request handling
+
+    def handle(self, client_key: str, view, args, kwargs):
+        if not client_key or len(client_key) > MAX_KEY_LENGTH:
+            return abort(400, description="%s must be 1 to %d characters." % (HEADER, MAX_KEY_LENGTH))
+        key = hashlib.sha256(('%s %s %s' % (request.method, request.path, client_key)).encode('utf-8')).hexdigest()
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        entry = self.lookup(key)
+        if entry is None:
+            lease = self.reserve(key, fingerprint)
+            if lease is not None:
+                return self._run(key, fingerprint, lease, view, args, kwargs)
+            entry = self.lookup(key)  # lost the race to a concurrent request with the same key
+            if entry is None:
+                return abort(409, description="A request with this %s is still in progress." % HEADER)
+
+        if entry['fingerprint'] != fingerprint:
+            return abort(422, description="This %s was already used with a different request body." % HEADER)
+        if entry['status_code'] is None:
+            return abort(409, description="A request with this %s is still in progress." % HEADER)
+        response = Response(entry['body'], status=entry['status_code'], mimetype=entry['mimetype'])
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def _run(self, key: str, fingerprint: str, lease, view, args, kwargs):
+        if self.use_table:
+            # The view's commit (the create views commit once) releases this savepoint instead of committing
+            db.session.begin_nested()
+        try:
+            response = make_response(view(*args, **kwargs))
+        except BaseException:  # abort() in the view, or a server error
+            self.release(key, lease)
+            raise
+        if 200 <= response.status_code < 300:
+            self.store(key, fingerprint, lease, response)
+        else:
+            self.release(key, lease)
+        return response
+
+
+idempotency = IdempotencyStore()
+
+
+def idempotent(view):
+    """Decorator for create endpoints: honour the Idempotency-Key header (requests without one run as before)"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(HEADER)
+        if client_key is None:
+            return view(*args, **kwargs)
+        return idempotency.handle(client_key, view, args, kwargs)
+    return wrapper
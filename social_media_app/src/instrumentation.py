@@ -0,0 +1,146 @@
+# Opt-in per-request instrumentation (METRICS_ENABLED=true).
+# SQLAlchemy engine events count the statements each request runs and the time spent in the database, a JSON encoder
+# subclass times serialization, and Flask request hooks put it together per endpoint. The histograms are served in
+# Prometheus text format on /metrics (per worker process), and a request that runs more than QUERY_BUDGET statements
+# logs a warning so N+1 query regressions show up in the logs.
+import os
+import threading
+import time
+from flask import Response, current_app, g, has_request_context, request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)  # statements per request
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)  # response bytes
+DEFAULT_QUERY_BUDGET = 20
+
+
+class Histogram:
+    """Prometheus-style histogram with one series per endpoint"""
+
+    def __init__(self, name: str, help: str, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # endpoint -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint: str, value: float):
+        with self._lock:
+            series = self._series.setdefault(endpoint, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for endpoint, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (self.name, endpoint, bound, count))
+                lines.append('%s_bucket{endpoint="%s",le="+Inf"} %d' % (self.name, endpoint, series[-1]))
+                lines.append('%s_sum{endpoint="%s"} %s' % (self.name, endpoint, round(series[-2], 6)))
+                lines.append('%s_count{endpoint="%s"} %d' % (self.name, endpoint, series[-1]))
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def add_serialize_time(seconds: float):
+    """Add time spent encoding JSON to the current request's metrics (no-op when metrics are off)"""
+    if has_request_context() and 'metrics_serialize_seconds' in g:
+        g.metrics_serialize_seconds += seconds
+
+
+class TimedJSONEncoder(JSONEncoder):
+    """The app's JSON encoder, also adding the time spent encoding to the current request's metrics"""
+
+    def encode(self, o):
+        start = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            add_serialize_time(time.perf_counter() - start)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_query_start = time.perf_counter()  # kept on the execution context, so a failed statement leaks nothing
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Only statements run while serving a request count (not the like flusher or CLI commands)
+    if context is not None and has_request_context() and 'metrics_query_count' in g:
+        g.metrics_query_count += 1
+        g.metrics_db_seconds += time.perf_counter() - context.metrics_query_start
+
+
+class Instrumentation:
+    """Per-endpoint latency histograms and query counts, served in Prometheus text format by /metrics"""
+
+    def __init__(self):
+        self.latency = Histogram('http_request_duration_seconds', 'Time spent handling the request.', LATENCY_BUCKETS)
+        self.queries = Histogram('http_request_db_queries', 'SQL statements executed per request.', QUERY_BUCKETS)
+        self.db_time = Histogram('http_request_db_seconds', 'Time spent in the database per request.', LATENCY_BUCKETS)
+        self.serialize_time = Histogram('http_request_serialize_seconds', 'Time spent encoding JSON per request.', LATENCY_BUCKETS)
+        self.size = Histogram('http_response_size_bytes', 'Size of the response body.', SIZE_BUCKETS)
+        self._listening = False
+
+    def histograms(self):
+        return [self.latency, self.queries, self.db_time, self.serialize_time, self.size]
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', os.getenv('METRICS_ENABLED', 'false').lower() == 'true')
+        app.config.setdefault('QUERY_BUDGET', int(os.getenv('QUERY_BUDGET', DEFAULT_QUERY_BUDGET)))
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        if not self._listening:
+            # Listening on the Engine class covers the engine Flask-SQLAlchemy creates lazily later on
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            self._listening = True
+
+        app.json_encoder = TimedJSONEncoder
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+        app.extensions['instrumentation'] = self
+
+    def _before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_query_count = 0
+        g.metrics_db_seconds = 0.0
+        g.metrics_serialize_seconds = 0.0
+
+    def _after_request(self, response):
+        if 'metrics_start' not in g:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        self.latency.observe(endpoint, time.perf_counter() - g.metrics_start)
+        self.queries.observe(endpoint, g.metrics_query_count)
+        self.db_time.observe(endpoint, g.metrics_db_seconds)
+        self.serialize_time.observe(endpoint, g.metrics_serialize_seconds)
+        if response.content_length is not None:  # unknown for streamed responses
+            self.size.observe(endpoint, response.content_length)
+
+        budget = current_app.config['QUERY_BUDGET']
+        if g.metrics_query_count > budget:
+            current_app.logger.warning("%s %s (%s) ran %d SQL statements, over the budget of %d.",
+                                       request.method, request.path, endpoint, g.metrics_query_count, budget)
+        return response
+
+    def metrics_view(self):
+        lines = []
+        for histogram in self.histograms():
+            lines.extend(histogram.render())
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+instrumentation = Instrumentation()
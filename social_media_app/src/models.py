@@ -2,6 +2,9 @@
 # imports the datetime module from the standard library and the SQLAlchemy class from the flask_sqlalchemy module.
 import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, inspect, update
+from .cache import entity_cache
+from .events import change_feed
 
 # SQLAlechemy is an ORM (Object-Relational Mapping) library or database adapter object that allows us to interact with the database using Python objects.
 # creates a new instance of the SQLAlchemy class and assigns it to the variable db.
@@ -11,6 +14,8 @@ db = SQLAlchemy()
 # The Profile class inherits from the db.Model class, which is a base class for all models in Flask-SQLAlchemy.
 class Profile(db.Model):
     __tablename__ = 'profiles'
+    # (date, id) index backing the keyset pagination of the index() endpoint
+    __table_args__ = (db.Index('ix_profiles_start_date_id', 'start_date', 'id'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(128), unique=True, nullable=False)
     password = db.Column(db.String(128), nullable=False)
@@ -18,6 +23,16 @@ class Profile(db.Model):
     interests = db.Column(db.String(128))
     birthday = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
     start_date = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    # Set once the profile has too many followers to copy each new post into every follower's timeline (see feed.py)
+    fan_out_on_read = db.Column(db.Boolean, default=False, nullable=False)
+    # Bumped by every update(), used for ETags
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    # Counters kept up to date by every write that creates or deletes posts or likes (see count_rows() below)
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    total_likes = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # Set when a delete in chunks starts; `flask purge-profile --pending` finishes the ones a dead worker left behind (see purge.py)
+    deleting_since = db.Column(db.DateTime)
+    posts = db.relationship('Post', back_populates='author', passive_deletes='all')
 
     # The __init__ method is a constructor that initializes the Profile object with the username and password attributes.
     def __init__(self, username: str, password: str, name: str, start_date: datetime, interests=None, birthday=None):
@@ -28,7 +43,7 @@ class Profile(db.Model):
         self.birthday = birthday
         self.start_date = start_date
     
-    def serialize(self):
+    def serialize(self, counts: bool = False):
         return {
             'id': self.id,
             'username': self.username,
@@ -36,27 +51,52 @@ class Profile(db.Model):
             'interests': self.interests,
             'birthday': self.birthday.isoformat(),
             'start_date': self.start_date.isoformat(),
-            'password' : 'Not shown for security reasons.'
+            'password' : 'Not shown for security reasons.',
+            **({'counts': {'post_count': self.post_count, 'total_likes': self.total_likes}} if counts else {})
         }
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()  # assigns self.id without the extra SELECT reading it after commit would need
+        id = self.id
+        change_feed.publish(db.session, 'profile', 'created', id)  # sent to /events subscribers if the commit succeeds
         db.session.commit()
+        entity_cache.invalidate(Profile, id)
     
     def update(self):
+        id = self.id  # read before the commit expires the object's attributes
+        self.version = Profile.version + 1  # bumped in SQL (version = version + 1) so concurrent updates are never lost
+        change_feed.publish(db.session, 'profile', 'updated', id)
         db.session.commit()
+        entity_cache.invalidate(Profile, id)  # drop the cached show() payload so the next read sees the change
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        # Set-based DELETEs of everything below the profile instead of loading the children into the session (see purge.py)
+        from .purge import purge_profile  # imported here because purge.py imports the models
+        id = self.id
+        db.session.expunge(self)
+        purge_profile(id)
 
 class Post(db.Model):
     __tablename__ = 'posts'
+    # On Postgres the table is partitioned by month of post_date with primary key (id, post_date), see partitions.py
+    # (date, id) index backing the keyset pagination of the index() endpoint
+    __table_args__ = (db.Index('ix_posts_post_date_id', 'post_date', 'id'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     content = db.Column(db.String(128), nullable=False)
     post_date = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
     likes = db.Column(db.Integer, default=0)
-    profile_id = db.Column(db.Integer, db.ForeignKey('profiles.id'), nullable=False)
+    profile_id = db.Column(db.Integer, db.ForeignKey('profiles.id', ondelete='CASCADE'), nullable=False)
+    # Bumped by every update(), used for ETags
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    # Counters kept up to date by every write that creates or deletes comments or images (see count_rows() below)
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    image_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # Relationships used by GET /posts/<id>?expand=... (loaded explicitly with joinedload/selectinload, never lazily in a loop).
+    # passive_deletes='all' stops the ORM from loading the children to null out their foreign keys when a post is deleted.
+    author = db.relationship('Profile', back_populates='posts')
+    comments = db.relationship('Comment', back_populates='post', passive_deletes='all')
+    images = db.relationship('Image', back_populates='post', passive_deletes='all')
 
     def __init__(self, content:str, post_date: datetime, profile_id: int, likes:int = 0):
         self.content = content
@@ -64,33 +104,77 @@ class Post(db.Model):
         self.likes = likes
         self.profile_id = profile_id
     
-    def serialize(self):
+    def serialize(self, counts: bool = False):
         return {
             'id': self.id,
             'content': self.content,
             'post_date': self.post_date.isoformat(),
             'likes': self.likes,
-            'profile_id': self.profile_id
+            'profile_id': self.profile_id,
+            **({'counts': {'comment_count': self.comment_count, 'image_count': self.image_count}} if counts else {})
         }
 
     def insert(self):
+        from .feed import fan_out_many  # imported here because feed.py imports the models
         db.session.add(self)
+        db.session.flush()  # assigns self.id without the extra SELECT reading it after commit would need
+        id = self.id
+        count_rows(Post, [self])  # +1 on the parent's counter, in the same transaction
+        fan_out_many([self])  # into the author's and the followers' timelines (see feed.py), committed with the post
+        change_feed.publish(db.session, 'post', 'created', id, post_id=id)  # sent to /events subscribers if the commit succeeds
         db.session.commit()
-
+        entity_cache.invalidate(Post, id)
+    
     def update(self):
+        post_date = inspect(self).attrs.post_date.history  # read first, loading an expired attribute autoflushes the change
+        id = self.id  # read before the commit expires the object's attributes
+        self.version = Post.version + 1  # bumped in SQL (version = version + 1) so concurrent updates are never lost
+        likes = inspect(self).attrs.likes.history  # a new like count moves the author's total_likes as well
+        if likes.added and likes.deleted:
+            add_to_counters(Profile.total_likes, {self.profile_id: (likes.added[0] or 0) - (likes.deleted[0] or 0)})
+        if post_date.added:
+            self.move_timeline_entries(post_date.added[0])
+        change_feed.publish(db.session, 'post', 'updated', id, post_id=id)
         db.session.commit()
+        entity_cache.invalidate(Post, id)  # drop the cached show() payload so the next read sees the change
+
+    def move_timeline_entries(self, post_date):
+        """Give the post's timeline entries its new post_date (no commit); timelines are ordered (and archived) by their
+        own copy of the date"""
+        db.session.query(TimelineEntry).filter(TimelineEntry.post_id == self.id) \
+            .update({TimelineEntry.post_date: post_date}, synchronize_session=False)
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        # Set-based DELETEs of everything below the post instead of loading the children into the session (see purge.py)
+        from .purge import purge_post  # imported here because purge.py imports the models
+        id = self.id
+        db.session.expunge(self)
+        purge_post(id)
+
+# Profiles whose delete in chunks has not finished, a handful at most (partial on Postgres)
+db.Index('ix_profiles_deleting_since', Profile.deleting_since, postgresql_where=Profile.deleting_since.isnot(None))
+
+# Hot path: a profile's posts newest first (profile pages, feed fan-out-on-read, cascading deletes)
+db.Index('ix_posts_profile_id_post_date', Post.profile_id, Post.post_date.desc(), Post.id.desc())
 
 class Image(db.Model):
     __tablename__ = 'images'
+    # (date, id) index backing the keyset pagination of the index() endpoint
+    __table_args__ = (
+        db.Index('ix_images_image_date_id', 'image_date', 'id'),
+        db.Index('ix_images_post_id', 'post_id'),  # images of a post
+        db.Index('ix_images_comment_id', 'comment_id'),  # images of a comment
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     url = db.Column(db.String(128), nullable=False)
     image_date = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), nullable=False)
-    comment_id = db.Column(db.Integer, db.ForeignKey('comments.id',))
+    # Like Comment.post_id, these foreign keys only exist for create_all(), see there
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
+    comment_id = db.Column(db.Integer, db.ForeignKey('comments.id', ondelete='CASCADE'))
+    # Bumped by every update(), used for ETags
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    post = db.relationship('Post', back_populates='images')
+    comment = db.relationship('Comment', back_populates='images')
 
     def __init__(self, url:str, image_date: datetime, post_id:int, comment_id:int = None):
         self.url = url
@@ -109,21 +193,46 @@ class Image(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()  # assigns self.id without the extra SELECT reading it after commit would need
+        id = self.id
+        count_rows(Image, [self])  # +1 on the parent's counter, in the same transaction
+        change_feed.publish(db.session, 'image', 'created', id, post_id=self.post_id)  # sent to /events subscribers if the commit succeeds
         db.session.commit()
-
+        entity_cache.invalidate(Image, id)
+    
     def update(self):
+        id = self.id  # read before the commit expires the object's attributes
+        self.version = Image.version + 1  # bumped in SQL (version = version + 1) so concurrent updates are never lost
+        change_feed.publish(db.session, 'image', 'updated', id, post_id=self.post_id)
         db.session.commit()
+        entity_cache.invalidate(Image, id)  # drop the cached show() payload so the next read sees the change
 
     def delete(self):
+        id = self.id  # read before the commit detaches the deleted object
+        change_feed.publish(db.session, 'image', 'deleted', id, post_id=self.post_id)
+        count_rows(Image, [self], -1)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(Image, id)
 
 class Comment(db.Model):
     __tablename__ = 'comments'
+    # On Postgres the table is partitioned by month of comment_date with primary key (id, comment_date), see partitions.py
+    # (date, id) index backing the keyset pagination of the index() endpoint
+    __table_args__ = (
+        db.Index('ix_comments_comment_date_id', 'comment_date', 'id'),
+        db.Index('ix_comments_post_id_comment_date', 'post_id', 'comment_date', 'id'),  # the thread of a post in (date, id) order
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     content = db.Column(db.String(128), nullable=False)
     comment_date = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), nullable=False)
+    # The foreign key only exists for create_all(): on Postgres posts are partitioned (migration 0009), so every create
+    # checks the post exists (reference_errors() in api/bulk.py) and the deletes remove the comments (purge.py)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
+    # Bumped by every update(), used for ETags
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    post = db.relationship('Post', back_populates='comments')
+    images = db.relationship('Image', back_populates='comment', passive_deletes='all')
 
     def __init__(self, content:str, comment_date: datetime, post_id:int):
         self.content = content
@@ -139,16 +248,154 @@ class Comment(db.Model):
         }
 
     def insert(self):
+        from .trending import record_comments  # imported here because trending.py imports the models
         db.session.add(self)
+        db.session.flush()  # assigns self.id without the extra SELECT reading it after commit would need
+        id = self.id
+        count_rows(Comment, [self])  # +1 on the parent's counter, in the same transaction
+        record_comments([self])  # counts towards the post's trending score, committed with the comment
+        change_feed.publish(db.session, 'comment', 'created', id, post_id=self.post_id)  # sent to /events subscribers if the commit succeeds
         db.session.commit()
-
+        entity_cache.invalidate(Comment, id)
+    
     def update(self):
+        moved = self._moved_from()
+        id = self.id  # read before the commit expires the object's attributes
+        self.version = Comment.version + 1  # bumped in SQL (version = version + 1) so concurrent updates are never lost
+        if moved is not None:
+            # Moved to another post: its images move with it, and both posts' counters follow
+            old, new = moved
+            images = db.session.query(Image).filter(Image.comment_id == id).update({Image.post_id: new}, synchronize_session=False)
+            add_to_counters(Post.comment_count, {old: -1, new: 1})
+            add_to_counters(Post.image_count, {old: -images, new: images})
+        change_feed.publish(db.session, 'comment', 'updated', id, post_id=self.post_id)
+        db.session.commit()
+        entity_cache.invalidate(Comment, id)  # drop the cached show() payload so the next read sees the change
+
+    def _moved_from(self):
+        """(old post id, new post id) if post_id was changed, otherwise None"""
+        state = inspect(self)
+        history = state.attrs.post_id.history
+        if not history.added:
+            return None
+        with db.session.no_autoflush:  # the old value is only in the database until the change is flushed
+            old = history.deleted[0] if history.deleted else \
+                db.session.query(Comment.post_id).filter(Comment.id == state.identity[0]).scalar()
+        return (old, history.added[0]) if old != history.added[0] else None
+
+    def delete(self):
+        id = self.id  # read before the commit detaches the deleted object
+        change_feed.publish(db.session, 'comment', 'deleted', id, post_id=self.post_id)
+        uncount_comment(self)
+        delete_comment_images(self)
+        db.session.delete(self)
+        db.session.commit()
+        entity_cache.invalidate(Comment, id)
+
+# A Follow row means follower_id sees the posts of followee_id in their feed
+class Follow(db.Model):
+    __tablename__ = 'follows'
+    # The primary key covers "who does X follow", this index covers "who follows X" which the fan-out needs
+    __table_args__ = (db.Index('ix_follows_followee_id', 'followee_id'),)
+    follower_id = db.Column(db.Integer, db.ForeignKey('profiles.id', ondelete='CASCADE'), primary_key=True)
+    followee_id = db.Column(db.Integer, db.ForeignKey('profiles.id', ondelete='CASCADE'), primary_key=True)
+    follow_date = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    def __init__(self, follower_id: int, followee_id: int):
+        self.follower_id = follower_id
+        self.followee_id = followee_id
+
+    def serialize(self):
+        return {
+            'follower_id': self.follower_id,
+            'followee_id': self.followee_id,
+            'follow_date': self.follow_date.isoformat()
+        }
+
+    def insert(self):
+        db.session.add(self)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
 
+# Precomputed home timeline: one row per (profile, post) that should appear in that profile's feed.
+# The primary key is ordered (profile_id, post_date, post_id) so reading a feed page is one index range scan.
+class TimelineEntry(db.Model):
+    __tablename__ = 'timeline_entries'
+    __table_args__ = (db.Index('ix_timeline_entries_post_id', 'post_id'),)
+    profile_id = db.Column(db.Integer, db.ForeignKey('profiles.id', ondelete='CASCADE'), primary_key=True)
+    post_date = db.Column(db.DateTime, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True)
+
+# Hourly engagement score per post for /posts/trending (see trending.py). Likes and comments add to the bucket of the
+# hour they happened in, so ranking the last N hours only reads N hours of small rows instead of posts x comments.
+class TrendingBucket(db.Model):
+    __tablename__ = 'trending_buckets'
+    __table_args__ = (db.Index('ix_trending_buckets_post_id', 'post_id'),)
+    hour = db.Column(db.Integer, primary_key=True)  # hours since the Unix epoch (UTC)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True)
+    score = db.Column(db.Float, default=0, nullable=False)
+
+# Stored responses of POST requests sent with an Idempotency-Key header (see idempotency.py), so a retried create returns
+# the first response instead of inserting a duplicate. status_code is NULL while the first request is still running.
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (db.Index('ix_idempotency_keys_created_at', 'created_at'),)  # expiry sweeps
+    key = db.Column(db.String(64), primary_key=True)  # sha256 of method, path and the client's key
+    fingerprint = db.Column(db.String(64), nullable=False)  # sha256 of the request body
+    status_code = db.Column(db.Integer)
+    mimetype = db.Column(db.String(64))
+    body = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+# Counters maintained on write: profiles.post_count and total_likes, posts.comment_count and image_count.
+# Each path that creates or deletes posts, comments or images (the model methods, /bulk, /batch, purge.py) and the like
+# flush in counters.py adds its delta in the same transaction as the rows, so the counts never need a COUNT(*) to read.
+# `flask repair-counters` (aggregates.py) recomputes them from the tables if they ever drift.
+def add_to_counters(column, deltas: dict):
+    """column = column + delta for every {id: delta} (no commit)"""
+    deltas = {id: delta for id, delta in deltas.items() if id is not None and delta}
+    if not deltas:
+        return
+    table = column.table
+    statement = update(table).where(table.c.id == bindparam('b_id')).values({column.key: column + bindparam('b_delta')})
+    # Sorted by id so two transactions bumping the same parents lock them in the same order (no deadlocks)
+    db.session.execute(statement, [{'b_id': id, 'b_delta': delta} for id, delta in sorted(deltas.items())])
+
+def count_rows(model, rows, sign: int = 1):
+    """Add created (sign=1) or remove deleted (sign=-1) posts, comments or images (objects or RETURNING rows) from
+    their parents' counters, one UPDATE per parent (no commit)"""
+    counts, likes = {}, {}
+    for row in rows:
+        parent = row.profile_id if model is Post else row.post_id
+        counts[parent] = counts.get(parent, 0) + sign
+        if model is Post:
+            likes[parent] = likes.get(parent, 0) + sign * (row.likes or 0)
+    if model is Post:
+        add_to_counters(Profile.post_count, counts)
+        add_to_counters(Profile.total_likes, likes)
+    else:
+        add_to_counters(Post.comment_count if model is Comment else Post.image_count, counts)
+
+def uncount_comment(comment):
+    """Take a comment that is being deleted off its post's counters, together with the images it takes with it"""
+    count_rows(Comment, [comment], -1)
+    count_rows(Image, db.session.query(Image.post_id).filter(Image.comment_id == comment.id).all(), -1)
+
+def lock_for_delete(model, condition):
+    """Lock the rows about to be deleted (FOR UPDATE, no commit). A create that checked one of them as its parent holds a
+    FOR KEY SHARE lock (see api/bulk.py), so either it commits first and the deletes that follow see its row, or it
+    waits and then finds the parent gone."""
+    db.session.query(model.id).filter(condition).with_for_update().all()
+
+def delete_comment_images(comment):
+    """Delete the images of a comment that is being deleted (no commit); comments are partitioned, so no foreign key
+    cascades to them (migration 0009)"""
+    lock_for_delete(Comment, Comment.id == comment.id)
+    db.session.query(Image).filter(Image.comment_id == comment.id).delete(synchronize_session=False)
+
 # I now want to create 4 relationships: profile_posts, post_images, post_comments, and comment_images
 # profile_posts will be a one-to-many relationship between profiles and posts
 # post_images will be a one-to-many relationship between posts and images
@@ -0,0 +1,297 @@
+# Monthly range partitions of posts (by post_date) and comments (by comment_date) on Postgres, see migration 0009.
+# Nearly every read and write touches the last few weeks, so with one partition per month the hot indexes are a few small
+# ones that stay in memory, and vacuum only revisits recent months. Old months are detached and written to compressed
+# files by `flask archive-partitions`, which also takes them out of every index. Nothing has a foreign key to posts or
+# comments, so the same transaction moves the archived rows' comments and images into tables of their own (archived
+# next to the partition), deletes their timeline entries and trending buckets and takes them off the counters.
+# Archived rows were not deleted, so the change feed is not told about them.
+#
+# Partitions are named <table>_pYYYY_MM. A <table>_default partition catches rows outside every month (e.g. a date far
+# in the future); creating a month moves its rows out of the default partition first.
+# Future months are created ahead of time, PARTITION_MONTHS_AHEAD of them, by a background check that every worker runs
+# every PARTITION_CHECK_INTERVAL seconds (and by `flask create-partitions`, for cron or a deploy hook).
+#
+# Trade-offs of the partitioned layout:
+# - The primary keys are (id, <date>), so nothing can have a foreign key to posts.id or comments.id any more; the
+#   creates check the parents exist (api/bulk.py), and the set-based deletes in purge.py (and Comment.delete()) and
+#   archive_partitions() remove the dependent rows themselves.
+# - A lookup by id alone (GET /posts/<id>) probes the id index of every partition, which is cheap while archiving keeps
+#   the number of months small.
+import datetime
+import gzip
+import os
+import re
+import threading
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from .aggregates import uncount_posts
+from .models import Post, add_to_counters, db
+
+try:
+    import pyarrow  # optional, for --format parquet
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+PARTITIONED = {'posts': 'post_date', 'comments': 'comment_date'}  # table -> partition key
+DEFAULT_MONTHS_AHEAD = 3  # Future months that always have a partition
+DEFAULT_CHECK_INTERVAL = 6 * 3600  # Seconds between checks for missing future partitions
+EXPORT_BATCH_SIZE = 50000  # Rows per Parquet row group (read from a server-side cursor)
+LOCK_KEY = 0x706172746e  # pg_advisory_xact_lock key: one worker at a time creates or detaches partitions
+NAME_PATTERN = re.compile(r'^(?P<table>[a-z_]+)_p(?P<year>\d{4})_(?P<month>\d{2})$')
+
+
+def month_start(day):
+    return datetime.date(day.year, day.month, 1)
+
+
+def add_months(month: datetime.date, months: int):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: datetime.date):
+    return '%s_p%04d_%02d' % (table, month.year, month.month)
+
+
+def is_partitioned(table: str):
+    # relkind 'p' = partitioned table (false before migration 0009, or on SQLite)
+    if db.engine.dialect.name != 'postgresql':
+        return False
+    return db.session.execute(text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)"),
+                              {'table': table}).scalar() or False
+
+
+def partition_months(table: str):
+    """The months that have a partition of table, oldest first"""
+    names = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:table)"),
+        {'table': table}).scalars()
+    months = []
+    for name in names:
+        match = NAME_PATTERN.match(name)
+        if match and match.group('table') == table:
+            months.append(datetime.date(int(match.group('year')), int(match.group('month')), 1))
+    return sorted(months)
+
+
+def create_partition(table: str, month: datetime.date):
+    """Create the partition of table for month in the current transaction, moving its rows out of the default partition"""
+    name, column = partition_name(table, month), PARTITIONED[table]
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    db.session.execute(text('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (name, table)))
+    db.session.execute(text('WITH moved AS (DELETE FROM %s_default WHERE %s >= :start AND %s < :end RETURNING *) '
+                            'INSERT INTO %s SELECT * FROM moved' % (table, column, column, name)), bounds)
+    # Attaching builds the parent's indexes on the new table and only locks out other DDL, not reads or writes
+    db.session.execute(text("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM ('%s') TO ('%s')"
+                            % (table, name, bounds['start'].isoformat(), bounds['end'].isoformat())))
+
+
+def ensure_months(table: str, wanted):
+    """Create the partitions of table for the months in wanted that have none and commit, returns their names"""
+    if set(wanted) <= set(partition_months(table)):
+        return []  # the usual case: one catalog query and no DDL
+    created = []
+    db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': LOCK_KEY})
+    existing = set(partition_months(table))  # again, another worker may have created them while we waited
+    for month in wanted:
+        if month not in existing:
+            create_partition(table, month)
+            created.append(partition_name(table, month))
+    db.session.commit()
+    return created
+
+
+def ensure_partitions(months_ahead: int = DEFAULT_MONTHS_AHEAD, today=None):
+    """Create the missing partitions from this month to months_ahead months ahead, returns their names"""
+    created = []
+    this_month = month_start(today or datetime.datetime.utcnow())
+    for table in PARTITIONED:
+        if is_partitioned(table):
+            created += ensure_months(table, [add_months(this_month, n) for n in range(months_ahead + 1)])
+    return created
+
+
+def export_table(name: str, path: str, format: str):
+    """Write every row of table name to path as gzip compressed CSV (with a header) or as Parquet"""
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT * FROM %s LIMIT 0' % name)
+        columns = [c[0] for c in cursor.description if c[0] != 'search_vector']  # derived from content, not archived
+        select = 'SELECT %s FROM %s' % (', '.join(columns), name)
+        if format == 'csv':
+            with gzip.open(path, 'wb') as file:
+                cursor.copy_expert('COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER)' % select, file)
+        else:
+            # A named (server-side) cursor streams the partition, one row group per batch
+            cursor = connection.cursor(name='archive_%s' % name)
+            cursor.execute(select)
+            writer = None
+            try:
+                while True:
+                    rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                    if not rows:
+                        break
+                    batch = pyarrow.Table.from_pylist([dict(zip(columns, row)) for row in rows],
+                                                      schema=writer.schema if writer else None)
+                    if writer is None:
+                        writer = pyarrow.parquet.ParquetWriter(path, batch.schema, compression='zstd')
+                    writer.write_table(batch)
+            finally:
+                if writer is not None:
+                    writer.close()
+        connection.rollback()  # read only, end the transaction before the connection goes back to the pool
+    finally:
+        connection.close()
+
+
+def _move_rows(table: str, name: str, where: str):
+    """Move the rows of table matching where into a new table name in the current transaction, returns name"""
+    db.session.execute(text('CREATE TABLE %s (LIKE %s)' % (name, table)))
+    db.session.execute(text('WITH moved AS (DELETE FROM %s WHERE %s RETURNING *) INSERT INTO %s SELECT * FROM moved'
+                            % (table, where, name)))
+    return name
+
+
+def _uncount(column, table: str):
+    """Take the rows of table off the column counter of their posts"""
+    rows = db.session.execute(text('SELECT post_id, count(*) FROM %s GROUP BY post_id' % table))
+    add_to_counters(column, {post_id: -count for post_id, count in rows})
+
+
+def archive_dependents(table: str, name: str, month: datetime.date):
+    """Move the comments and images of the rows of partition name (still attached) into tables of their own, delete
+    what else refers to them and fix the counters, without committing. Returns the names of the new tables."""
+    # Plain reads go on; creates that check a parent in this partition (FOR KEY SHARE) and writes to it wait until the
+    # commit, so nothing new can refer to these rows meanwhile
+    db.session.execute(text('LOCK TABLE %s IN EXCLUSIVE MODE' % name))
+    if table == 'comments':
+        _uncount(Post.comment_count, name)
+        images = _move_rows('images', name + '_images', 'comment_id IN (SELECT id FROM %s)' % name)
+        _uncount(Post.image_count, images)
+        return [images]
+    uncount_posts((Post.post_date >= month) & (Post.post_date < add_months(month, 1)))  # the authors' counters
+    # The posts' comments sit in the partitions of their own months, the images hang off the post or off a comment
+    comments = _move_rows('comments', name + '_comments', 'post_id IN (SELECT id FROM %s)' % name)
+    images = _move_rows('images', name + '_images',
+                        'post_id IN (SELECT id FROM %s) OR comment_id IN (SELECT id FROM %s)' % (name, comments))
+    for derived in ('timeline_entries', 'trending_buckets'):  # recomputed data, dropped rather than archived
+        db.session.execute(text('DELETE FROM %s WHERE post_id IN (SELECT id FROM %s)' % (derived, name)))
+    return [comments, images]
+
+
+def archive_partitions(before: datetime.date, directory: str, format: str = 'csv', keep: bool = False, log=print):
+    """Detach the partitions of every month before the month before, export them (and the tables of their dependents) to
+    directory and drop them (unless keep). Returns the paths written."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for table in PARTITIONED:
+        if not is_partitioned(table):
+            continue
+        for month in partition_months(table):
+            if month >= before:
+                continue
+            name = partition_name(table, month)
+            db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': LOCK_KEY})
+            names = [name] + archive_dependents(table, name, month)
+            # A plain DETACH briefly locks the parent table; the partition's rows then leave every query and index
+            db.session.execute(text('ALTER TABLE %s DETACH PARTITION %s' % (table, name)))
+            db.session.commit()
+
+            # From here on a failure leaves the detached tables in place, `DROP TABLE` them or put the rows back by hand
+            for name in names:
+                path = os.path.join(directory, '%s.%s' % (name, 'csv.gz' if format == 'csv' else 'parquet'))
+                export_table(name, path, format)
+                if not keep:
+                    db.session.execute(text('DROP TABLE %s' % name))
+                    db.session.commit()
+                log('  %s -> %s%s' % (name, path, ' (table kept)' if keep else ''))
+                paths.append(path)
+    return paths
+
+
+class PartitionMaintenance:
+    """Checks every PARTITION_CHECK_INTERVAL seconds that the next months have partitions and creates missing ones"""
+
+    def __init__(self):
+        self.app = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+        app.config.setdefault('PARTITION_AUTO_CREATE', uri.startswith('postgresql'))
+        app.config.setdefault('PARTITION_MONTHS_AHEAD', DEFAULT_MONTHS_AHEAD)
+        app.config.setdefault('PARTITION_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL)
+        self.app = app
+        app.extensions['partitions'] = self
+        if app.config['PARTITION_AUTO_CREATE']:
+            app.before_request(self._ensure_thread)
+
+    def _ensure_thread(self):
+        # Started on the first request so that every gunicorn worker gets its own thread after the fork
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='partition-maintenance', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    created = ensure_partitions(self.app.config['PARTITION_MONTHS_AHEAD'])
+                    if created:
+                        self.app.logger.info("Created partitions %s.", ', '.join(created))
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception("Creating future partitions failed, retrying on the next check.")
+                finally:
+                    db.session.remove()
+            if self._stop.wait(self.app.config['PARTITION_CHECK_INTERVAL']):
+                return
+
+    def stop(self):
+        self._stop.set()
+
+
+partitions = PartitionMaintenance()
+
+
+def _require_partitions():
+    if not any(is_partitioned(table) for table in PARTITIONED):
+        raise click.ClickException('posts and comments are not partitioned (needs Postgres and `flask db upgrade` to 0009).')
+
+
+@click.command('create-partitions')
+@click.option('--months-ahead', type=int, default=DEFAULT_MONTHS_AHEAD, help='Future months that should have a partition.')
+@with_appcontext
+def create_partitions_command(months_ahead):
+    """Create the monthly partitions of posts and comments up to N months ahead."""
+    _require_partitions()
+    created = ensure_partitions(months_ahead)
+    click.echo('Created %s.' % ', '.join(created) if created else 'Every partition exists already.')
+
+
+@click.command('archive-partitions')
+@click.option('--before', required=True, help='Archive the months before this one (YYYY-MM).')
+@click.option('--to', 'directory', default='archive', show_default=True, help='Directory the files are written to.')
+@click.option('--format', type=click.Choice(['csv', 'parquet']), default='csv', show_default=True,
+              help='gzip compressed CSV, or Parquet (needs pyarrow).')
+@click.option('--keep-table', is_flag=True, help='Keep the detached tables instead of dropping them.')
+@with_appcontext
+def archive_partitions_command(before, directory, format, keep_table):
+    """Detach the monthly partitions of posts and comments before a month, export them to files and drop them."""
+    try:
+        before_month = datetime.datetime.strptime(before, '%Y-%m').date()
+    except ValueError:
+        raise click.ClickException('--before must be a month, YYYY-MM.')
+    if format == 'parquet' and pyarrow is None:
+        raise click.ClickException('--format parquet needs the pyarrow package (pip install pyarrow).')
+    _require_partitions()
+    paths = archive_partitions(before_month, directory, format, keep_table, log=click.echo)
+    click.echo('Wrote %d files.' % len(paths))
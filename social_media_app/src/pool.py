@@ -0,0 +1,119 @@
+# SQLAlchemy connection pool settings, checked against the gunicorn worker model, plus stats for /debug/pool.
+# Every gunicorn worker process has its own pool, so the database sees up to workers x (pool_size + max_overflow)
+# connections. Too small a pool makes request threads queue for a connection, too large a total exhausts Postgres
+# max_connections when we scale out. The settings come from env vars (or test_config) instead of SQLAlchemy defaults.
+import multiprocessing
+import os
+import threading
+import time
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+
+def env_flag(name: str, default: bool):
+    return os.getenv(name, str(default)).lower() in ('1', 'true', 'yes')
+
+
+def pool_config():
+    """Default DB_POOL_* settings read from the environment"""
+    return dict(
+        DB_POOL_SIZE=int(os.getenv('DB_POOL_SIZE', 5)),  # Connections each worker keeps open
+        DB_MAX_OVERFLOW=int(os.getenv('DB_MAX_OVERFLOW', 5)),  # Extra connections a worker may open under load
+        DB_POOL_TIMEOUT=float(os.getenv('DB_POOL_TIMEOUT', 10)),  # Seconds a request waits for a connection before failing
+        DB_POOL_RECYCLE=int(os.getenv('DB_POOL_RECYCLE', 1800)),  # Reconnect connections older than this (seconds)
+        DB_POOL_PRE_PING=env_flag('DB_POOL_PRE_PING', True),  # Test connections on checkout so a Postgres restart is survived
+        DB_MAX_CONNECTIONS=int(os.getenv('DB_MAX_CONNECTIONS', 0)) or None  # Postgres max_connections budget for this app
+    )
+
+
+def worker_model():
+    """(workers, concurrent requests per worker) from the same env vars gunicorn.conf.py reads"""
+    workers = int(os.getenv('WEB_CONCURRENCY') or multiprocessing.cpu_count() * 2 + 1)
+    if os.getenv('GUNICORN_WORKER_CLASS', 'gthread') == 'gevent':
+        concurrency = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+    else:
+        concurrency = int(os.getenv('GUNICORN_THREADS', 4))
+    return workers, concurrency
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a free connection"""
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+def configure_pool(app):
+    """Set SQLALCHEMY_ENGINE_OPTIONS from the DB_POOL_* settings and check them against the worker model"""
+    uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+    if not uri.startswith('postgresql'):
+        return  # SQLite (tests) uses its own single-connection pool
+
+    config = app.config
+    options = dict(
+        poolclass=TimedQueuePool,
+        pool_size=config['DB_POOL_SIZE'],
+        max_overflow=config['DB_MAX_OVERFLOW'],
+        pool_timeout=config['DB_POOL_TIMEOUT'],
+        pool_recycle=config['DB_POOL_RECYCLE'],
+        pool_pre_ping=config['DB_POOL_PRE_PING'],
+        # psycopg2's execute_batch for executemany UPDATEs (like counter flushes) instead of one round-trip per row
+        executemany_mode='values_plus_batch'
+    )
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    workers, concurrency = worker_model()
+    per_worker = config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW']
+    if per_worker < concurrency and os.getenv('GUNICORN_WORKER_CLASS', 'gthread') != 'gevent':
+        app.logger.warning(
+            "DB pool allows %d connections per worker but each worker runs %d threads, requests will queue for "
+            "connections. Raise DB_POOL_SIZE/DB_MAX_OVERFLOW or lower GUNICORN_THREADS.", per_worker, concurrency)
+    if config['DB_MAX_CONNECTIONS'] and workers * per_worker > config['DB_MAX_CONNECTIONS']:
+        raise RuntimeError(
+            "%d workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW = %d) = %d connections exceeds DB_MAX_CONNECTIONS=%d."
+            % (workers, per_worker, workers * per_worker, config['DB_MAX_CONNECTIONS']))
+
+
+def pool_stats(engine):
+    """Current state of this worker's pool as a dictionary"""
+    pool = engine.pool
+    stats = {'pool_class': type(pool).__name__, 'pid': os.getpid()}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,
+            timeout=pool.timeout()
+        )
+    if isinstance(pool, TimedQueuePool):
+        stats.update(
+            checkouts=pool.checkouts,
+            checkout_timeouts=pool.timeouts,
+            wait_seconds_total=round(pool.wait_seconds_total, 6),
+            wait_seconds_avg=round(pool.wait_seconds_total / pool.checkouts, 6) if pool.checkouts else 0.0,
+            wait_seconds_max=round(pool.wait_seconds_max, 6)
+        )
+    return stats
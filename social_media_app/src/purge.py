@@ -0,0 +1,210 @@
+# Set-based deletes for posts and profiles.
+# session.delete() on a profile would have to load every post, comment and image below it to delete them one by one.
+# Instead each table is cleared with one DELETE ... WHERE <parent> IN (SELECT ...) statement, children first, so deleting a
+# profile with 100k posts is a handful of statements in one transaction and no child row is loaded into the session.
+# Since migration 0009 posts and comments are partitioned and nothing has a foreign key to them (only posts.profile_id
+# still cascades), so these deletes are what keeps comments, images, timelines and trending buckets from pointing at
+# nothing: a plain DELETE FROM posts in psql leaves orphans.
+# Profiles with more than PURGE_SYNC_MAX_POSTS posts are deleted by a background thread in chunks of PURGE_CHUNK_SIZE
+# posts, one transaction per chunk, so no single transaction holds locks on the whole account. The thread dies with its
+# worker (a max_requests recycle, a timeout or a deploy), so profiles.deleting_since records the delete before it
+# starts and `flask purge-profile --pending` (cron, or a deploy hook) finishes every profile left half-deleted.
+import datetime
+import threading
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, select
+from .aggregates import uncount_posts
+from .cache import entity_cache
+from .events import change_feed
+from .models import Comment, Follow, Image, Post, Profile, TimelineEntry, TrendingBucket, db, lock_for_delete
+
+SYNC_MAX_POSTS = 10000  # Profiles with more posts than this are deleted in the background
+CHUNK_SIZE = 5000  # Posts deleted per transaction by the background job
+
+
+def _execute(statement):
+    return db.session.execute(statement.execution_options(synchronize_session=False)).rowcount
+
+
+def delete_posts(condition):
+    """Delete the posts matching condition and everything that references them, without committing.
+    Returns {table: rows deleted}."""
+    post_ids = select(Post.id).where(condition)
+    comment_ids = select(Comment.id).where(Comment.post_id.in_(post_ids))
+    lock_for_delete(Post, condition)  # before the children, so no new comment or image of these posts slips in
+    uncount_posts(condition)  # the authors' post and like counters (the posts' own counters go with them)
+    return {
+        # images can hang off the post or off one of its comments
+        'images': _execute(delete(Image).where(Image.post_id.in_(post_ids)))
+                  + _execute(delete(Image).where(Image.comment_id.in_(comment_ids))),
+        'comments': _execute(delete(Comment).where(Comment.post_id.in_(post_ids))),
+        'timeline_entries': _execute(delete(TimelineEntry).where(TimelineEntry.post_id.in_(post_ids))),
+        'trending_buckets': _execute(delete(TrendingBucket).where(TrendingBucket.post_id.in_(post_ids))),
+        'posts': _execute(delete(Post).where(condition)),
+    }
+
+
+def _delete_profile_row(id: int):
+    counts = {
+        'follows': _execute(delete(Follow).where(Follow.follower_id == id))
+                   + _execute(delete(Follow).where(Follow.followee_id == id)),
+        'timeline_entries': _execute(delete(TimelineEntry).where(TimelineEntry.profile_id == id)),
+    }
+    counts['profiles'] = _execute(delete(Profile).where(Profile.id == id))
+    return counts
+
+
+def _merge(total: dict, counts: dict):
+    for table, count in counts.items():
+        total[table] = total.get(table, 0) + count
+    return total
+
+
+def publish_deleted(profile_id, post_ids):
+    """Tell the change feed about the deleted posts (comments and images go with them) and profile, without committing"""
+    messages = [{'type': 'post', 'action': 'deleted', 'id': post_id, 'post_id': post_id} for post_id in post_ids]
+    if profile_id is not None:
+        messages.append({'type': 'profile', 'action': 'deleted', 'id': profile_id, 'post_id': None})
+    change_feed.publish_many(db.session, messages)
+
+
+def purge_post(id: int):
+    """Delete a post with its comments, images and timeline entries in one transaction"""
+    counts = delete_posts(Post.id == id)
+    publish_deleted(None, [id])
+    db.session.commit()
+    entity_cache.invalidate(Post, id)
+    return counts
+
+
+def purge_profile(id: int):
+    """Delete a profile and everything below it in one transaction"""
+    # Only the post ids are read (for the cache), the rows are never loaded. Cached comments and images of the profile
+    # expire on their own after CACHE_TTL / CACHE_SHARED_TTL seconds.
+    lock_for_delete(Profile, Profile.id == id)  # creates that checked the profile commit first, later ones find it gone
+    post_ids = [post_id for post_id, in db.session.query(Post.id).filter(Post.profile_id == id)]
+    counts = delete_posts(Post.profile_id == id)
+    _merge(counts, _delete_profile_row(id))
+    publish_deleted(id, post_ids)
+    db.session.commit()
+    entity_cache.invalidate_many(Post, post_ids)
+    entity_cache.invalidate(Profile, id)
+    return counts
+
+
+def mark_deleting(id: int):
+    """Record that the profile is being deleted in chunks, so the delete can be resumed if it is interrupted (and the
+    creates refuse new rows under it, see reference_errors() in api/bulk.py)"""
+    db.session.query(Profile).filter(Profile.id == id, Profile.deleting_since.is_(None)) \
+        .update({Profile.deleting_since: datetime.datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+
+
+def pending_deletes():
+    """Ids of the profiles whose delete in chunks started but has not finished, oldest first"""
+    return [id for id, in db.session.query(Profile.id).filter(Profile.deleting_since.isnot(None))
+            .order_by(Profile.deleting_since)]
+
+
+def purge_profile_in_chunks(id: int, chunk_size: int = CHUNK_SIZE):
+    """Delete a profile's posts chunk_size at a time (one transaction each), then the profile itself"""
+    mark_deleting(id)
+    counts = {}
+    while True:
+        post_ids = [post_id for post_id, in db.session.query(Post.id).filter(Post.profile_id == id).limit(chunk_size)]
+        if not post_ids:
+            break
+        _merge(counts, delete_posts(Post.id.in_(post_ids)))
+        publish_deleted(None, post_ids)
+        db.session.commit()
+        entity_cache.invalidate_many(Post, post_ids)
+    # A create that checked the profile before mark_deleting() committed may have added a post behind the chunks: with
+    # the profile locked, delete those with the profile row (the posts' foreign key alone would orphan their children)
+    lock_for_delete(Profile, Profile.id == id)
+    post_ids = [post_id for post_id, in db.session.query(Post.id).filter(Post.profile_id == id)]
+    _merge(counts, delete_posts(Post.profile_id == id))
+    _merge(counts, _delete_profile_row(id))
+    publish_deleted(id, post_ids)
+    db.session.commit()
+    entity_cache.invalidate_many(Post, post_ids)
+    entity_cache.invalidate(Profile, id)
+    return counts
+
+
+def has_many_posts(id: int, limit: int):
+    """True if the profile has more than limit posts, without counting all of them"""
+    # ( comparable to SELECT 1 FROM posts WHERE profile_id = :id LIMIT :limit + 1; on ix_posts_profile_id_post_date )
+    return db.session.query(Post.id).filter(Post.profile_id == id).limit(limit + 1).count() > limit
+
+
+class PurgeJobs:
+    """Deletes profiles with more than PURGE_SYNC_MAX_POSTS posts in chunks on a background thread"""
+
+    def __init__(self):
+        self.app = None
+        self.running = {}  # profile id -> thread, in this worker process
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('PURGE_SYNC_MAX_POSTS', SYNC_MAX_POSTS)
+        app.config.setdefault('PURGE_CHUNK_SIZE', CHUNK_SIZE)
+        self.app = app
+        app.extensions['purge_jobs'] = self
+
+    def delete_profile(self, id: int):
+        """Delete the profile now if it is small, otherwise start a background job. Returns True if it was deleted now."""
+        if not has_many_posts(id, current_app.config['PURGE_SYNC_MAX_POSTS']):
+            purge_profile(id)
+            return True
+        mark_deleting(id)  # committed before the thread starts, so `purge-profile --pending` can finish it if the thread dies
+        self.start(id)
+        return False
+
+    def start(self, id: int):
+        with self._lock:
+            if id in self.running and self.running[id].is_alive():
+                return  # already being deleted
+            thread = threading.Thread(target=self._run, args=(id,), name='purge-profile-%d' % id, daemon=True)
+            self.running[id] = thread
+            thread.start()
+
+    def _run(self, id: int):
+        with self.app.app_context():
+            try:
+                counts = purge_profile_in_chunks(id, self.app.config['PURGE_CHUNK_SIZE'])
+                self.app.logger.info("Deleted profile %d in the background: %s", id, counts)
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception("Deleting profile %d in the background failed, `flask purge-profile --pending` "
+                                          "deletes the rest.", id)
+            finally:
+                db.session.remove()
+                with self._lock:
+                    self.running.pop(id, None)
+
+
+purge_jobs = PurgeJobs()
+
+
+@click.command('purge-profile')
+@click.argument('profile_id', type=int, required=False)
+@click.option('--pending', is_flag=True, help='Finish every background delete that did not complete (e.g. its worker was restarted).')
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, help='Posts deleted per transaction.')
+@with_appcontext
+def purge_profile_command(profile_id, pending, chunk_size):
+    """Delete a profile and everything below it, in chunks."""
+    if pending == (profile_id is not None):
+        raise click.UsageError('Give either a PROFILE_ID or --pending.')
+    if pending:
+        ids = pending_deletes()
+    elif Profile.query.get(profile_id) is None:
+        raise click.ClickException('Profile %d does not exist.' % profile_id)
+    else:
+        ids = [profile_id]
+    for id in ids:
+        counts = purge_profile_in_chunks(id, chunk_size)
+        click.echo('Profile %d: %s' % (id, ', '.join('%s: %d' % item for item in sorted(counts.items()))))
+    if pending and not ids:
+        click.echo('No profiles are waiting to be deleted.')
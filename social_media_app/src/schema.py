@@ -0,0 +1,37 @@
+# Schema checks that keep the hot access paths indexed.
+# Postgres does not index foreign key columns automatically, so a forgotten index turns every "children of X" lookup
+# (and every delete of X) into a sequential scan. uncovered_foreign_keys() is run by the test suite and by
+# `flask check-indexes` so a model cannot gain a foreign key without an index that covers it.
+import click
+import sqlalchemy as sa
+from flask.cli import with_appcontext
+from .models import db
+
+
+def _leading_columns(columns):
+    return [c.name for c in columns]
+
+
+def uncovered_foreign_keys(metadata=None):
+    """Return 'table.column' for every foreign key whose columns do not lead an index, primary key or unique constraint"""
+    metadata = metadata if metadata is not None else db.metadata
+    uncovered = []
+    for table in metadata.sorted_tables:
+        candidates = [_leading_columns(index.columns) for index in table.indexes]
+        candidates += [_leading_columns(c.columns) for c in table.constraints
+                       if isinstance(c, (sa.PrimaryKeyConstraint, sa.UniqueConstraint))]
+        for fk in table.foreign_key_constraints:
+            fk_columns = set(_leading_columns(fk.columns))
+            if not any(set(columns[:len(fk_columns)]) == fk_columns for columns in candidates):
+                uncovered.append('%s.%s' % (table.name, ','.join(sorted(fk_columns))))
+    return uncovered
+
+
+@click.command('check-indexes')
+@with_appcontext
+def check_indexes_command():
+    """Fail if a foreign key has no covering index."""
+    uncovered = uncovered_foreign_keys()
+    if uncovered:
+        raise click.ClickException('Foreign keys without a covering index: %s' % ', '.join(uncovered))
+    click.echo('Every foreign key has a covering index.')
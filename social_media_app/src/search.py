@@ -0,0 +1,179 @@
+# Full-text search over Post.content and Comment.content, used by GET /search.
+# On Postgres every table has a search_vector tsvector column that a trigger keeps up to date and a GIN index covers
+# (migration 0004), so a search is one ranked index lookup per table. The column is maintained by the database only and
+# is not mapped on the models. Anywhere else (the SQLite test database) an in-process inverted index is used instead:
+# it is built from the tables on the first search and kept current from ORM flush events, so a search only touches
+# the rows that contain its terms rather than scanning the table.
+import math
+import re
+import threading
+from collections import defaultdict
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from .models import Comment, Post, db
+
+SEARCHABLE = {'post': (Post, Post.post_date), 'comment': (Comment, Comment.comment_date)}  # result type -> model
+TS_CONFIG = 'english'  # Postgres text search configuration used by the triggers and the queries
+MAX_RESULTS = 1000  # Deepest result a client can page to, ranked search has no keyset to seek on
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(content):
+    return _WORD.findall((content or '').lower())
+
+
+class PostgresSearch:
+    """Ranked search with websearch_to_tsquery() against the trigger-maintained search_vector columns"""
+
+    def search(self, q: str, types, limit: int, offset: int):
+        selects = []
+        for kind in types:
+            model, date_column = SEARCHABLE[kind]
+            selects.append(
+                "SELECT '%s' AS kind, t.id, t.%s AS date, ts_rank(t.search_vector, q) AS rank "
+                "FROM %s t, websearch_to_tsquery('%s', :q) q WHERE t.search_vector @@ q"
+                % (kind, date_column.key, model.__tablename__, TS_CONFIG))
+        statement = text(' UNION ALL '.join(selects) + ' ORDER BY rank DESC, date DESC, id DESC LIMIT :limit OFFSET :offset')
+        rows = db.session.execute(statement, {'q': q, 'limit': limit, 'offset': offset})
+        return [(row.kind, row.id, float(row.rank)) for row in rows]
+
+
+class InvertedIndex:
+    """In-process term -> {(kind, id): term frequency} index with tf-idf ranking, for databases without tsvector"""
+
+    def __init__(self):
+        self._postings = defaultdict(dict)  # term -> {(kind, id): count}
+        self._documents = {}  # (kind, id) -> terms
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.loaded = False
+
+    def add(self, kind: str, id: int, content: str):
+        terms = tokenize(content)
+        with self._lock:
+            self._remove((kind, id))
+            counts = defaultdict(int)
+            for term in terms:
+                counts[term] += 1
+            for term, count in counts.items():
+                self._postings[term][(kind, id)] = count
+            self._documents[(kind, id)] = tuple(counts)
+
+    def remove(self, kind: str, id: int):
+        with self._lock:
+            self._remove((kind, id))
+
+    def _remove(self, key):
+        document = self._documents.pop(key, None)
+        if document is None:
+            return
+        for term in document:
+            postings = self._postings[term]
+            postings.pop(key, None)
+            if not postings:
+                del self._postings[term]
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self.loaded = False
+
+    def load(self):
+        """Index every post and comment (once, on the first search)"""
+        self.clear()
+        for kind, (model, _) in SEARCHABLE.items():
+            for id, content in db.session.query(model.id, model.content).yield_per(1000):
+                self.add(kind, id, content)
+        self.loaded = True
+
+    def search(self, q: str, types, limit: int, offset: int):
+        if not self.loaded:
+            with self._load_lock:  # concurrent first searches build the index once
+                if not self.loaded:
+                    self.load()
+        terms = set(tokenize(q))
+        if not terms:
+            return []
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            postings.sort(key=len)  # intersect starting from the rarest term
+            total = len(self._documents) or 1
+            scores = {}
+            for key in postings[0]:
+                if key[0] in types and all(key in p for p in postings[1:]):
+                    # Every term must match (like websearch_to_tsquery), rank by tf-idf
+                    scores[key] = sum(p[key] * math.log(1 + total / len(p)) for p in postings)
+            ranked = sorted(scores.items(), key=lambda item: (item[1], item[0][1]), reverse=True)  # ties: newest id first
+        return [(kind, id, round(score, 6)) for (kind, id), score in ranked[offset:offset + limit]]
+
+
+class SearchIndex:
+    """The search backend for the app's database: tsvector queries on Postgres, the in-process index otherwise"""
+
+    def __init__(self):
+        self.backend = None
+        self._listening = False
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_BACKEND', 'auto')  # 'postgres', 'memory' or 'auto' (postgres when the database is)
+        backend = app.config['SEARCH_BACKEND']
+        if backend == 'auto':
+            uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+            backend = 'postgres' if uri.startswith('postgresql') else 'memory'
+        self.backend = PostgresSearch() if backend == 'postgres' else InvertedIndex()
+
+        if not self._listening:
+            # Session class events cover the scoped session Flask-SQLAlchemy creates
+            event.listen(Session, 'after_flush', _after_flush)
+            event.listen(Session, 'after_commit', _after_commit)
+            event.listen(Session, 'after_soft_rollback', _after_rollback)
+            self._listening = True
+        app.extensions['search_index'] = self
+
+    def search(self, q: str, types, limit: int, offset: int):
+        """[(kind, id, rank)] for one page of results, best match first"""
+        return self.backend.search(q, types, limit, offset)
+
+
+search_index = SearchIndex()
+
+
+def _kind_of(obj):
+    for kind, (model, _) in SEARCHABLE.items():
+        if isinstance(obj, model):
+            return kind
+    return None
+
+
+def _after_flush(session, flush_context):
+    # Collect changed posts and comments, the inverted index is only updated once the transaction commits
+    index = search_index.backend
+    if not isinstance(index, InvertedIndex) or not index.loaded:
+        return
+    pending = session.info.setdefault('search_pending', [])
+    for obj in list(session.new) + list(session.dirty):
+        kind = _kind_of(obj)
+        if kind is not None:
+            pending.append(('add', kind, obj.id, obj.content))
+    for obj in session.deleted:
+        kind = _kind_of(obj)
+        if kind is not None:
+            pending.append(('remove', kind, obj.id, None))
+
+
+def _after_commit(session):
+    pending = session.info.pop('search_pending', None)
+    index = search_index.backend
+    if not pending or not isinstance(index, InvertedIndex):
+        return
+    for action, kind, id, content in pending:
+        if action == 'remove':
+            index.remove(kind, id)
+        else:
+            index.add(kind, id, content)
+
+
+def _after_rollback(session, previous_transaction):
+    session.info.pop('search_pending', None)
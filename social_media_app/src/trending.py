@@ -0,0 +1,126 @@
+# Trending posts: engagement score over the last N hours with exponential decay, served by GET /posts/trending.
+# Likes (from the like flusher in counters.py) and new comments add to an hourly (hour, post_id) bucket in
+# trending_buckets with an upsert, so the score is maintained incrementally and a ranking only aggregates the buckets
+# of the window. The top posts for each window are kept in memory for TRENDING_REFRESH seconds, so a request is O(k),
+# and buckets older than TRENDING_MAX_HOURS are compacted away (deleted) at most once per TRENDING_COMPACT_INTERVAL.
+import threading
+import time
+from flask import current_app
+from sqlalchemy import case, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .models import TrendingBucket, db
+
+LIKE_WEIGHT = 1.0  # Score of one like
+COMMENT_WEIGHT = 3.0  # Score of one comment, a reply takes more effort than a like
+HALF_LIFE_HOURS = 6.0  # A bucket this many hours old counts half as much as the current hour
+MAX_HOURS = 168  # Longest window a client can ask for, older buckets are compacted away
+MAX_RESULTS = 100  # Posts kept per ranking, the most a client can ask for
+REFRESH_SECONDS = 10  # How long a ranking is served from memory before it is recomputed
+COMPACT_INTERVAL = 3600  # Seconds between deletes of expired buckets
+
+
+def current_hour(now: float = None):
+    return int((now if now is not None else time.time()) // 3600)
+
+
+def add_scores(scores: dict, hour: int = None):
+    """Add {post_id: score} to the current hour's buckets, in the caller's transaction (no commit)"""
+    if not scores:
+        return
+    hour = hour if hour is not None else current_hour()
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        statement = pg_insert(TrendingBucket.__table__)
+    elif dialect == 'sqlite':
+        statement = sqlite_insert(TrendingBucket.__table__)
+    else:
+        raise RuntimeError("Trending scores need INSERT ... ON CONFLICT (Postgres or SQLite), not %s." % dialect)
+    # score = score + delta in the database, so concurrent workers never overwrite each other's scores
+    statement = statement.on_conflict_do_update(
+        index_elements=['hour', 'post_id'],
+        set_={'score': TrendingBucket.__table__.c.score + statement.excluded.score})
+    # Sorted by post id so two workers upserting the same hour lock rows in the same order (no deadlocks)
+    db.session.execute(statement, [{'hour': hour, 'post_id': id, 'score': score} for id, score in sorted(scores.items())])
+
+
+def record_likes(deltas: dict):
+    """Score {post_id: like delta} flushed by the like buffer (unlikes take the score back down)"""
+    weight = current_app.config['TRENDING_LIKE_WEIGHT']
+    add_scores({id: delta * weight for id, delta in deltas.items()})
+
+
+def record_comments(comments):
+    """Score newly created comments (or rows with a post_id) on their posts, without committing"""
+    weight = current_app.config['TRENDING_COMMENT_WEIGHT']
+    scores = {}
+    for c in comments:
+        scores[c.post_id] = scores.get(c.post_id, 0) + weight
+    add_scores(scores)
+
+
+class TrendingRankings:
+    """Top posts per window size, recomputed from trending_buckets at most every TRENDING_REFRESH seconds"""
+
+    def __init__(self):
+        self._rankings = {}  # hours -> (computed_at, [(post_id, score), ...])
+        self._lock = threading.Lock()
+        self._compacted_at = 0.0
+
+    def init_app(self, app):
+        app.config.setdefault('TRENDING_LIKE_WEIGHT', LIKE_WEIGHT)
+        app.config.setdefault('TRENDING_COMMENT_WEIGHT', COMMENT_WEIGHT)
+        app.config.setdefault('TRENDING_HALF_LIFE_HOURS', HALF_LIFE_HOURS)
+        app.config.setdefault('TRENDING_MAX_HOURS', MAX_HOURS)
+        app.config.setdefault('TRENDING_MAX_RESULTS', MAX_RESULTS)
+        app.config.setdefault('TRENDING_REFRESH', REFRESH_SECONDS)
+        app.config.setdefault('TRENDING_COMPACT_INTERVAL', COMPACT_INTERVAL)
+        self.clear()
+        app.extensions['trending'] = self
+
+    def clear(self):
+        with self._lock:
+            self._rankings.clear()
+            self._compacted_at = 0.0
+
+    def top(self, hours: int, limit: int):
+        """[(post_id, score)] of the limit best posts over the last hours, best first"""
+        config = current_app.config
+        now = time.monotonic()
+        with self._lock:
+            ranking = self._rankings.get(hours)
+        if ranking is None or now - ranking[0] >= config['TRENDING_REFRESH']:
+            if now - self._compacted_at >= config['TRENDING_COMPACT_INTERVAL']:
+                self.compact()
+                self._compacted_at = now
+            ranking = (now, self._compute(hours))
+            with self._lock:
+                self._rankings[hours] = ranking
+        return ranking[1][:limit]
+
+    def _compute(self, hours: int):
+        config = current_app.config
+        half_life = config['TRENDING_HALF_LIFE_HOURS']
+        now = current_hour()
+        # One decay factor per bucket in the window: score x 0.5 ^ (age / half-life)
+        decay = case({now - age: 0.5 ** (age / half_life) for age in range(hours)}, value=TrendingBucket.hour, else_=0)
+        score = func.sum(TrendingBucket.score * decay).label('score')
+        # ( comparable to SELECT post_id, sum(score * <decay>) FROM trending_buckets WHERE hour > :now - :hours GROUP BY post_id ORDER BY 2 DESC LIMIT 100; )
+        rows = db.session.query(TrendingBucket.post_id, score) \
+            .filter(TrendingBucket.hour > now - hours) \
+            .group_by(TrendingBucket.post_id) \
+            .having(score > 0) \
+            .order_by(score.desc(), TrendingBucket.post_id.desc()) \
+            .limit(config['TRENDING_MAX_RESULTS']) \
+            .all()
+        return [(post_id, round(score, 6)) for post_id, score in rows]
+
+    def compact(self):
+        """Delete buckets that have fallen out of the longest window"""
+        oldest = current_hour() - current_app.config['TRENDING_MAX_HOURS']
+        deleted = TrendingBucket.query.filter(TrendingBucket.hour <= oldest).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+trending = TrendingRankings()
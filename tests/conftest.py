@@ -1,6 +1,56 @@
 import pytest
+from datetime import datetime
+from sqlalchemy import event
 from social_media_app.src import create_app
-from social_media_app.src.models import db
+from social_media_app.src.models import Profile, Post, db
 
 def test_conftest():
-    assert True
\ No newline at end of file
+    assert True
+
+# Build the app against an in-memory SQLite database so the tests do not need the Postgres container
+@pytest.fixture
+def app():
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'SQLALCHEMY_ECHO': False,
+        'LIKE_FLUSH_INTERVAL': 0  # no background flusher, tests flush by hand
+    })
+    with app.app_context():
+        # pysqlite only sends BEGIN before a write, so a SAVEPOINT would start (and its RELEASE commit) the transaction;
+        # let SQLAlchemy send BEGIN itself, as on Postgres
+        @event.listens_for(db.engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(db.engine, 'begin')
+        def begin(connection):
+            connection.connection.execute('BEGIN')  # on the DBAPI connection, so it is not counted as a query
+
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+# Factories for the rows most tests start from: make_profile('ana') and make_post('text', profile) insert and return one
+@pytest.fixture
+def make_profile(app):
+    def make(username='brent', name=None):
+        profile = Profile(username=username, password='x' * 8, name=name or username.title(), start_date=datetime(2024, 1, 1),
+                          birthday=datetime(1990, 1, 1))
+        profile.insert()
+        return profile
+    return make
+
+@pytest.fixture
+def make_post(make_profile):
+    # Without a profile, each post gets a new one (so call it once per test, or pass the profile)
+    def make(content='hello', profile=None, post_date=datetime(2024, 5, 1)):
+        post = Post(content=content, post_date=post_date, profile_id=(profile or make_profile()).id)
+        post.insert()  # fans out to the timelines too
+        return post
+    return make
@@ -0,0 +1,116 @@
+import time
+from datetime import datetime
+from social_media_app.src.cache import LocalCache, entity_cache
+from social_media_app.src.counters import like_buffer
+from social_media_app.src.models import Post, db
+
+def test_local_cache_evicts_least_recently_used():
+    cache = LocalCache(max_entries=2)
+    cache.set('a', {'n': 1}, 60)
+    cache.set('b', {'n': 2}, 60)
+    cache.get('a')
+    cache.set('c', {'n': 3}, 60)
+    assert cache.get('b') is None
+    assert cache.get('a') == {'n': 1}
+
+def test_local_cache_evicts_by_size():
+    cache = LocalCache(max_entries=10, max_bytes=100)
+    cache.set('a', {'n': 1}, 60, 60)
+    cache.set('b', {'n': 2}, 60, 30)
+    cache.set('c', {'n': 3}, 60, 30)  # 120 bytes, 'a' goes
+    assert cache.get('a') is None and cache.get('b') == {'n': 2} and cache.get('c') == {'n': 3}
+
+def test_local_cache_expires_entries():
+    cache = LocalCache()
+    cache.set('a', {'n': 1}, 0.01)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+
+def test_show_reads_through_cache_and_update_invalidates(client, make_post):
+    post = make_post()
+    assert client.get('/posts/%d' % post.id).get_json()['content'] == 'hello'
+
+    # A write that bypasses the model is not seen because the payload is served from the cache
+    db.session.execute(Post.__table__.update().values(content='changed behind the cache'))
+    db.session.commit()
+    assert client.get('/posts/%d' % post.id).get_json()['content'] == 'hello'
+
+    # update() invalidates, so the next read goes back to the database
+    post = Post.query.get(post.id)
+    post.content = 'edited'
+    post.update()
+    assert client.get('/posts/%d' % post.id).get_json()['content'] == 'edited'
+
+def test_shared_backend_fills_local_tier(client, make_post):
+    post = make_post()
+    entity_cache.shared = LocalCache()  # local stand-in for the shared (Redis) backend
+    try:
+        client.get('/posts/%d' % post.id)
+        entity_cache.local.clear()
+        assert entity_cache.get(Post, post.id)['content'] == 'hello'
+        post.delete()
+        assert entity_cache.shared.get(entity_cache.key(Post, post.id)) is None
+    finally:
+        entity_cache.shared = None
+
+def test_show_still_404s(client):
+    assert client.get('/posts/999').status_code == 404
+
+def test_show_etag_and_not_modified(client, make_post):
+    post = make_post()
+    response = client.get('/posts/%d' % post.id)
+    etag = response.headers['ETag']
+    assert etag == '"posts-%d-1"' % post.id
+
+    response = client.get('/posts/%d' % post.id, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    # Also answered without the cache, from the version column alone
+    entity_cache.local.clear()
+    assert client.get('/posts/%d' % post.id, headers={'If-None-Match': etag}).status_code == 304
+
+    post = Post.query.get(post.id)
+    post.content = 'edited'
+    post.update()
+    response = client.get('/posts/%d' % post.id, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] == '"posts-%d-2"' % post.id
+
+def test_index_etag_changes_with_the_page(client, make_post):
+    post = make_post()
+    etag = client.get('/posts').headers['ETag']
+    assert client.get('/posts', headers={'If-None-Match': etag}).status_code == 304
+
+    client.post('/posts/%d/like' % post.id)
+    like_buffer.flush()
+    response = client.get('/posts', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['results'][0]['likes'] == 1
+    assert response.headers['ETag'] != etag
+
+def test_index_ids_keeps_order_and_reports_missing(client, make_post):
+    first = make_post()
+    second = Post(content='second', post_date=datetime(2024, 5, 2), profile_id=first.profile_id)
+    second.insert()
+    first_id, second_id = first.id, second.id
+    client.get('/posts/%d' % first_id)  # cached
+
+    body = client.get('/posts?ids=%d,999,%d,%d' % (second_id, first_id, second_id)).get_json()
+    assert [p['id'] for p in body['results']] == [second_id, first_id]
+    assert body['missing'] == [999]
+    assert body['results'][0] == client.get('/posts/%d' % second_id).get_json()  # now cached too
+
+    # Both entries are cached, so the database is not read again
+    db.session.execute(Post.__table__.update().values(content='changed behind the cache'))
+    db.session.commit()
+    assert client.get('/posts?ids=%d,%d' % (first_id, second_id)).get_json()['results'][1]['content'] == 'second'
+
+def test_index_ids_validates(app, client):
+    app.config['MULTIGET_MAX_IDS'] = 2
+    assert client.get('/profiles?ids=').status_code == 400
+    assert client.get('/profiles?ids=1,x').status_code == 400
+    assert client.get('/profiles?ids=1,²').status_code == 400  # a Unicode digit, not a number
+    assert client.get('/profiles?ids=1,2,3').status_code == 400
+    assert client.get('/profiles?ids=1,1,1').status_code == 400  # counted before duplicates are dropped
+    assert client.get('/comments?ids=1').get_json() == {'results': [], 'missing': [1]}
@@ -1,2 +1,184 @@
+import json
+import pytest
+from flask import _app_ctx_stack
+from datetime import datetime
+from social_media_app.src.models import Post, Comment, IdempotencyKey, db
+
 def test_comments():
-    assert True
\ No newline at end of file
+    assert True
+
+def test_bulk_create_inserts_every_item(client, make_post):
+    post = make_post()
+    body = [{'content': 'c%d' % n, 'comment_date': '2024-05-02T10:00:0%d' % n, 'post_id': post.id} for n in range(3)]
+    response = client.post('/comments/bulk', json=body)
+    assert response.status_code == 200
+    assert [c['content'] for c in response.get_json()['results']] == ['c0', 'c1', 'c2']
+    assert Comment.query.count() == 3
+
+def test_bulk_create_reports_item_errors_and_inserts_nothing(client, make_post):
+    post = make_post()
+    body = [
+        {'content': 'ok', 'comment_date': '2024-05-02', 'post_id': post.id},
+        {'content': 'no date', 'post_id': post.id},
+        {'content': 'bad post', 'comment_date': '2024-05-02', 'post_id': 999},
+    ]
+    response = client.post('/comments/bulk', json=body)
+    assert response.status_code == 400
+    assert [e['index'] for e in response.get_json()['errors']] == [1, 2]
+    assert Comment.query.count() == 0
+
+def test_create_checks_the_post_exists(client, make_post):
+    post = make_post()
+    response = client.post('/comments', json={'content': 'orphan', 'comment_date': '2024-05-02', 'post_id': 999})
+    assert response.status_code == 400 and 'post_id 999 does not exist' in response.get_data(as_text=True)
+    assert client.post('/comments', json={'content': 'ok', 'comment_date': '2024-05-02', 'post_id': post.id}).status_code == 200
+    assert Comment.query.count() == 1
+
+def test_bulk_create_rejects_non_array(client):
+    assert client.post('/comments/bulk', json={'content': 'x'}).status_code == 400
+
+def test_post_events_stream_new_comments(app, client, make_post):
+    post = make_post()
+    other = Post(content='other', post_date=datetime(2024, 5, 1), profile_id=post.profile_id)
+    other.insert()
+    response = client.get('/posts/%d/events' % post.id)
+    assert response.mimetype == 'text/event-stream'
+    events = iter(response.response)
+    assert next(events) == b'retry: 3000\n\n'
+
+    Comment(content='elsewhere', comment_date=datetime(2024, 5, 2), post_id=other.id).insert()  # another post's topic
+    comment = Comment(content='first!', comment_date=datetime(2024, 5, 2), post_id=post.id)
+    comment.insert()
+    expected = {'type': 'comment', 'action': 'created', 'id': comment.id, 'post_id': post.id}
+    context = _app_ctx_stack.top  # a real server iterates the body after the request's contexts are popped
+    context.pop()
+    try:
+        event = next(events)
+    finally:
+        context.push()
+    assert event.startswith(b'event: comment.created\ndata: ')
+    assert json.loads(event.split(b'data: ')[1]) == expected
+    response.close()
+    assert not app.extensions['change_feed'].subscribers  # unsubscribed when the client went away
+
+def test_events_are_only_sent_after_commit(app, client, make_post):
+    post = make_post()
+    feed = app.extensions['change_feed']
+    subscription = feed.subscribe(post.id)
+    feed.publish(db.session, 'comment', 'created', 123, post_id=post.id)
+    db.session.rollback()
+    assert subscription.get(timeout=0) is None
+    subscription.close()
+
+def test_slow_event_subscriber_is_reset(app, client, make_post):
+    post = make_post()
+    app.config['EVENTS_QUEUE_SIZE'] = 2
+    subscription = app.extensions['change_feed'].subscribe()  # everything
+    for n in range(3):
+        Comment(content='c%d' % n, comment_date=datetime(2024, 5, 2), post_id=post.id).insert()
+    assert subscription.get(timeout=0)['action'] == 'reset'
+    assert subscription.get(timeout=0) is None
+    subscription.close()
+
+def test_post_events_missing_post(client):
+    assert client.get('/posts/999/events').status_code == 404
+
+def test_retried_create_with_idempotency_key_is_replayed(client, make_post):
+    post = make_post()
+    body = [{'content': 'once', 'comment_date': '2024-05-02', 'post_id': post.id}]
+    headers = {'Idempotency-Key': 'retry-1'}
+    first = client.post('/comments/bulk', json=body, headers=headers)
+    second = client.post('/comments/bulk', json=body, headers=headers)
+    assert first.status_code == second.status_code == 200
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_json() == first.get_json()
+    assert Comment.query.count() == 1
+    # The same key with another body is a client bug, not a retry
+    assert client.post('/comments/bulk', json=body * 2, headers=headers).status_code == 422
+
+def test_failed_create_can_be_retried_with_the_same_key(client, make_post):
+    post = make_post()
+    headers = {'Idempotency-Key': 'retry-2'}
+    assert client.post('/comments/bulk', json=[{'content': 'no date', 'post_id': post.id}], headers=headers).status_code == 400
+    body = [{'content': 'fixed', 'comment_date': '2024-05-02', 'post_id': post.id}]
+    response = client.post('/comments/bulk', json=body, headers=headers)
+    assert response.status_code == 200 and 'Idempotent-Replayed' not in response.headers
+
+def test_idempotency_keys_are_shared_through_the_table(app, client, monkeypatch, make_post):
+    post = make_post()
+    store = app.extensions['idempotency']
+    monkeypatch.setattr(store, 'use_table', True)
+    body = [{'content': 'once', 'comment_date': '2024-05-02', 'post_id': post.id}]
+    headers = {'Idempotency-Key': 'retry-3'}
+    first = client.post('/comments/bulk', json=body, headers=headers)
+    store.local.clear()  # as if the retry reached another worker
+    second = client.post('/comments/bulk', json=body, headers=headers)
+    assert second.headers['Idempotent-Replayed'] == 'true' and second.get_json() == first.get_json()
+    assert Comment.query.count() == 1
+    assert IdempotencyKey.query.one().status_code == 200
+
+def test_key_of_a_dead_worker_is_taken_over_after_its_lease(app, client, monkeypatch, make_post):
+    import hashlib
+    from datetime import timedelta
+    post = make_post()
+    store = app.extensions['idempotency']
+    monkeypatch.setattr(store, 'use_table', True)
+    body = json.dumps([{'content': 'once', 'comment_date': '2024-05-02', 'post_id': post.id}])
+    headers = {'Idempotency-Key': 'retry-4', 'Content-Type': 'application/json'}
+    # The in-progress row of a worker that was killed before it stored the response
+    key = hashlib.sha256(b'POST /comments/bulk retry-4').hexdigest()
+    fingerprint = hashlib.sha256(body.encode('utf-8')).hexdigest()
+    db.session.add(IdempotencyKey(key=key, fingerprint=fingerprint, created_at=datetime.utcnow()))
+    db.session.commit()
+    assert client.post('/comments/bulk', data=body, headers=headers).status_code == 409  # still within its lease
+
+    IdempotencyKey.query.get(key).created_at = datetime.utcnow() - timedelta(seconds=store.lease + 1)
+    db.session.commit()
+    response = client.post('/comments/bulk', data=body, headers=headers)
+    assert response.status_code == 200 and Comment.query.count() == 1
+    assert IdempotencyKey.query.one().status_code == 200
+
+def test_create_is_committed_with_its_stored_response(app, client, monkeypatch, make_post):
+    post = make_post()
+    store = app.extensions['idempotency']
+    monkeypatch.setattr(store, 'use_table', True)
+
+    def killed(*args):
+        raise RuntimeError('worker killed')  # after the view, before the stored response is committed
+    monkeypatch.setattr(store, 'store', killed)
+    body = [{'content': 'once', 'comment_date': '2024-05-02', 'post_id': post.id}]
+    with pytest.raises(RuntimeError):
+        client.post('/comments/bulk', json=body, headers={'Idempotency-Key': 'retry-5'})
+    db.session.rollback()  # the dead worker's connection goes away with its transaction
+    assert Comment.query.count() == 0
+
+def test_deleting_a_comment_deletes_its_images(app, make_post):
+    from social_media_app.src.models import Image
+    post = make_post()
+    comment = Comment(content='nice', comment_date=datetime(2024, 5, 2), post_id=post.id)
+    comment.insert()
+    Image(url='http://img/1.png', image_date=datetime(2024, 5, 2), post_id=post.id, comment_id=comment.id).insert()
+    Image(url='http://img/2.png', image_date=datetime(2024, 5, 2), post_id=post.id).insert()
+    Comment.query.get(comment.id).delete()
+    assert [i.url for i in Image.query.all()] == ['http://img/2.png']
+    assert Post.query.get(post.id).image_count == 1
+
+def test_moving_a_comment_moves_its_counts_and_images(app, client, make_post):
+    from social_media_app.src.models import Image
+    first = make_post()
+    second = Post(content='other', post_date=datetime(2024, 5, 1), profile_id=first.profile_id)
+    second.insert()
+    first_id, second_id = first.id, second.id
+    comment = Comment(content='nice', comment_date=datetime(2024, 5, 2), post_id=first_id)
+    comment.insert()
+    Image(url='http://img/1.png', image_date=datetime(2024, 5, 2), post_id=first_id, comment_id=comment.id).insert()
+    comment.post_id = second_id  # expired by the commits above, as a later request would see it
+    comment.update()
+    assert [(p.comment_count, p.image_count) for p in (Post.query.get(first_id), Post.query.get(second_id))] == [(0, 0), (1, 1)]
+    assert Image.query.one().post_id == second_id
+    # and back, loaded before it changes as the PATCH endpoint does
+    comment = Comment.query.get(comment.id)
+    assert comment.post_id == second_id
+    comment.post_id = first_id
+    comment.update()
+    assert [(p.comment_count, p.image_count) for p in (Post.query.get(first_id), Post.query.get(second_id))] == [(1, 1), (0, 0)]
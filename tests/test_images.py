@@ -1,3 +1,24 @@
+from datetime import datetime
+from social_media_app.src.models import Comment, Image
+
 def test_images():
     assert True
 
+def test_bulk_create_checks_the_comment_is_on_the_post(client, make_profile, make_post):
+    profile = make_profile()
+    first, second = (make_post('p%d' % n, profile) for n in range(2))
+    comment = Comment(content='nice', comment_date=datetime(2024, 5, 2), post_id=first.id)
+    comment.insert()
+    body = [{'url': 'a.png', 'image_date': '2024-05-02', 'post_id': post_id, 'comment_id': comment.id} for post_id in (first.id, second.id)]
+    response = client.post('/images/bulk', json=body)
+    assert response.status_code == 400
+    assert [e['index'] for e in response.get_json()['errors']] == [1]
+    assert Image.query.count() == 0
+
+def test_create_checks_the_post_and_comment_exist(client, make_post):
+    post = make_post('p')
+    image = {'url': 'a.png', 'image_date': '2024-05-02', 'post_id': post.id}
+    assert client.post('/images', json=dict(image, post_id=999)).status_code == 400
+    assert client.post('/images', json=dict(image, comment_id=999)).status_code == 400
+    assert client.post('/images', json=image).status_code == 200
+    assert Image.query.count() == 1
@@ -1,3 +1,240 @@
+import gzip
+import pytest
+from datetime import datetime, timedelta
+from social_media_app.src.models import Profile, Post, Comment, Image, TimelineEntry, TrendingBucket, db
+from social_media_app.src.counters import like_buffer
+
 def test_posts():
     assert True
 
+@pytest.fixture
+def make_posts(make_profile, make_post):
+    # A profile with count posts, 'post 0' first and a minute apart
+    def make(count):
+        profile = make_profile()
+        for n in range(count):
+            make_post('post %d' % n, profile, datetime(2024, 5, 1) + timedelta(minutes=n))
+        return profile
+    return make
+
+def test_index_pages_with_cursor(client, make_posts):
+    make_posts(5)
+    first = client.get('/posts?limit=2').get_json()
+    assert [p['content'] for p in first['results']] == ['post 4', 'post 3']
+    second = client.get('/posts?limit=2&after=' + first['next']).get_json()
+    assert [p['content'] for p in second['results']] == ['post 2', 'post 1']
+    last = client.get('/posts?limit=2&after=' + second['next']).get_json()
+    assert [p['content'] for p in last['results']] == ['post 0']
+    assert last['next'] is None
+
+def test_index_caps_page_size(app, client, make_posts):
+    app.config['PAGE_SIZE_MAX'] = 3
+    make_posts(5)
+    assert len(client.get('/posts?limit=1000').get_json()['results']) == 3
+
+def test_index_rejects_bad_cursor(client):
+    assert client.get('/posts?after=not-a-cursor').status_code == 400
+
+def test_index_streams_ndjson(app, client, make_posts):
+    app.config['STREAM_BATCH_SIZE'] = 2
+    make_posts(5)
+    response = client.get('/posts?stream=1')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == 5
+
+def test_index_streams_on_accept_header(client, make_posts):
+    make_posts(1)
+    response = client.get('/posts', headers={'Accept': 'application/x-ndjson'})
+    assert response.mimetype == 'application/x-ndjson'
+
+def test_likes_are_buffered_then_flushed(client, make_posts):
+    make_posts(1)
+    post = Post.query.first()
+    for _ in range(3):
+        client.post('/posts/%d/like' % post.id)
+    response = client.post('/posts/%d/unlike' % post.id).get_json()
+    assert response['likes'] == 2
+    assert like_buffer.pending(post.id) == 2
+    assert client.get('/posts/%d?exact=1' % post.id).get_json()['likes'] == 2
+    assert like_buffer.pending(post.id) == 0
+    db.session.expire_all()
+    assert Post.query.get(post.id).likes == 2
+
+def test_like_missing_post_404s(client):
+    assert client.post('/posts/999/like').status_code == 404
+
+def test_bulk_create_posts_fans_out(client, make_posts):
+    profile = make_posts(0)
+    body = [{'content': 'bulk %d' % n, 'post_date': '2024-06-0%d' % (n + 1), 'profile_id': profile.id} for n in range(2)]
+    assert client.post('/posts/bulk', json=body).status_code == 200
+    feed = client.get('/profiles/%d/feed' % profile.id).get_json()['results']
+    assert [p['content'] for p in feed] == ['bulk 1', 'bulk 0']
+
+def test_bulk_create_rejects_bad_content(client, make_posts):
+    profile = make_posts(0)
+    body = [{'content': content, 'post_date': '2024-06-01', 'profile_id': profile.id} for content in (5, ['x'], 'x' * 129, 'ok')]
+    response = client.post('/posts/bulk', json=body)
+    assert response.status_code == 400
+    assert [e['index'] for e in response.get_json()['errors']] == [0, 1, 2]
+    assert Post.query.count() == 0
+
+def test_show_expand_uses_a_fixed_number_of_queries(client, make_posts):
+    from sqlalchemy import event
+    from social_media_app.src.models import Comment, Image
+    profile_id = make_posts(1).id
+    post_id = Post.query.first().id
+
+    def count_queries(comment_count):
+        for n in range(comment_count):
+            c = Comment(content='c', comment_date=datetime(2024, 6, 1) + timedelta(minutes=n), post_id=post_id)
+            c.insert()
+            Image(url='u', image_date=datetime(2024, 6, 1), post_id=post_id, comment_id=c.id).insert()
+        db.session.expunge_all()  # start from an empty session like a real request does
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            body = client.get('/posts/%d?expand=author,comments,images&comments_limit=50' % post_id).get_json()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return len(statements), body
+
+    few, body = count_queries(2)
+    many, body = count_queries(20)
+    assert few == many == 4
+    assert body['author']['id'] == profile_id
+    assert len(body['comments']['results']) == 22
+    assert len(body['comments']['results'][0]['images']) == 1
+    assert len(body['images']) == 22
+
+def test_show_rejects_unknown_expand(client, make_posts):
+    make_posts(1)
+    assert client.get('/posts/%d?expand=likes' % Post.query.first().id).status_code == 400
+
+def test_trending_ranks_by_likes_and_comments(app, client, make_posts):
+    app.config['TRENDING_REFRESH'] = 0  # recompute on every request
+    make_posts(3)
+    quiet, liked, discussed = Post.query.order_by(Post.id).all()
+    for _ in range(2):
+        client.post('/posts/%d/like' % liked.id)
+    like_buffer.flush()
+    comment = {'content': 'agreed', 'comment_date': '2024-05-02T00:00:00', 'post_id': discussed.id}
+    assert client.post('/comments/bulk', json=[comment, comment]).status_code == 200
+
+    results = client.get('/posts/trending?hours=1').get_json()['results']
+    assert [r['id'] for r in results] == [discussed.id, liked.id]  # 2 comments (x3) outrank 2 likes, no score: left out
+    assert results[1]['likes'] == 2 and results[1]['score'] == 2.0
+
+    assert client.get('/posts/trending?hours=0').status_code == 400
+    assert client.get('/posts/trending?hours=abc').status_code == 400
+
+def test_index_sparse_fieldsets(client, make_posts):
+    make_posts(3)
+    page = client.get('/posts?fields=content,likes&limit=2').get_json()
+    assert page['results'][0] == {'content': 'post 2', 'likes': 0}
+    rest = client.get('/posts?fields=content,likes&limit=2&after=%s' % page['next']).get_json()  # the cursor still works
+    assert [p['content'] for p in rest['results']] == ['post 0']
+
+    post_id = Post.query.order_by(Post.id).first().id
+    assert client.get('/posts/%d?fields=id' % post_id).get_json() == {'id': post_id}
+    assert client.get('/posts/%d?fields=id' % post_id).headers['ETag'] != client.get('/posts/%d' % post_id).headers['ETag']
+    assert client.get('/posts?fields=password').status_code == 400
+
+def test_index_is_compressed_when_accepted(client, make_posts):
+    make_posts(50)
+    plain = client.get('/posts')
+    assert 'Content-Encoding' not in plain.headers
+    response = client.get('/posts', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+    assert gzip.decompress(response.data) == plain.data
+    # The compressed variant's ETag is current too, and the 304 carries the tag the client holds
+    revalidated = client.get('/posts', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304 and revalidated.headers['ETag'] == response.headers['ETag']
+
+def test_batch_creates_post_with_images_and_comment(client, make_posts):
+    profile = make_posts(0)
+    operations = [
+        {'op': 'create', 'type': 'post', 'ref': 'p', 'data': {'content': 'trip', 'post_date': '2024-05-01', 'profile_id': profile.id}},
+        {'op': 'create', 'type': 'image', 'data': {'url': 'a.jpg', 'image_date': '2024-05-01', 'post_id': '$p'}},
+        {'op': 'create', 'type': 'image', 'data': {'url': 'b.jpg', 'image_date': '2024-05-01', 'post_id': '$p'}},
+        {'op': 'create', 'type': 'comment', 'ref': 'c', 'data': {'content': 'first', 'comment_date': '2024-05-01', 'post_id': '$p'}},
+        {'op': 'update', 'type': 'comment', 'id': '$c', 'data': {'content': 'first!'}},
+    ]
+    response = client.post('/batch', json={'operations': operations})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    post = Post.query.one()
+    assert [r['type'] for r in results] == ['post', 'image', 'image', 'comment', 'comment']
+    assert results[0]['id'] == post.id and results[4]['comment']['content'] == 'first!'
+    assert Image.query.filter_by(post_id=post.id).count() == 2
+    assert Comment.query.one().content == 'first!'
+    assert TimelineEntry.query.filter_by(post_id=post.id).count() == 1  # fanned out like POST /posts
+
+def test_batch_post_created_and_deleted_leaves_nothing_behind(client, make_posts):
+    profile = make_posts(0)
+    operations = [
+        {'op': 'create', 'type': 'post', 'ref': 'p', 'data': {'content': 'oops', 'post_date': '2024-05-01', 'profile_id': profile.id}},
+        {'op': 'create', 'type': 'comment', 'data': {'content': 'gone too', 'comment_date': '2024-05-01', 'post_id': '$p'}},
+        {'op': 'delete', 'type': 'post', 'id': '$p'},
+    ]
+    assert client.post('/batch', json={'operations': operations}).status_code == 200
+    assert Post.query.count() == 0 and Comment.query.count() == 0
+    assert TimelineEntry.query.count() == 0 and TrendingBucket.query.count() == 0
+    assert Profile.query.get(profile.id).post_count == 0
+    operations.append({'op': 'update', 'type': 'post', 'id': '$p', 'data': {'content': 'x'}})
+    response = client.post('/batch', json={'operations': operations})
+    assert response.status_code == 400 and 'deleted' in response.get_json()['errors'][0]['error']
+
+def test_batch_post_created_then_liked_counts_its_likes_once(client, make_posts):
+    profile = make_posts(0)
+    operations = [
+        {'op': 'create', 'type': 'post', 'ref': 'p', 'data': {'content': 'liked', 'post_date': '2024-05-01', 'profile_id': profile.id}},
+        {'op': 'update', 'type': 'post', 'id': '$p', 'data': {'likes': 5}},
+    ]
+    assert client.post('/batch', json={'operations': operations}).status_code == 200
+    assert Profile.query.get(profile.id).total_likes == 5
+
+def test_batch_rolls_back_when_an_operation_fails(client, make_posts):
+    profile = make_posts(1)
+    operations = [
+        {'op': 'create', 'type': 'post', 'ref': 'p', 'data': {'content': 'lost', 'post_date': '2024-05-01', 'profile_id': profile.id}},
+        {'op': 'create', 'type': 'comment', 'data': {'content': 'lost', 'comment_date': '2024-05-01', 'post_id': '$p'}},
+        {'op': 'update', 'type': 'comment', 'id': 999, 'data': {'content': 'nope'}},
+    ]
+    response = client.post('/batch', json={'operations': operations})
+    assert response.status_code == 400
+    assert response.get_json()['errors'][0]['index'] == 2
+    assert Post.query.count() == 1 and Comment.query.count() == 0
+    assert client.post('/batch', json={'operations': [{'op': 'create', 'type': 'image', 'data': {'post_id': '$x'}}]}).status_code == 400
+    missing = {'op': 'create', 'type': 'comment', 'data': {'content': 'orphan', 'comment_date': '2024-05-01', 'post_id': 999}}
+    response = client.post('/batch', json={'operations': [missing]})
+    assert response.status_code == 400 and response.get_json()['errors'][0]['error'] == 'post_id 999 does not exist.'
+
+def test_counters_follow_creates_deletes_and_likes(app, client, make_posts):
+    profile = make_posts(2)
+    post = Post.query.order_by(Post.id).first()
+    comment = Comment(content='hi', comment_date=datetime(2024, 5, 2), post_id=post.id)
+    comment.insert()
+    Image(url='a.jpg', image_date=datetime(2024, 5, 2), post_id=post.id, comment_id=comment.id).insert()
+    client.post('/comments/bulk', json=[{'content': 'c%d' % n, 'comment_date': '2024-05-02', 'post_id': post.id} for n in range(3)])
+    client.post('/posts/%d/like' % post.id)
+    like_buffer.flush()
+    assert client.get('/posts/%d?include=counts' % post.id).get_json()['counts'] == {'comment_count': 4, 'image_count': 1}
+    assert client.get('/profiles/%d?include=counts' % profile.id).get_json()['counts'] == {'post_count': 2, 'total_likes': 1}
+
+    comment.delete()  # takes its image with it
+    counts = client.get('/posts?include=counts&fields=id').get_json()['results'][-1]
+    assert counts == {'id': post.id, 'counts': {'comment_count': 3, 'image_count': 0}}
+    post.delete()
+    assert client.get('/profiles?ids=%d&include=counts' % profile.id).get_json()['results'][0]['counts'] == {'post_count': 1, 'total_likes': 0}
+    assert client.get('/posts?include=authors').status_code == 400
+
+def test_repair_counters_recomputes_from_the_tables(app, make_posts):
+    from social_media_app.src.aggregates import repair_counters
+    profile = make_posts(3)
+    db.session.execute(Profile.__table__.update().values(post_count=0))  # drifted, e.g. after a manual load
+    db.session.commit()
+    repair_counters(chunk_size=1, log=lambda message: None)
+    assert Profile.query.get(profile.id).post_count == 3
@@ -1,2 +1,123 @@
+import pytest
+from datetime import datetime, timedelta
+from social_media_app.src.models import Profile, Post, Comment, Image, Follow, TimelineEntry, db
+from social_media_app.src.purge import delete_posts, mark_deleting, purge_jobs, purge_profile_in_chunks
+
 def test_profiles():
-    assert True
\ No newline at end of file
+    assert True
+
+@pytest.fixture
+def numbered_post(make_post):
+    # The profile's post n: content '<username> n', n minutes after the first
+    return lambda profile, n: make_post('%s %d' % (profile.username, n), profile, datetime(2024, 5, 1) + timedelta(minutes=n))
+
+def test_feed_merges_followed_profiles(client, make_profile, numbered_post):
+    brent, ana, bob = make_profile('brent'), make_profile('ana'), make_profile('bob')
+    assert client.post('/profiles/%d/following' % brent.id, json={'profile_id': ana.id}).status_code == 200
+    numbered_post(ana, 1)
+    numbered_post(bob, 2)  # not followed, must not show up
+    numbered_post(brent, 3)
+    numbered_post(ana, 4)
+
+    first = client.get('/profiles/%d/feed?limit=2' % brent.id).get_json()
+    assert [p['content'] for p in first['results']] == ['ana 4', 'brent 3']
+    second = client.get('/profiles/%d/feed?limit=2&after=%s' % (brent.id, first['next'])).get_json()
+    assert [p['content'] for p in second['results']] == ['ana 1']
+    assert second['next'] is None
+
+def test_feed_reads_big_profiles_at_read_time(app, client, make_profile, numbered_post):
+    app.config['FEED_FANOUT_MAX_FOLLOWERS'] = 0
+    brent, star = make_profile('brent'), make_profile('star')
+    client.post('/profiles/%d/following' % brent.id, json={'profile_id': star.id})
+    post = numbered_post(star, 1)
+    assert star.fan_out_on_read
+    assert TimelineEntry.query.filter_by(profile_id=brent.id, post_id=post.id).first() is None
+    assert [p['content'] for p in client.get('/profiles/%d/feed' % brent.id).get_json()['results']] == ['star 1']
+
+def test_unfollow_clears_timeline(client, make_profile, numbered_post):
+    brent, ana = make_profile('brent'), make_profile('ana')
+    numbered_post(ana, 1)
+    client.post('/profiles/%d/following' % brent.id, json={'profile_id': ana.id})
+    assert len(client.get('/profiles/%d/feed' % brent.id).get_json()['results']) == 1  # backfilled on follow
+    assert client.delete('/profiles/%d/following/%d' % (brent.id, ana.id)).get_json() is True
+    assert client.get('/profiles/%d/feed' % brent.id).get_json()['results'] == []
+
+def test_delete_profile_removes_everything_below_it(client, make_profile, numbered_post):
+    brent, ana = make_profile('brent'), make_profile('ana')
+    client.post('/profiles/%d/following' % ana.id, json={'profile_id': brent.id})
+    posts = [numbered_post(brent, n) for n in range(3)]
+    comment = Comment(content='nice', comment_date=datetime(2024, 5, 2), post_id=posts[0].id)
+    comment.insert()
+    Image(url='a.png', image_date=datetime(2024, 5, 2), post_id=posts[0].id, comment_id=comment.id).insert()
+    other = numbered_post(ana, 9)
+    brent_id, post_id, other_id = brent.id, posts[0].id, other.id
+
+    assert client.delete('/profiles/%d' % brent_id).get_json() is True
+    assert Profile.query.get(brent_id) is None
+    assert Post.query.filter_by(profile_id=brent_id).count() == 0
+    assert Comment.query.count() == 0 and Image.query.count() == 0
+    assert Follow.query.count() == 0
+    assert TimelineEntry.query.filter(TimelineEntry.post_id != other_id).count() == 0
+    assert client.get('/posts/%d' % post_id).status_code == 404
+    assert client.get('/posts/%d' % other_id).status_code == 200
+
+def test_delete_large_profile_in_chunks(app, client, monkeypatch, make_profile, numbered_post):
+    brent = make_profile('brent')
+    for n in range(5):
+        numbered_post(brent, n)
+    brent_id = brent.id
+
+    # Over PURGE_SYNC_MAX_POSTS the request only starts the background job
+    app.config['PURGE_SYNC_MAX_POSTS'] = 2
+    started = []
+    monkeypatch.setattr(purge_jobs, 'start', started.append)
+    response = client.delete('/profiles/%d' % brent_id)
+    assert response.status_code == 202 and started == [brent_id]
+    assert Profile.query.get(brent_id).deleting_since is not None  # recorded for `purge-profile --pending`
+
+    counts = purge_profile_in_chunks(brent_id, chunk_size=2)
+    assert counts['posts'] == 5 and counts['profiles'] == 1
+    assert Profile.query.get(brent_id) is None
+
+def test_interrupted_delete_is_finished_by_purge_profile_pending(app, make_profile, numbered_post):
+    brent, ana = make_profile('brent'), make_profile('ana')
+    for n in range(3):
+        numbered_post(brent, n)
+    brent_id, ana_id = brent.id, ana.id
+    # A worker that died after marking the profile and deleting one chunk
+    mark_deleting(brent_id)
+    delete_posts(Post.id == Post.query.filter_by(profile_id=brent_id).first().id)
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['purge-profile', '--pending'])
+    assert result.exit_code == 0 and 'Profile %d' % brent_id in result.output
+    assert Profile.query.get(brent_id) is None and Post.query.count() == 0
+    assert Profile.query.get(ana_id) is not None
+    assert 'No profiles' in app.test_cli_runner().invoke(args=['purge-profile', '--pending']).output
+
+def test_changing_post_date_moves_timeline_entries(client, make_profile, numbered_post):
+    brent, ana = make_profile('brent'), make_profile('ana')
+    client.post('/profiles/%d/following' % brent.id, json={'profile_id': ana.id})
+    post = numbered_post(ana, 1)
+    post.post_date = datetime(2024, 6, 1)
+    post.update()
+    assert {e.post_date for e in TimelineEntry.query.filter_by(post_id=post.id)} == {datetime(2024, 6, 1)}
+
+def test_batch_post_date_update_moves_timeline_entries(client, make_profile, numbered_post):
+    brent, ana = make_profile('brent'), make_profile('ana')
+    client.post('/profiles/%d/following' % brent.id, json={'profile_id': ana.id})
+    post = numbered_post(ana, 1)
+    operation = {'op': 'update', 'type': 'post', 'id': post.id, 'data': {'post_date': '2024-06-01'}}
+    assert client.post('/batch', json={'operations': [operation]}).status_code == 200
+    assert {e.post_date for e in TimelineEntry.query.filter_by(post_id=post.id)} == {datetime(2024, 6, 1)}
+
+def test_no_new_rows_under_a_profile_being_deleted(client, make_profile, numbered_post):
+    brent = make_profile('brent')
+    post = numbered_post(brent, 1)
+    brent_id, post_id = brent.id, post.id
+    mark_deleting(brent_id)
+    response = client.post('/posts', json={'content': 'late', 'post_date': '2024-05-02', 'profile_id': brent_id})
+    assert response.status_code == 400 and 'is being deleted' in response.get_data(as_text=True)
+    assert client.post('/comments', json={'content': 'late', 'comment_date': '2024-05-02', 'post_id': post_id}).status_code == 400
+    assert client.post('/images', json={'url': 'a.png', 'image_date': '2024-05-02', 'post_id': post_id}).status_code == 400
+    assert Post.query.count() == 1 and Comment.query.count() == 0 and Image.query.count() == 0
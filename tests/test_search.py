@@ -0,0 +1,42 @@
+from datetime import datetime
+from social_media_app.src.models import Post, Comment
+
+def test_search():
+    assert True
+
+def test_search_ranks_posts_and_comments(client, make_post):
+    post = make_post('Hiking in the mountains')
+    Comment(content='mountains mountains everywhere', comment_date=datetime(2024, 5, 2), post_id=post.id).insert()
+    Comment(content='nice beach', comment_date=datetime(2024, 5, 2), post_id=post.id).insert()
+
+    results = client.get('/search?q=mountains').get_json()['results']
+    assert [r['type'] for r in results] == ['comment', 'post']  # higher term frequency ranks first
+    assert results[1]['post']['id'] == post.id
+    assert client.get('/search?q=mountains&type=post').get_json()['results'][0]['post']['content'] == 'Hiking in the mountains'
+    assert client.get('/search?q=hiking+beach').get_json()['results'] == []  # every term must match
+
+def test_search_index_follows_writes(client, make_post):
+    post = make_post('first draft')
+    assert len(client.get('/search?q=draft').get_json()['results']) == 1  # builds the index
+
+    post = Post.query.get(post.id)
+    post.content = 'final version'
+    post.update()
+    assert client.get('/search?q=draft').get_json()['results'] == []
+    assert len(client.get('/search?q=final').get_json()['results']) == 1
+
+    post.delete()
+    assert client.get('/search?q=final').get_json()['results'] == []
+
+def test_search_pages_and_validates(client, make_post):
+    post = make_post('cat')
+    for i in range(3):
+        Comment(content='cat %d' % i, comment_date=datetime(2024, 5, 2), post_id=post.id).insert()
+    page = client.get('/search?q=cat&limit=3').get_json()
+    assert len(page['results']) == 3
+    rest = client.get('/search?q=cat&limit=3&after=%s' % page['next']).get_json()
+    assert len(rest['results']) == 1 and rest['next'] is None
+
+    assert client.get('/search').status_code == 400
+    assert client.get('/search?q=cat&type=profile').status_code == 400
+    assert client.get('/search?q=cat&after=nope').status_code == 400